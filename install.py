@@ -41,5 +41,6 @@ for name, default in defaults:
         s.value = default
         db.session.add(s)
 db.session.commit()
+models.invalidate_settings()
 
 print('finished setting default settings')
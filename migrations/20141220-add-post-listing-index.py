@@ -0,0 +1,11 @@
+"""
+Composite index for the keyset-paginated stream queries in
+views.collect_posts
+"""
+from sqlalchemy import create_engine
+from config import Configuration
+
+engine = create_engine(Configuration.SQLALCHEMY_DATABASE_URI, echo=True)
+
+engine.execute('create index ix_post_listing '
+               'on post (deleted, draft, hidden, published)')
@@ -0,0 +1,23 @@
+"""
+Single-row table whose version is bumped whenever a Setting changes,
+so that each worker knows when to reload its settings snapshot
+"""
+from sqlalchemy import (create_engine, Column, Integer, MetaData)
+from sqlalchemy.ext.declarative import declarative_base
+from config import Configuration
+
+metadata = MetaData()
+Base = declarative_base(metadata=metadata)
+
+engine = create_engine(Configuration.SQLALCHEMY_DATABASE_URI, echo=True)
+
+
+class SettingsVersion(Base):
+    __tablename__ = 'settings_version'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, default=0)
+
+
+metadata.create_all(engine)
+engine.execute('insert into settings_version (id, version) values (1, 1)')
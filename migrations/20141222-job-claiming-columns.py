@@ -0,0 +1,17 @@
+"""
+Columns used by SqlQueueImpl to claim, retry, and schedule jobs, and
+an index so workers can find pending jobs without a full table scan
+"""
+from sqlalchemy import create_engine
+from config import Configuration
+
+engine = create_engine(Configuration.SQLALCHEMY_DATABASE_URI, echo=True)
+
+engine.execute('alter table job add column run_at timestamp')
+engine.execute('alter table job add column attempts integer default 0')
+engine.execute('alter table job add column locked_by varchar(128)')
+engine.execute('alter table job add column locked_at timestamp')
+engine.execute('alter table job add column error text')
+engine.execute('update job set run_at = created, attempts = 0')
+engine.execute('create index ix_job_pending on job (complete, run_at)')
+engine.execute('create index ix_job_key on job (key)')
@@ -0,0 +1,25 @@
+"""
+Persistent cache of discovered webmention/pingback endpoints
+"""
+from sqlalchemy import (create_engine, Column, String, DateTime, MetaData)
+from sqlalchemy.ext.declarative import declarative_base
+from config import Configuration
+
+metadata = MetaData()
+Base = declarative_base(metadata=metadata)
+
+engine = create_engine(Configuration.SQLALCHEMY_DATABASE_URI, echo=True)
+
+
+class WebmentionEndpoint(Base):
+    __tablename__ = 'webmention_endpoint'
+
+    key = Column(String(512), primary_key=True)
+    webmention = Column(String(512))
+    pingback = Column(String(512))
+    etag = Column(String(256))
+    last_modified = Column(String(64))
+    expires = Column(DateTime, index=True)
+
+
+metadata.create_all(engine)
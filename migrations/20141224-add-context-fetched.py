@@ -0,0 +1,12 @@
+"""
+Record when each context was fetched so that fresh ones can be shared
+between posts instead of refetched, and index context.url for the
+lookup
+"""
+from sqlalchemy import create_engine
+from config import Configuration
+
+engine = create_engine(Configuration.SQLALCHEMY_DATABASE_URI, echo=True)
+
+engine.execute('alter table context add column fetched timestamp')
+engine.execute('create index ix_context_url on context (url)')
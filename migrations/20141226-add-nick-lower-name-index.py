@@ -0,0 +1,10 @@
+"""
+Functional index for the case-insensitive @-name lookups in
+util.resolve_nicks
+"""
+from sqlalchemy import create_engine
+from config import Configuration
+
+engine = create_engine(Configuration.SQLALCHEMY_DATABASE_URI, echo=True)
+
+engine.execute('create index ix_nick_lower_name on nick (lower(name))')
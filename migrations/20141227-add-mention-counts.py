@@ -0,0 +1,81 @@
+"""
+Store the number of replies, likes, reposts, etc. on each post so that
+listings don't have to load every mention to show them. The counts are
+deduplicated the way Post.group_mentions does it: a mention whose
+permalink is a syndication url of another mention of the same type is
+not counted. Safe to run again.
+"""
+import collections
+import json
+from sqlalchemy import (create_engine, Table, Column, String, Integer,
+                        Text, MetaData, select, ForeignKey, bindparam, exc)
+from config import Configuration
+
+engine = create_engine(Configuration.SQLALCHEMY_DATABASE_URI, echo=True)
+
+try:
+    engine.execute('alter table post add column mention_counts text')
+except (exc.OperationalError, exc.ProgrammingError):
+    print('post.mention_counts already exists')
+
+metadata = MetaData()
+
+posts = Table(
+    'post', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('mention_counts', Text),
+)
+
+mentions = Table(
+    'mention', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('permalink', String),
+    Column('syndication', Text),
+    Column('reftype', String),
+)
+
+posts_to_mentions = Table(
+    'posts_to_mentions', metadata,
+    Column('post_id', Integer, ForeignKey('post.id')),
+    Column('mention_id', Integer, ForeignKey('mention.id')),
+)
+
+REFTYPES = ('reply', 'like', 'repost', 'rsvp', 'reference')
+
+
+def count_mentions(rows):
+    by_permalink = set((reftype, permalink)
+                       for _, reftype, permalink, _ in rows if permalink)
+    children = set()
+    for mention_id, reftype, permalink, syndication in rows:
+        for url in json.loads(syndication or '[]') or []:
+            if (reftype, url) in by_permalink:
+                children.add((reftype, url))
+    counts = collections.Counter(
+        reftype for _, reftype, permalink, _ in rows
+        if reftype in REFTYPES and (reftype, permalink) not in children)
+    return dict(counts)
+
+
+def add_mention_counts(conn):
+    by_post = collections.defaultdict(list)
+    for row in conn.execute(
+            select([posts_to_mentions.c.post_id, mentions.c.id,
+                    mentions.c.reftype, mentions.c.permalink,
+                    mentions.c.syndication])
+            .select_from(posts_to_mentions.join(mentions))):
+        by_post[row[0]].append(tuple(row[1:]))
+
+    conn.execute(posts.update().values(mention_counts='{}'))
+    batch = [{'the_post_id': post_id,
+              'counts': json.dumps(count_mentions(rows))}
+             for post_id, rows in by_post.items()]
+    print('counted mentions of {} posts'.format(len(batch)))
+    if batch:
+        conn.execute(posts.update()
+                     .where(posts.c.id == bindparam('the_post_id'))
+                     .values(mention_counts=bindparam('counts')), batch)
+
+
+with engine.begin() as conn:
+    add_mention_counts(conn)
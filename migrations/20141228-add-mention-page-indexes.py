@@ -0,0 +1,13 @@
+"""
+Index posts_to_mentions by (post_id, mention_id) and mention by
+published, so a post's mentions can be paged through without loading
+all of them
+"""
+from sqlalchemy import create_engine
+from config import Configuration
+
+engine = create_engine(Configuration.SQLALCHEMY_DATABASE_URI, echo=True)
+
+engine.execute('create index ix_posts_to_mentions_post_mention '
+               'on posts_to_mentions (post_id, mention_id)')
+engine.execute('create index ix_mention_published on mention (published)')
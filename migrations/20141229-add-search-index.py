@@ -0,0 +1,8 @@
+"""
+Add the full-text search index (a tsvector column with a GIN index on
+Postgres, an FTS5 table on SQLite) and fill it with every post
+"""
+from redwind import search
+
+search.create_index()
+print('indexed {} posts'.format(search.reindex_all()))
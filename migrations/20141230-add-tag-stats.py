@@ -0,0 +1,9 @@
+"""
+Keep per-tag counts and frecency scores in a tag_stat table, so the
+tag cloud and the editor don't aggregate every post on each request
+"""
+from redwind import db
+from redwind import tags
+
+db.create_all()
+tags.update_tag_stats()
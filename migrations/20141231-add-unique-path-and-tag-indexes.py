@@ -0,0 +1,124 @@
+"""
+Unique indexes on post.path, post.historic_path and tag.name, which
+save_post relies on instead of probing for free paths and looking up
+tags one at a time. Duplicates left by earlier races are resolved
+first: duplicate tags are merged into the oldest one, later posts with
+a duplicate path get a -N suffix, and duplicate historic paths are
+kept only on the oldest post. Safe to run again.
+"""
+import collections
+import re
+from sqlalchemy import (create_engine, Table, Column, String, Integer,
+                        MetaData, select, ForeignKey, and_, func, exc)
+from config import Configuration
+
+engine = create_engine(Configuration.SQLALCHEMY_DATABASE_URI, echo=True)
+
+metadata = MetaData()
+
+tags = Table(
+    'tag', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String),
+)
+
+tag_stats = Table(
+    'tag_stat', metadata,
+    Column('tag_id', Integer, primary_key=True),
+)
+
+posts = Table(
+    'post', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('path', String),
+    Column('historic_path', String),
+)
+
+posts_to_tags = Table(
+    'posts_to_tags', metadata,
+    Column('post_id', Integer, ForeignKey('post.id')),
+    Column('tag_id', Integer, ForeignKey('tag.id')),
+)
+
+
+def merge_duplicate_tags(conn):
+    """Returns the ids of the tags that others were merged into"""
+    by_name = collections.defaultdict(list)
+    for tag_id, name in conn.execute(
+            select([tags.c.id, tags.c.name]).order_by(tags.c.id)):
+        by_name[name].append(tag_id)
+
+    merged = set()
+    for name, (keep, *rest) in by_name.items():
+        if not rest:
+            continue
+        print('merging tags', rest, 'into', keep, name)
+        tagged = set(post_id for post_id, in conn.execute(
+            select([posts_to_tags.c.post_id])
+            .where(posts_to_tags.c.tag_id == keep)))
+        for post_id, tag_id in conn.execute(
+                select([posts_to_tags.c.post_id, posts_to_tags.c.tag_id])
+                .where(posts_to_tags.c.tag_id.in_(rest))).fetchall():
+            row = and_(posts_to_tags.c.post_id == post_id,
+                       posts_to_tags.c.tag_id == tag_id)
+            if post_id in tagged:
+                conn.execute(posts_to_tags.delete().where(row))
+            else:
+                conn.execute(posts_to_tags.update().where(row)
+                             .values(tag_id=keep))
+                tagged.add(post_id)
+        conn.execute(tag_stats.delete().where(tag_stats.c.tag_id.in_(rest)))
+        conn.execute(tags.delete().where(tags.c.id.in_(rest)))
+        merged.add(keep)
+    return merged
+
+
+def free_path(conn, base_path):
+    """Same as Post.allocate_path"""
+    suffix = re.compile(re.escape(base_path) + r'-(\d+)$')
+    taken = set()
+    for path, in conn.execute(select([posts.c.path]).where(
+            posts.c.path.like(base_path + '-%'))):
+        m = suffix.match(path)
+        if m:
+            taken.add(int(m.group(1)))
+    idx = 1
+    while idx in taken:
+        idx += 1
+    return '{}-{}'.format(base_path, idx)
+
+
+def resolve_duplicate_paths(conn):
+    for column in (posts.c.path, posts.c.historic_path):
+        dupes = conn.execute(
+            select([column]).where(column != None).group_by(column)
+            .having(func.count() > 1)).fetchall()
+        for path, in dupes:
+            post_ids = [post_id for post_id, in conn.execute(
+                select([posts.c.id]).where(column == path)
+                .order_by(posts.c.id))]
+            for post_id in post_ids[1:]:
+                new_path = free_path(conn, path) \
+                    if column is posts.c.path else None
+                print('post', post_id, 'duplicated', path, '->', new_path)
+                conn.execute(posts.update().where(posts.c.id == post_id)
+                             .values({column: new_path}))
+
+
+with engine.begin() as conn:
+    merged = merge_duplicate_tags(conn)
+    resolve_duplicate_paths(conn)
+
+for statement in (
+        'create unique index ix_post_path on post (path)',
+        'create unique index ix_post_historic_path on post (historic_path)',
+        'create unique index ix_tag_name on tag (name)'):
+    try:
+        engine.execute(statement)
+    except (exc.OperationalError, exc.ProgrammingError):
+        print('already exists:', statement)
+
+if merged:
+    # only reads the columns it needs, so it works on older schemas
+    from redwind.tags import update_tag_stats
+    update_tag_stats(merged)
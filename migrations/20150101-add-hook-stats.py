@@ -0,0 +1,8 @@
+"""
+Table of per-hook call counts, failures and timings for the /hooks
+admin page
+"""
+from redwind import db
+from redwind import hooks
+
+db.create_all()
@@ -0,0 +1,20 @@
+"""
+Record when each post and its mentions last changed, for atom
+<updated> and the page validators. Existing posts start out updated
+when they were published, and mentions_updated at their latest
+mention.
+"""
+from redwind import db
+
+db.engine.execute('alter table post add column updated timestamp')
+db.engine.execute('alter table post add column mentions_updated timestamp')
+db.engine.execute('update post set updated = published')
+db.engine.execute("""
+update post set mentions_updated = (
+  select max(mention.published) from mention
+  join posts_to_mentions on posts_to_mentions.mention_id = mention.id
+  where posts_to_mentions.post_id = post.id)
+""")
+db.engine.execute('create index ix_post_updated on post (updated)')
+db.engine.execute(
+    'create index ix_post_mentions_updated on post (mentions_updated)')
@@ -0,0 +1,9 @@
+"""
+Table of cache namespace generations, so that invalidations made by
+one process (e.g. qworker) reach the others when the cache is the
+in-process LRU
+"""
+from redwind import db
+from redwind import cache
+
+db.create_all()
@@ -0,0 +1,286 @@
+"""
+Shared cache for rendered pages and other expensive results. Entries
+are grouped into namespaces (e.g., 'index' or 'tag:indieweb'); bumping
+a namespace's generation evicts every entry that was stored under it,
+without having to know the individual keys.
+
+The generations have to be seen by every process, including qworker,
+whose jobs invalidate pages served by the web workers. With Redis they
+live next to the entries; with the in-process LRU cache they are kept
+in the cache_generation table, and each process rereads the ones it
+uses at most every CACHE_GENERATION_CHECK_INTERVAL seconds.
+"""
+from . import app
+from . import db
+import collections
+import pickle
+import sqlalchemy
+import threading
+import time
+
+
+class CacheGeneration(db.Model):
+    """Generation of one cache namespace, shared by all processes when
+    the cache itself is not
+    """
+    namespace = db.Column(db.String(256), primary_key=True)
+    generation = db.Column(db.Integer, default=0)
+
+
+class LruCacheImpl:
+    """In-process least-recently-used cache. Only visible to a single
+    worker process, but fast and has no external dependencies.
+    """
+    shared = False
+
+    def __init__(self, max_entries=1000, default_timeout=None):
+        self.max_entries = max_entries
+        self.default_timeout = default_timeout
+        self.entries = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires and expires < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, timeout=None):
+        timeout = timeout or self.default_timeout
+        expires = timeout and time.time() + timeout
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def incr(self, key):
+        with self.lock:
+            value = (self.get(key) or 0) + 1
+            self.entries[key] = (None, value)
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class RedisCacheImpl:
+    """Cache backed by Redis, shared by every worker process that points
+    at the same server (e.g. the uWSGI processes in uwsgi-prod.ini).
+    """
+    shared = True
+
+    def __init__(self, redis_url, prefix, default_timeout=None):
+        import redis
+        self.redis = redis.StrictRedis.from_url(redis_url)
+        self.prefix = prefix
+        self.default_timeout = default_timeout
+
+    def get(self, key):
+        value = self.redis.get(self.prefix + key)
+        if value is not None:
+            return pickle.loads(value)
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return [value if value is None else pickle.loads(value)
+                for value in self.redis.mget(
+                    [self.prefix + key for key in keys])]
+
+    def set(self, key, value, timeout=None):
+        timeout = timeout or self.default_timeout
+        if timeout:
+            self.redis.setex(self.prefix + key, int(timeout),
+                             pickle.dumps(value))
+        else:
+            self.redis.set(self.prefix + key, pickle.dumps(value))
+
+    def delete(self, key):
+        self.redis.delete(self.prefix + key)
+
+    def incr(self, key):
+        # stored pickled so that get() can read it back like any other
+        # value; WATCH/MULTI keeps concurrent increments from colliding
+        rkey = self.prefix + key
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(rkey)
+                    current = pipe.get(rkey)
+                    value = (pickle.loads(current) if current else 0) + 1
+                    pipe.multi()
+                    pipe.set(rkey, pickle.dumps(value))
+                    pipe.execute()
+                    return value
+                except redis_watch_error():
+                    continue
+
+    def clear(self):
+        for rkey in self.redis.scan_iter(self.prefix + '*'):
+            self.redis.delete(rkey)
+
+
+class NullCacheImpl:
+    """Cache that never stores anything; used when caching is disabled.
+    """
+    shared = True
+
+    def get(self, key):
+        return None
+
+    def get_many(self, keys):
+        return [None for _ in keys]
+
+    def set(self, key, value, timeout=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def incr(self, key):
+        return 0
+
+    def clear(self):
+        pass
+
+
+def redis_watch_error():
+    import redis
+    return redis.WatchError
+
+
+def get_impl():
+    if get_impl.cached:
+        return get_impl.cached
+    cache_type = app.config.get('CACHE_TYPE', 'lru')
+    timeout = app.config.get('CACHE_TIMEOUT', 600)
+    if cache_type == 'redis':
+        redis_url = (app.config.get('CACHE_REDIS_URL')
+                     or app.config.get('REDIS_URL'))
+        prefix = app.config.get('CACHE_KEY_PREFIX', 'redwind:cache:')
+        app.logger.debug('started cache with RedisCacheImpl %s;%s',
+                         redis_url, prefix)
+        impl = RedisCacheImpl(redis_url, prefix, timeout)
+    elif cache_type == 'lru':
+        max_entries = app.config.get('CACHE_MAX_ENTRIES', 1000)
+        app.logger.debug('started cache with LruCacheImpl %d', max_entries)
+        impl = LruCacheImpl(max_entries, timeout)
+    else:
+        app.logger.debug('caching is disabled')
+        impl = NullCacheImpl()
+    get_impl.cached = impl
+    return impl
+
+get_impl.cached = None
+
+
+def get_generations(namespaces):
+    impl = get_impl()
+    if impl.shared:
+        return impl.get_many(['gen:' + ns for ns in namespaces])
+    now = time.time()
+    interval = app.config.get('CACHE_GENERATION_CHECK_INTERVAL', 5)
+    known = get_generations.known
+    stale = [ns for ns in namespaces
+             if ns not in known or now - known[ns][1] >= interval]
+    if stale:
+        load_generations(stale, now)
+    return [known[ns][0] for ns in namespaces]
+
+get_generations.known = {}
+
+
+def load_generations(namespaces, now=None):
+    now = now or time.time()
+    gens = dict(db.session.query(CacheGeneration.namespace,
+                                 CacheGeneration.generation)
+                .filter(CacheGeneration.namespace.in_(namespaces)))
+    for ns in namespaces:
+        get_generations.known[ns] = (gens.get(ns, 0), now)
+
+
+def bump_generations(namespaces):
+    """Increment the generations, in the database if the cache isn't
+    shared. Commits the session, so call it after committing the
+    changes that made the entries stale.
+    """
+    impl = get_impl()
+    if impl.shared:
+        for ns in namespaces:
+            impl.incr('gen:' + ns)
+        return
+    table = CacheGeneration.__table__
+    for ns in namespaces:
+        row = table.c.namespace == ns
+        # incremented in SQL so concurrent bumps aren't lost
+        if not db.session.execute(table.update().where(row).values(
+                generation=table.c.generation + 1)).rowcount:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(table.insert().values(
+                        namespace=ns, generation=1))
+            except sqlalchemy.exc.IntegrityError:
+                # another process inserted it first
+                db.session.execute(table.update().where(row).values(
+                    generation=table.c.generation + 1))
+    # this process sees its own invalidations straight away
+    load_generations(namespaces)
+    db.session.commit()
+
+
+def _namespaced_key(key, namespaces):
+    if not namespaces:
+        return key
+    gens = get_generations(namespaces)
+    return '{}|{}'.format(key, ','.join(str(gen or 0) for gen in gens))
+
+
+def get(key, namespaces=()):
+    return get_impl().get(_namespaced_key(key, namespaces))
+
+
+def get_many(keys, namespaces=()):
+    suffix = _namespaced_key('', namespaces) if namespaces else ''
+    return get_impl().get_many([key + suffix for key in keys])
+
+
+def set(key, value, namespaces=(), timeout=None):
+    get_impl().set(_namespaced_key(key, namespaces), value, timeout)
+
+
+def set_many(mapping, namespaces=(), timeout=None):
+    suffix = _namespaced_key('', namespaces) if namespaces else ''
+    for key, value in mapping.items():
+        get_impl().set(key + suffix, value, timeout)
+
+
+def delete(key, namespaces=()):
+    get_impl().delete(_namespaced_key(key, namespaces))
+
+
+def invalidate(*namespaces):
+    """Evict every entry stored under any of these namespaces
+    """
+    app.logger.debug('invalidating cache namespaces %s', namespaces)
+    if namespaces:
+        bump_generations(namespaces)
+
+
+def clear():
+    get_impl().clear()
+    get_generations.known.clear()
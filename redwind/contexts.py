@@ -1,53 +1,205 @@
 from . import app
+from . import cache
 from . import db
 from . import hooks
+from . import queue
 from . import util
 
-from .models import Context
-import bs4
-import mf2py
+from .models import Context, Post, get_settings, posts_to_reply_contexts,\
+    posts_to_repost_contexts, posts_to_like_contexts,\
+    posts_to_bookmark_contexts
+import collections
+import concurrent.futures
+import datetime
 import mf2util
-from flask import request, render_template, jsonify
+from flask import request, render_template, jsonify, g
 
 
-def fetch_contexts(post):
-    do_fetch_context(post, 'reply_contexts', post.in_reply_to)
-    do_fetch_context(post, 'repost_contexts', post.repost_of)
-    do_fetch_context(post, 'like_contexts', post.like_of)
-    do_fetch_context(post, 'bookmark_contexts', post.bookmark_of)
+CONTEXT_ATTRS = (
+    ('in_reply_to', 'reply_contexts'),
+    ('repost_of', 'repost_contexts'),
+    ('like_of', 'like_contexts'),
+    ('bookmark_of', 'bookmark_contexts'),
+)
 
+CONTEXT_FIELDS = ('permalink', 'author_name', 'author_url', 'author_image',
+                  'content', 'content_plain', 'published', 'title')
 
-def do_fetch_context(post, context_attr, urls):
-    app.logger.debug("fetching urls %s", urls)
-    old_contexts = getattr(post, context_attr)
-    new_contexts = [create_context(url) for url in urls]
 
-    for old in old_contexts:
-        if old not in new_contexts:
-            db.session.delete(old)
+def fetch_contexts(post, defer=None):
+    """Attach a Context to the post for each in-reply-to, repost-of,
+    like-of, and bookmark-of url. Contexts are shared by url: one that
+    was fetched less than CONTEXT_MAX_AGE seconds ago is reused, and the
+    rest are fetched concurrently. With defer (default: the
+    CONTEXT_FETCH_DEFERRED setting), missing contexts start out as
+    placeholders and are filled in by a queued job.
+    """
+    if defer is None:
+        defer = app.config.get('CONTEXT_FETCH_DEFERRED', False)
 
-    for new_context in new_contexts:
-        db.session.add(new_context)
+    urls = list(collections.OrderedDict.fromkeys(
+        url for url_attr, _ in CONTEXT_ATTRS
+        for url in getattr(post, url_attr) or []))
+    contexts = lookup_contexts(urls)
+    stale = [url for url in urls if is_stale(contexts.get(url))]
 
-    setattr(post, context_attr, new_contexts)
+    if defer:
+        for url in stale:
+            if url not in contexts:
+                contexts[url] = Context(url=url, permalink=url)
+    else:
+        for url, fetched in fetch_many(stale).items():
+            contexts[url] = update_context(contexts.get(url), fetched)
+
+    old_contexts = set()
+    for url_attr, context_attr in CONTEXT_ATTRS:
+        old_contexts.update(getattr(post, context_attr))
+        new_contexts = [contexts[url]
+                        for url in getattr(post, url_attr) or []]
+        for context in new_contexts:
+            db.session.add(context)
+        setattr(post, context_attr, new_contexts)
+
+    db.session.flush()
+    delete_orphans(old_contexts - set(contexts.values()))
+    db.session.commit()
+
+    if defer and stale:
+        queue.enqueue(do_refresh_contexts, stale)
+
+
+def do_refresh_contexts(urls):
+    """Queued job: fetch contexts that were deferred by fetch_contexts
+    and fill in the placeholder rows.
+    """
+    contexts = lookup_contexts(urls)
+    refreshed = []
+    for url, fetched in fetch_many(urls).items():
+        context = update_context(contexts.get(url), fetched)
+        db.session.add(context)
+        refreshed.append(context)
+    db.session.flush()
+    mark_posts_updated(context.id for context in refreshed)
     db.session.commit()
+    cache.invalidate('all')
+
+
+def mark_posts_updated(context_ids):
+    """Bump Post.updated on every post that shows one of these contexts
+    """
+    ids = list(context_ids)
+    if not ids:
+        return
+    post_ids = set()
+    for table in (posts_to_reply_contexts, posts_to_repost_contexts,
+                  posts_to_like_contexts, posts_to_bookmark_contexts):
+        post_ids.update(row[0] for row in db.session.execute(
+            db.select([table.c.post_id])
+            .where(table.c.context_id.in_(ids))))
+    if post_ids:
+        Post.query.filter(Post.id.in_(post_ids)).update(
+            {Post.updated: datetime.datetime.utcnow()},
+            synchronize_session=False)
+
+
+def lookup_contexts(urls):
+    """Existing contexts for these urls, the most recently fetched one
+    for each url. Placeholders and failed fetches only come first when
+    there is nothing else.
+    """
+    if not urls:
+        return {}
+    contexts = {}
+    # Postgres puts NULLs first in descending order, SQLite last
+    for context in Context.query.filter(Context.url.in_(urls))\
+                                .order_by(Context.fetched.is_(None),
+                                          Context.fetched.desc(),
+                                          Context.id.desc()):
+        contexts.setdefault(context.url, context)
+    return contexts
+
+
+def is_stale(context):
+    if not context or not context.fetched:
+        return True
+    max_age = app.config.get('CONTEXT_MAX_AGE', 86400)
+    return context.fetched < datetime.datetime.utcnow() \
+        - datetime.timedelta(seconds=max_age)
+
+
+def fetch_many(urls):
+    """Run create_context for each url concurrently. The threads only
+    talk to the network; they return unsaved Contexts.
+    """
+    if not urls:
+        return {}
+    # hooks read the settings; share this request's snapshot so the
+    # threads don't need the database
+    settings = get_settings()
+
+    def fetch(url):
+        with app.app_context():
+            g.rw_settings = settings
+            return create_context(url)
+
+    max_workers = min(len(urls), app.config.get('CONTEXT_FETCH_WORKERS', 4))
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        return dict(zip(urls, pool.map(fetch, urls)))
+
+
+def update_context(context, fetched):
+    """Copy a freshly fetched context onto the existing row for its url,
+    if there is one, so that every post sharing it sees the update. A
+    context whose fetch failed doesn't replace an existing one.
+    """
+    if not context:
+        return fetched
+    if not fetched.fetched:
+        return context
+    for field in CONTEXT_FIELDS + ('syndication', 'fetched'):
+        setattr(context, field, getattr(fetched, field))
+    return context
+
+
+def delete_orphans(contexts):
+    """Delete contexts that no post refers to anymore
+    """
+    ids = [context.id for context in contexts if context.id]
+    if not ids:
+        return
+    referenced = set()
+    for table in (posts_to_reply_contexts, posts_to_repost_contexts,
+                  posts_to_like_contexts, posts_to_bookmark_contexts):
+        referenced.update(row[0] for row in db.session.execute(
+            db.select([table.c.context_id])
+            .where(table.c.context_id.in_(ids))))
+    for context in contexts:
+        if context.id and context.id not in referenced:
+            db.session.delete(context)
 
 
 def create_context(url):
-    for context in hooks.fire('create-context', url):
-        if context:
-            return context
+    """Fetch the context for a url, or make a default one from the url
+    if that fails. Only a successful fetch sets Context.fetched, so a
+    failed one is retried the next time the context is needed.
+    """
+    context = hooks.fire_first('create-context', url,
+                               timeout=app.config.get('CONTEXT_HOOK_TIMEOUT'))
+    if context:
+        context.fetched = context.fetched or datetime.datetime.utcnow()
+        return context
 
     context = None
     response = None
+    doc = None
+    fetched = None
     try:
         response = util.fetch_html(url)
         response.raise_for_status()
+        fetched = datetime.datetime.utcnow()
 
-        context = Context.query.filter_by(url=url).first()
-        app.logger.debug(
-            'checked for pre-existing context for this url: %s', context)
-        blob = mf2py.Parser(doc=response.text, url=url).to_dict()
+        doc = util.HtmlDocument.from_response(response, url)
+        blob = doc.to_mf2()
         if blob:
             app.logger.debug('parsed successfully by mf2py: %s', url)
             entry = mf2util.interpret(blob, url)
@@ -88,21 +240,23 @@ def create_context(url):
         app.logger.debug('Generating default context: %s', url)
         context = Context()
         context.url = context.permalink = url
-        if response:
-            html = response.text
-            soup = bs4.BeautifulSoup(html)
-            if soup.title:
-                app.logger.debug('Found title: %s', soup.title.string)
-                context.title = soup.title.string
+        if doc:
+            if doc.soup.title:
+                app.logger.debug('Found title: %s', doc.soup.title.string)
+                context.title = doc.soup.title.string
 
+    context.fetched = fetched
     return context
 
 
 @app.route('/services/fetch_context')
 def fetch_context_service():
+    urls = request.args.getlist('url[]')
+    contexts = lookup_contexts(urls)
+    fetched = fetch_many([url for url in urls if is_stale(contexts.get(url))])
     results = []
-    for url in request.args.getlist('url[]'):
-        ctx = create_context(url)
+    for url in urls:
+        ctx = fetched.get(url) or contexts[url]
         results.append({
             'title': ctx.title,
             'permalink': ctx.permalink,
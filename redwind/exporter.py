@@ -64,6 +64,8 @@ def export_post(p):
         'bookmark_contexts': [export_context(c) for c in p.bookmark_contexts], 
         'title': p.title, 
         'published': export_datetime(p.published), 
+        'updated': export_datetime(p.updated),
+        'mentions_updated': export_datetime(p.mentions_updated),
         'slug': p.slug, 
         'syndication': p.syndication, 
         'location': p.location, 
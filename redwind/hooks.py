@@ -1,14 +1,227 @@
+"""
+Plugins register actions for named hooks (e.g. 'post-saved'), which
+the app fires at the right moments. Actions registered with
+deferred=True don't run in the request: each firing of a hook enqueues
+one job that runs all of its deferred actions. Every action is timed,
+and the calls, failures and durations are kept in the hook_stat table
+for the /hooks admin page.
+"""
 from . import app
+from . import db
+from . import queue
+from .models import get_settings
+import collections
+import concurrent.futures
+import datetime
+import sqlalchemy
+import threading
+import time
 
 actions = {}
+deferred_actions = {}
 
 
-def register(hook, action):
+class HookStat(db.Model):
+    hook = db.Column(db.String(64), primary_key=True)
+    action = db.Column(db.String(256), primary_key=True)
+    calls = db.Column(db.Integer, default=0)
+    failures = db.Column(db.Integer, default=0)
+    total_time = db.Column(db.Float, default=0.0)
+    max_time = db.Column(db.Float, default=0.0)
+    last_run = db.Column(db.DateTime)
+    last_failure = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+    @property
+    def mean_time(self):
+        return self.total_time / self.calls if self.calls else 0.0
+
+
+ModelRef = collections.namedtuple('ModelRef', ['cls', 'id'])
+
+
+def register(hook, action, deferred=False):
+    """Call action(*args, **kwargs) whenever hook is fired. Deferred
+    actions run later from the queue, with any model instances among
+    the arguments reloaded by id; the other arguments must pickle.
+    """
     #app.logger.debug('registering hook %s -> %s', hook, action)
-    actions.setdefault(hook, []).append(action)
+    registry = deferred_actions if deferred else actions
+    registry.setdefault(hook, []).append(action)
 
 
 def fire(hook, *args, **kwargs):
+    """Run the hook's actions and return their results, after queueing
+    a single job for its deferred actions, if it has any.
+    """
     app.logger.debug('firing hook %s', hook)
-    return [action(*args, **kwargs)
+    if deferred_actions.get(hook):
+        queue.enqueue(run_deferred, hook, [freeze(arg) for arg in args],
+                      {key: freeze(value) for key, value in kwargs.items()})
+    return [run_action(hook, action, args, kwargs)
             for action in actions.get(hook, [])]
+
+
+def fire_first(hook, *args, timeout=None, **kwargs):
+    """Run the hook's actions in turn until one returns something other
+    than None, and return that. An action that raises, or that takes
+    longer than timeout seconds, is logged and skipped (it may still
+    finish in the background).
+    """
+    app.logger.debug('firing hook %s for the first result', hook)
+    for action in actions.get(hook, []):
+        try:
+            if timeout:
+                result = run_with_timeout(hook, action, args, kwargs,
+                                          timeout)
+            else:
+                result = run_action(hook, action, args, kwargs)
+        except Exception:
+            app.logger.exception('hook %s action %s failed', hook,
+                                 action_name(action))
+            continue
+        if result is not None:
+            return result
+
+
+def run_deferred(hook, args, kwargs):
+    """Queued job: run the deferred actions for one firing of a hook.
+    A failing action doesn't stop the others, and the job isn't
+    retried, so that the actions that worked don't run twice.
+    """
+    args = [thaw(arg) for arg in args]
+    kwargs = {key: thaw(value) for key, value in kwargs.items()}
+    if any(arg is None for arg in args):
+        app.logger.warn('skipping %s hooks, an argument was deleted', hook)
+        return
+    results = []
+    # actions may build external urls, as they did in the request
+    with app.test_request_context(
+            base_url=get_settings().site_url or 'http://localhost'):
+        for action in deferred_actions.get(hook, []):
+            try:
+                results.append(run_action(hook, action, args, kwargs))
+            except Exception:
+                app.logger.exception('hook %s action %s failed', hook,
+                                     action_name(action))
+                results.append(None)
+    flush_stats(force=True)
+    return results
+
+
+def run_action(hook, action, args, kwargs):
+    start = time.time()
+    try:
+        result = action(*args, **kwargs)
+    except Exception as e:
+        record(hook, action, time.time() - start, repr(e))
+        raise
+    record(hook, action, time.time() - start)
+    return result
+
+
+def run_with_timeout(hook, action, args, kwargs, timeout):
+    def run():
+        with app.app_context():
+            return action(*args, **kwargs)
+
+    start = time.time()
+    # a thread of its own, so that actions which time out and keep
+    # running can't hold up the ones that come after them
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+    future = executor.submit(run)
+    executor.shutdown(wait=False)
+    try:
+        result = future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        record(hook, action, time.time() - start,
+               'timed out after {}s'.format(timeout))
+        raise
+    except Exception as e:
+        record(hook, action, time.time() - start, repr(e))
+        raise
+    record(hook, action, time.time() - start)
+    return result
+
+
+def action_name(action):
+    return '{}.{}'.format(action.__module__, action.__name__)
+
+
+def freeze(arg):
+    if isinstance(arg, db.Model):
+        return ModelRef(type(arg), arg.id)
+    return arg
+
+
+def thaw(arg):
+    if isinstance(arg, ModelRef):
+        return arg.cls.query.get(arg.id)
+    return arg
+
+
+def record(hook, action, elapsed, error=None):
+    """Add one call to the stats kept in memory until flush_stats"""
+    now = datetime.datetime.utcnow()
+    with record.lock:
+        stat = record.pending.setdefault((hook, action_name(action)), {
+            'calls': 0, 'failures': 0, 'total_time': 0.0, 'max_time': 0.0,
+            'last_run': None, 'last_failure': None, 'last_error': None,
+        })
+        stat['calls'] += 1
+        stat['total_time'] += elapsed
+        stat['max_time'] = max(stat['max_time'], elapsed)
+        stat['last_run'] = now
+        if error:
+            stat['failures'] += 1
+            stat['last_failure'] = now
+            stat['last_error'] = error
+
+record.pending = {}
+record.lock = threading.Lock()
+
+
+def flush_stats(force=False):
+    """Add the stats recorded in this process to hook_stat, at most
+    every HOOK_STATS_INTERVAL seconds unless forced. Uses its own
+    transaction, so the session's pending work is not committed.
+    """
+    interval = app.config.get('HOOK_STATS_INTERVAL', 60)
+    if not record.pending or (
+            not force and time.time() - flush_stats.last < interval):
+        return
+    with record.lock:
+        pending, record.pending = record.pending, {}
+    flush_stats.last = time.time()
+
+    table = HookStat.__table__
+    for (hook, action), stat in pending.items():
+        where = db.and_(table.c.hook == hook, table.c.action == action)
+        values = {
+            'calls': table.c.calls + stat['calls'],
+            'failures': table.c.failures + stat['failures'],
+            'total_time': table.c.total_time + stat['total_time'],
+            'max_time': db.case([(table.c.max_time < stat['max_time'],
+                                  stat['max_time'])],
+                                else_=table.c.max_time),
+            'last_run': stat['last_run'],
+        }
+        if stat['last_error']:
+            values['last_failure'] = stat['last_failure']
+            values['last_error'] = stat['last_error']
+        try:
+            with db.engine.begin() as conn:
+                if not conn.execute(table.update().where(where)
+                                    .values(values)).rowcount:
+                    conn.execute(table.insert().values(
+                        hook=hook, action=action, **stat))
+        except sqlalchemy.exc.SQLAlchemyError:
+            app.logger.exception('failed to save stats for %s', action)
+
+flush_stats.last = 0
+
+
+@app.after_request
+def flush_request_stats(response):
+    flush_stats()
+    return response
@@ -0,0 +1,229 @@
+"""
+Resized copies ("derivatives") of the files uploaded with posts, kept
+next to the originals: _data/<post path>/derivatives/<size>/<filename>.
+Uploaded photos get every size made from the queue, recorded with their
+dimensions in Post.photos so that templates can write srcset, width and
+height; anything else is made on the first request for it. A derivative
+older than its original is made again. Resizing needs Pillow; without
+it the originals are served.
+"""
+from . import app
+from . import db
+from . import util
+from .models import Post
+import concurrent.futures
+import datetime
+import os
+
+# longest side, in pixels, of each named size
+SIZES = {
+    'small': 300,
+    'medium': 800,
+    'large': 1600,
+}
+RESIZABLE = ('.jpg', '.jpeg', '.png', '.webp')
+JPEG_QUALITY = 85
+
+EXIF_ORIENTATION = 0x0112
+# the Image.transpose method that turns each EXIF orientation upright
+ORIENTATION_TRANSPOSE = {
+    2: 'FLIP_LEFT_RIGHT',
+    3: 'ROTATE_180',
+    4: 'FLIP_TOP_BOTTOM',
+    5: 'TRANSPOSE',
+    6: 'ROTATE_270',
+    7: 'TRANSVERSE',
+    8: 'ROTATE_90',
+}
+
+
+def get_sizes():
+    return app.config.get('IMAGE_SIZES') or SIZES
+
+
+def derivative_path(source, size, fmt=None):
+    """Where the derivative of source (a path in _data/<path>/files)
+    at this size, optionally converted to fmt (e.g. 'webp'), is kept
+    """
+    files_dir, filename = os.path.split(source)
+    if fmt:
+        filename += '.' + fmt
+    return os.path.join(os.path.dirname(files_dir), 'derivatives', size,
+                        filename)
+
+
+def is_cached_current(source, dest):
+    try:
+        return os.stat(dest).st_mtime >= os.stat(source).st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def get_derivative(source, size, fmt=None):
+    """The path to serve for source at the named size (and format): a
+    derivative, made now if it's missing or stale, or the original if
+    the size is unknown, the file can't be resized, or making it fails.
+    """
+    side = get_sizes().get(size)
+    if not side or not source.lower().endswith(RESIZABLE) \
+       or fmt not in (None, 'webp'):
+        return source
+    dest = derivative_path(source, size, fmt)
+    if is_cached_current(source, dest):
+        return dest
+    try:
+        pool = get_pool()
+        if pool:
+            pool.submit(resize, source, dest, side, fmt).result(
+                app.config.get('IMAGE_RESIZE_TIMEOUT', 30))
+        else:
+            resize(source, dest, side, fmt)
+    except ImportError:
+        app.logger.warn('Pillow is not installed, cannot resize images')
+        return source
+    except Exception:
+        app.logger.exception('failed to resize %s to %s', source, size)
+        return source
+    return dest
+
+
+def resize(source, dest, side, fmt=None):
+    """Write source scaled to fit in side x side pixels (never scaled
+    up) to dest, in its own format or fmt. The EXIF orientation is
+    applied and the metadata left behind. Runs in the pool.
+    """
+    from PIL import Image
+
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    # written aside and renamed, so a half-written image is never served
+    tmp = '{}.{}.tmp'.format(dest, os.getpid())
+    try:
+        with Image.open(source) as im:
+            fmt = fmt.upper() if fmt else im.format
+            method = ORIENTATION_TRANSPOSE.get(exif_orientation(im))
+            if method:
+                im = im.transpose(getattr(Image, method))
+            im.thumbnail((side, side), Image.LANCZOS)
+            if fmt == 'JPEG':
+                if im.mode not in ('RGB', 'L'):
+                    im = im.convert('RGB')
+                im.save(tmp, fmt, quality=JPEG_QUALITY, optimize=True)
+            elif fmt == 'WEBP':
+                im.save(tmp, fmt, quality=JPEG_QUALITY)
+            else:
+                im.save(tmp, fmt)
+        os.replace(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def get_pool():
+    """The process pool for resizing, or None to resize in the request
+    (IMAGE_RESIZE_PROCESSES <= 1)
+    """
+    if get_pool.cached is None:
+        processes = app.config.get('IMAGE_RESIZE_PROCESSES', 2)
+        get_pool.cached = processes > 1 and \
+            concurrent.futures.ProcessPoolExecutor(processes)
+    return get_pool.cached or None
+
+get_pool.cached = None
+
+
+def image_size(path):
+    """(width, height) of an image as displayed, i.e. after its EXIF
+    orientation is applied. Only reads the header.
+    """
+    from PIL import Image
+
+    with Image.open(path) as im:
+        width, height = im.size
+        # orientations 5-8 are rotated by 90 degrees
+        if exif_orientation(im) in (5, 6, 7, 8):
+            width, height = height, width
+    return width, height
+
+
+def exif_orientation(im):
+    """The EXIF orientation (1-8) of an open image, 1 if it has none.
+    (ImageOps.exif_transpose and Image.getexif need Pillow 6, which
+    doesn't run on Python 3.4.)
+    """
+    try:
+        exif = im._getexif() or {}
+    except AttributeError:
+        # only JPEG and WebP images have EXIF data
+        return 1
+    except Exception:
+        app.logger.warn('could not read the EXIF data of %s', im.filename)
+        return 1
+    return exif.get(EXIF_ORIENTATION, 1)
+
+
+def make_variants(source, webp=None):
+    """Make every size of source now, smallest first, stopping at the
+    first size the original fits into. Returns the original's
+    (width, height) and a list of {'size', 'width', 'height'} for the
+    variants, with 'webp': True if a WebP copy was made as well.
+    """
+    if webp is None:
+        webp = app.config.get('PHOTO_WEBP', False)
+    width, height = image_size(source)
+    variants = []
+    for size, side in sorted(get_sizes().items(), key=lambda item: item[1]):
+        dest = get_derivative(source, size)
+        if dest == source:
+            break
+        variant = dict(zip(('width', 'height'), image_size(dest)),
+                       size=size)
+        if webp and get_derivative(source, size, 'webp') != source:
+            variant['webp'] = True
+        variants.append(variant)
+        if max(width, height) <= side:
+            break
+    return (width, height), variants
+
+
+def do_make_photo_variants(post_id, filenames=()):
+    """Queued job: make the sizes of a post's photos and record them in
+    post.photos, and make the sizes of the other uploaded filenames so
+    that the first visitor doesn't wait for them.
+    """
+    from .views import invalidate_post_listings
+
+    try:
+        import PIL
+    except ImportError:
+        app.logger.warn('Pillow is not installed, cannot resize images')
+        return
+    post = Post.load_by_id(post_id)
+    if not post:
+        return
+    files_dir = os.path.join(util.image_root_path(), '_data', post.path,
+                             'files')
+    photos = []
+    for photo in post.photos or []:
+        source = os.path.join(files_dir, photo.get('filename'))
+        if os.path.exists(source) and source.lower().endswith(RESIZABLE):
+            try:
+                (width, height), variants = make_variants(source)
+                photo = dict(photo, width=width, height=height,
+                             variants=variants)
+            except Exception:
+                app.logger.exception('failed to make sizes of %s', source)
+        photos.append(photo)
+    for filename in filenames:
+        source = os.path.join(files_dir, filename)
+        if os.path.exists(source) and source.lower().endswith(RESIZABLE):
+            try:
+                make_variants(source)
+            except Exception:
+                app.logger.exception('failed to make sizes of %s', source)
+
+    # JsonType columns only notice a new value
+    post.photos = photos
+    # the permalink's validators change with its srcset
+    post.updated = datetime.datetime.utcnow()
+    db.session.commit()
+    invalidate_post_listings(post)
@@ -1,5 +1,9 @@
 from . import db
-from .models import Setting, Post, Contact, Venue, Tag, Nick, Mention, Context
+from . import search as search_index
+from . import util
+from . import tags as tag_stats
+from .models import Setting, Post, Contact, Venue, Tag, Nick, Mention, Context,\
+    invalidate_settings
 import datetime
 
 
@@ -15,6 +19,10 @@ def import_all(blob):
     db.session.add_all([import_contact(c) for c in blob['contacts']])
     db.session.add_all([import_post(p, tags, venues) for p in blob['posts']])
     db.session.commit()
+    invalidate_settings()
+    util.invalidate_contacts()
+    tag_stats.update_tag_stats()
+    search_index.reindex_all()
 
     
 def import_datetime(dt):
@@ -79,12 +87,16 @@ def import_post(blob, tags, venues):
     p.bookmark_contexts = [import_context(c) for c in blob['bookmark_contexts']]
     p.title = blob['title']
     p.published = import_datetime(blob['published'])
+    # older exports have neither
+    p.updated = import_datetime(blob.get('updated')) or p.published
+    p.mentions_updated = import_datetime(blob.get('mentions_updated'))
     p.slug = blob['slug']
     p.syndication = blob['syndication']
     p.location = blob['location']
     p.photos = blob['photos']
     p.venue = lookup_venue(blob['venue'])
     p.mentions = [import_mention(m) for m in blob['mentions']]
+    p.update_mention_counts()
     p.content = blob['content']
     p.content_html = blob['content_html']
     return p
@@ -1,16 +1,33 @@
 """
-Generate static map images
+Generate static map images. Pages get a stable /map/<key>.png url
+straight away; maps that aren't cached yet are fetched from the queue,
+one job per request, and a placeholder is served until they exist.
+Each map's query is kept next to it (<key>.query), so that a request
+for a map that failed or was evicted can queue it again. The cache
+directory is kept under MAP_CACHE_MAX_BYTES by removing the least
+recently served maps.
 """
-from flask import url_for
+from flask import url_for, g, has_request_context
 from redwind import app
+from redwind import cache
+from redwind import queue
 from redwind import util
 import hashlib
 import os
+import time
 import urllib.parse
 
 # get_map_image(600, 400, 33, -88, 13, [])
 # get_map_image(600, 400, 33, -88, 13, [Marker(33, -88)])
 
+MAP_SERVICE_URL = 'http://static-maps.kylewm.com/img.php'
+PLACEHOLDER = os.path.join('img', 'map-placeholder.png')
+# how long a queued map is trusted to be on its way
+QUEUED_TIMEOUT = 300
+# a served map's mtime is bumped at most this often (seconds), so that
+# eviction can tell which maps are still in use
+TOUCH_INTERVAL = 86400
+
 
 class Marker:
     def __init__(self, lat, lng, icon='dot-small-blue'):
@@ -35,13 +52,158 @@ def get_map_image(width, height, maxzoom, markers):
 
     m = hashlib.md5()
     m.update(bytes(query, 'utf-8'))
-    hash = m.hexdigest()
+    key = m.hexdigest()
+
+    if not os.path.exists(map_path(key)):
+        if has_request_context():
+            # fetched together once the page is done
+            pending = g.get('rw_pending_maps')
+            if pending is None:
+                g.rw_pending_maps = pending = {}
+            pending[key] = query
+        else:
+            queue_maps({key: query})
+
+    return url_for('static_map', key=key)
+
+
+def cache_dir():
+    return app.config.get('MAP_CACHE_DIR') \
+        or os.path.join(app.static_folder, 'map')
+
+
+def map_path(key):
+    return os.path.join(cache_dir(), key + '.png')
+
+
+def query_path(key):
+    return os.path.join(cache_dir(), key + '.query')
+
+
+def save_queries(pending):
+    """Keep the query of each {key: query} map that has none saved"""
+    for key, query in pending.items():
+        path = query_path(key)
+        if os.path.exists(path):
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(query)
+        os.replace(tmp_path, path)
+
+
+def saved_query(key):
+    """The query a map was requested with, or None if it isn't known"""
+    try:
+        with open(query_path(key)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def cached_map(key):
+    """The path to a map if it has been fetched, or None"""
+    path = map_path(key)
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+    if time.time() - mtime > TOUCH_INTERVAL:
+        os.utime(path)
+    return path
+
+
+def queue_maps(pending):
+    """Enqueue one job to fetch these {key: query} maps, leaving out
+    any that were queued recently
+    """
+    save_queries(pending)
+    keys = sorted(pending)
+    queued = cache.get_many(['map-queued:' + key for key in keys])
+    todo = {key: pending[key] for key, was_queued in zip(keys, queued)
+            if not was_queued}
+    if todo:
+        app.logger.debug('queueing %d maps', len(todo))
+        queue.enqueue(generate_maps, todo)
+        cache.set_many({'map-queued:' + key: True for key in todo},
+                       timeout=QUEUED_TIMEOUT)
+
+
+@app.after_request
+def queue_pending_maps(response):
+    pending = g.get('rw_pending_maps')
+    if pending:
+        g.rw_pending_maps = None
+        queue_maps(pending)
+    return response
+
+
+def fetch_map(query, path):
+    """Download a map from the static map service. MAP_FETCHER can
+    name another function that takes the same arguments, e.g. one that
+    draws maps locally.
+    """
+    util.download_resource(
+        app.config.get('MAP_SERVICE_URL', MAP_SERVICE_URL) + '?' + query,
+        path)
+
 
-    relpath = os.path.join('map', hash + '.png')
-    abspath = os.path.join(util.image_root_path(), app.static_folder, relpath)
+def generate_maps(pending):
+    """Queued job: fetch each of these {key: query} maps that isn't
+    cached yet, then evict old maps if the cache has grown too big
+    """
+    fetcher = app.config.get('MAP_FETCHER') or fetch_map
+    for key, query in pending.items():
+        path = map_path(key)
+        if os.path.exists(path):
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written aside and renamed, so a half-written map is never served
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            fetcher(query, tmp_path)
+            os.replace(tmp_path, path)
+        except Exception:
+            app.logger.exception('failed to fetch map %s', query)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        cache.delete('map-queued:' + key)
+    evict_maps()
 
-    if not os.path.exists(abspath):
-        map_url = 'http://static-maps.kylewm.com/img.php?' + query
-        util.download_resource(map_url, abspath)
 
-    return url_for('static', filename=relpath)
+def evict_maps(max_bytes=None):
+    """Remove the least recently served maps until the cache is under
+    MAP_CACHE_MAX_BYTES, leaving some room to spare. Returns the number
+    of maps removed.
+    """
+    if max_bytes is None:
+        max_bytes = app.config.get('MAP_CACHE_MAX_BYTES', 50 * 1024 * 1024)
+    directory = cache_dir()
+    try:
+        names = [name for name in os.listdir(directory)
+                 if name.endswith('.png')]
+    except FileNotFoundError:
+        return 0
+    stats = []
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            stats.append((os.stat(path), path))
+        except FileNotFoundError:
+            pass
+    total = sum(stat.st_size for stat, _ in stats)
+    if total <= max_bytes:
+        return 0
+    removed = 0
+    for stat, path in sorted(stats, key=lambda s: s[0].st_mtime):
+        if total <= max_bytes * 0.9:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= stat.st_size
+        removed += 1
+    app.logger.info('evicted %d maps from the cache', removed)
+    return removed
@@ -5,9 +5,16 @@ from . import maps
 
 from flask import g, session
 
+import collections
+import datetime
 import os
 import os.path
 import json
+import re
+import sqlalchemy
+import sqlalchemy.orm
+import threading
+import time
 import urllib
 
 
@@ -15,6 +22,7 @@ TWEET_INTENT_URL = 'https://twitter.com/intent/tweet?in_reply_to={}'
 RETWEET_INTENT_URL = 'https://twitter.com/intent/retweet?tweet_id={}'
 FAVORITE_INTENT_URL = 'https://twitter.com/intent/favorite?tweet_id={}'
 OPEN_STREET_MAP_URL = 'http://www.openstreetmap.org/?mlat={0}&mlon={1}#map=17/{0}/{1}'
+MENTION_REFTYPES = ('reply', 'like', 'repost', 'rsvp', 'reference')
 
 
 class JsonType(db.TypeDecorator):
@@ -41,24 +49,95 @@ class Setting(db.Model):
     value = db.Column(db.Text)
 
 
+class SettingsVersion(db.Model):
+    """Single-row counter that is bumped every time a Setting changes,
+    so that each worker can tell when its snapshot is stale.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, default=0)
+
+
 class Settings:
-    def __init__(self):
-        for s in Setting.query.all():
-            setattr(self, s.key, s.value)
+    """Immutable snapshot of every Setting, shared by all of the
+    requests handled by a worker process.
+    """
+    def __init__(self, version, values):
+        self.__dict__.update(values)
+        self.__dict__['_version'] = version
+
+    def __setattr__(self, key, value):
+        raise AttributeError(
+            'Settings are read-only; update the Setting and call '
+            'invalidate_settings() instead')
+
+
+def get_settings_version():
+    return db.session.query(SettingsVersion.version)\
+                     .filter_by(id=1).scalar() or 0
+
+
+def load_settings():
+    """Return the process-wide settings snapshot, reloading it if
+    another worker has changed the settings. The version row is only
+    checked every SETTINGS_CHECK_INTERVAL seconds.
+    """
+    now = time.time()
+    snapshot = load_settings.snapshot
+    interval = app.config.get('SETTINGS_CHECK_INTERVAL', 5)
+    if snapshot and now - load_settings.checked < interval:
+        return snapshot
+
+    with load_settings.lock:
+        snapshot = load_settings.snapshot
+        version = get_settings_version()
+        if not snapshot or snapshot._version != version:
+            app.logger.debug('loading settings version %d', version)
+            snapshot = Settings(version, {
+                s.key: s.value for s in Setting.query.all()})
+            load_settings.snapshot = snapshot
+        load_settings.checked = now
+    return snapshot
+
+load_settings.snapshot = None
+load_settings.checked = 0
+load_settings.lock = threading.Lock()
 
 
 def get_settings():
     settings = g.get('rw_settings', None)
     if settings is None:
-        g.rw_settings = settings = Settings()
+        g.rw_settings = settings = load_settings()
     return settings
 
 
+def invalidate_settings():
+    """Call after committing changes to any Setting. Bumps the shared
+    version so every worker reloads its snapshot.
+    """
+    table = SettingsVersion.__table__
+    # incremented in SQL so concurrent bumps aren't lost
+    bump = table.update().where(table.c.id == 1).values(
+        version=sqlalchemy.func.coalesce(table.c.version, 0) + 1)
+    if not db.session.execute(bump).rowcount:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert().values(id=1, version=1))
+        except sqlalchemy.exc.IntegrityError:
+            # another worker inserted it first
+            db.session.execute(bump)
+    db.session.commit()
+    load_settings.snapshot = None
+    if 'rw_settings' in g:
+        del g.rw_settings
+
+
 posts_to_mentions = db.Table(
     'posts_to_mentions', db.Model.metadata,
     db.Column('post_id', db.Integer, db.ForeignKey('post.id'), index=True),
     db.Column('mention_id', db.Integer, db.ForeignKey('mention.id'),
-              index=True))
+              index=True),
+    # a post's mentions without visiting the table (Post.mentions_page)
+    db.Index('ix_posts_to_mentions_post_mention', 'post_id', 'mention_id'))
 
 posts_to_reply_contexts = db.Table(
     'posts_to_reply_contexts', db.Model.metadata,
@@ -144,6 +223,14 @@ class Venue(db.Model):
 
 
 class Post(db.Model):
+    __table_args__ = (
+        # backs the stream queries in views.collect_posts
+        db.Index('ix_post_listing', 'deleted', 'draft', 'hidden',
+                 'published'),
+        db.Index('ix_post_path', 'path', unique=True),
+        db.Index('ix_post_historic_path', 'historic_path', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     path = db.Column(db.String(256))
     historic_path = db.Column(db.String(256))
@@ -171,6 +258,10 @@ class Post(db.Model):
 
     title = db.Column(db.String(256))
     published = db.Column(db.DateTime, index=True)
+    # when the post itself (content, contexts, syndication, ...) and
+    # when its mentions last changed, for feeds and cache validators
+    updated = db.Column(db.DateTime, index=True)
+    mentions_updated = db.Column(db.DateTime, index=True)
     slug = db.Column(db.String(256))
 
     syndication = db.Column(JsonType)
@@ -182,6 +273,14 @@ class Post(db.Model):
 
     mentions = db.relationship('Mention', secondary=posts_to_mentions,
                                order_by='Mention.published')
+    # {reftype: count} of the deduplicated mentions; see
+    # update_mention_counts
+    mention_counts = db.Column(JsonType)
+    # the latest few mentions of each type, set on listings by
+    # views.load_mention_previews when MENTION_PREVIEWS is configured
+    mention_previews = None
+    # the matching part of the content, set on search results
+    search_snippet = None
 
     content = db.Column(db.Text)
     content_html = db.Column(db.Text)
@@ -198,6 +297,53 @@ class Post(db.Model):
     def load_by_historic_path(cls, path):
         return cls.query.filter_by(historic_path=path).first()
 
+    @classmethod
+    def allocate_path(cls, base_path):
+        """The first of base_path, base_path-1, base_path-2, ... that
+        no post has, found with one query. Another save can still take
+        it before this one commits; use claim_path to retry then.
+        """
+        suffix = re.compile(re.escape(base_path) + r'-(\d+)$')
+        taken = set()
+        for path, in db.session.query(cls.path).filter(db.or_(
+                cls.path == base_path, cls.path.like(base_path + '-%'))):
+            if path == base_path:
+                taken.add(0)
+            else:
+                m = suffix.match(path)
+                if m:
+                    taken.add(int(m.group(1)))
+        if 0 not in taken:
+            return base_path
+        idx = 1
+        while idx in taken:
+            idx += 1
+        return '{}-{}'.format(base_path, idx)
+
+    def claim_path(self, base_path):
+        """Give this post the path allocate_path finds, writing it
+        straight away. If another save takes the same path in the
+        meantime, ix_post_path refuses ours and the next one is tried.
+        """
+        self.path = None
+        db.session.add(self)
+        db.session.flush()
+        for attempt in range(3):
+            path = self.allocate_path(base_path)
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(
+                        self.__table__.update()
+                        .where(self.__table__.c.id == self.id)
+                        .values(path=path))
+                break
+            except sqlalchemy.exc.IntegrityError:
+                app.logger.debug('path taken concurrently: %s', path)
+                if attempt == 2:
+                    raise
+        sqlalchemy.orm.attributes.set_committed_value(self, 'path', path)
+        return path
+
     def __init__(self, post_type):
         self.post_type = post_type
         self.draft = False
@@ -211,12 +357,15 @@ class Post(db.Model):
         self.bookmark_of = []
         self.title = None
         self.published = None
+        self.updated = None
+        self.mentions_updated = None
         self.slug = None
         self.location = None
         self.syndication = []
         self.tags = []
         self.audience = []  # public
         self.mention_urls = []
+        self.mention_counts = {}
         self.photos = None
         self.content = None
         self.content_html = None
@@ -240,40 +389,121 @@ class Post(db.Model):
     def photo_thumbnail(self, photo):
         return self.photo_url(photo) + '?size=medium'
 
+    def photo_variant(self, photo, size='medium'):
+        """The recorded size (see images.do_make_photo_variants) that
+        ?size=size serves, or None if they haven't been made yet
+        """
+        variants = photo.get('variants')
+        if variants:
+            for variant in variants:
+                if variant['size'] == size:
+                    return variant
+            # the original fit into a smaller size already
+            return variants[-1]
+
+    def photo_srcset(self, photo, fmt=None):
+        """A srcset listing the recorded sizes of a photo, in fmt
+        (e.g. 'webp') if given, or None if they haven't been made
+        """
+        variants = photo.get('variants')
+        if not variants or (fmt and not all(v.get(fmt) for v in variants)):
+            return None
+        url = self.photo_url(photo)
+        suffix = '&format=' + fmt if fmt else ''
+        return ', '.join('{}?size={}{} {}w'.format(
+            url, variant['size'], suffix, variant['width'])
+            for variant in variants)
+
     @property
     def permalink(self):
         site_url = get_settings().site_url or 'http://localhost'
         return '/'.join((site_url, self.path))
 
-    def _dedupe(self, mentions):
-        all_children = set()
-        mentions = list(mentions)
-        for m in mentions:
-            if m.syndication:
-                m._children = [n for n in mentions
-                               if n.permalink in m.syndication]
-                all_children.update(m._children)
-        return [m for m in mentions if m not in all_children]
+    def group_mentions(self):
+        """Sort mentions into lists by reftype, in one pass. A mention
+        whose permalink is among the syndication urls of another
+        mention of the same type (e.g. a tweet backfed by Bridgy and
+        the original reply) is listed as that mention's _children
+        instead. The groups are kept until the mentions change.
+        """
+        mentions = self.mentions
+        key = tuple((id(m), m.reftype) for m in mentions)
+        cached = getattr(self, '_mention_groups', None)
+        if cached and cached[0] == key:
+            return cached[1]
+
+        groups = group_mentions(mentions)
+        self._mention_groups = (key, groups)
+        return groups
+
+    def update_mention_counts(self):
+        """Store the number of each kind of response in mention_counts,
+        for listings to show without loading the mentions. Call after
+        changing the mentions.
+        """
+        self._mention_groups = None
+        groups = self.group_mentions()
+        self.mention_counts = {reftype: len(groups[reftype])
+                               for reftype in MENTION_REFTYPES
+                               if groups.get(reftype)}
+
+    @property
+    def response_counts(self):
+        if self.mention_counts is None:
+            self.update_mention_counts()
+        return self.mention_counts
+
+    def mentions_page(self, after=None, limit=None, reftypes=None,
+                      exclude=None):
+        """Load this post's mentions in the order they were published,
+        starting after the mention whose id is `after`, without loading
+        the whole mentions collection. Returns (mentions, cursor), where
+        cursor is the `after` for the next page, or None if this is the
+        last one.
+        """
+        query = Mention.query.join(
+            posts_to_mentions, posts_to_mentions.c.mention_id == Mention.id)\
+            .filter(posts_to_mentions.c.post_id == self.id)
+        if reftypes:
+            query = query.filter(Mention.reftype.in_(reftypes))
+        if exclude:
+            query = query.filter(~Mention.reftype.in_(exclude))
+        if after:
+            published = db.session.query(Mention.published)\
+                                  .filter(Mention.id == after).scalar()
+            if published:
+                query = query.filter(db.or_(
+                    Mention.published > published,
+                    db.and_(Mention.published == published,
+                            Mention.id > after)))
+
+        query = query.order_by(Mention.published, Mention.id)
+        if not limit:
+            return query.all(), None
+        mentions = query.limit(limit + 1).all()
+        if len(mentions) > limit:
+            return mentions[:limit], mentions[limit - 1].id
+        return mentions, None
 
     @property
     def likes(self):
-        return self._dedupe(m for m in self.mentions if m.reftype == 'like')
+        return self.group_mentions().get('like', [])
 
     @property
     def reposts(self):
-        return self._dedupe(m for m in self.mentions if m.reftype == 'repost')
+        return self.group_mentions().get('repost', [])
 
     @property
     def replies(self):
-        return self._dedupe(m for m in self.mentions if m.reftype == 'reply')
+        return self.group_mentions().get('reply', [])
 
     @property
     def rsvps(self):
-        return self._dedupe(m for m in self.mentions if m.reftype == 'rsvp')
+        return self.group_mentions().get('rsvp', [])
 
     @property
     def references(self):
-        return self._dedupe(m for m in self.mentions if m.reftype == 'reference')
+        return self.group_mentions().get('reference', [])
 
     @property
     def tweet_id(self):
@@ -392,6 +622,15 @@ class Post(db.Model):
         new_synd = list(self.syndication)
         new_synd.append(url)
         self.syndication = new_synd
+        self.updated = datetime.datetime.utcnow()
+
+    @property
+    def last_modified(self):
+        """The latest of when this post was published, edited or
+        mentioned
+        """
+        return max(filter(None, (self.published, self.updated,
+                                 self.mentions_updated)), default=None)
 
     def __repr__(self):
         if self.title:
@@ -400,9 +639,35 @@ class Post(db.Model):
             return 'post:{}'.format(self.path)
 
 
+def group_mentions(mentions):
+    """Sort mentions into lists by reftype, folding each backfed copy
+    into the _children of the mention it was syndicated from (see
+    Post.group_mentions). Works on any list of mentions, e.g. a page
+    from Post.mentions_page.
+    """
+    by_permalink = collections.defaultdict(list)
+    for m in mentions:
+        if m.permalink:
+            by_permalink[m.reftype, m.permalink].append(m)
+
+    all_children = set()
+    for m in mentions:
+        if m.syndication:
+            children = {id(n): n for url in m.syndication
+                        for n in by_permalink.get((m.reftype, url), ())}
+            m._children = [n for n in mentions if id(n) in children]
+            all_children.update(children)
+
+    groups = collections.defaultdict(list)
+    for m in mentions:
+        if id(m) not in all_children:
+            groups[m.reftype].append(m)
+    return groups
+
+
 class Context(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    url = db.Column(db.String(512))
+    url = db.Column(db.String(512), index=True)
     permalink = db.Column(db.String(512))
     author_name = db.Column(db.String(128))
     author_url = db.Column(db.String(512))
@@ -412,6 +677,8 @@ class Context(db.Model):
     published = db.Column(db.DateTime)
     title = db.Column(db.String(512))
     syndication = db.Column(JsonType)
+    # when the context was last fetched; None for placeholders
+    fetched = db.Column(db.DateTime)
 
     def __init__(self, **kwargs):
         self.url = kwargs.get('url')
@@ -424,6 +691,7 @@ class Context(db.Model):
         self.published = kwargs.get('published')
         self.title = kwargs.get('title')
         self.syndication = kwargs.get('syndication', [])
+        self.fetched = kwargs.get('fetched')
 
     @property
     def title_or_url(self):
@@ -453,7 +721,7 @@ class Mention(db.Model):
     author_image = db.Column(db.String(512))
     content = db.Column(db.Text)
     content_plain = db.Column(db.Text)
-    published = db.Column(db.DateTime)
+    published = db.Column(db.DateTime, index=True)
     title = db.Column(db.String(512))
     syndication = db.Column(JsonType)
     reftype = db.Column(db.String(32))
@@ -482,10 +750,40 @@ class Mention(db.Model):
 
 
 class Tag(db.Model):
+    __table_args__ = (
+        db.Index('ix_tag_name', 'name', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(256))
     posts = db.relationship('Post', secondary=posts_to_tags)
 
+    @classmethod
+    def load_or_create(cls, names):
+        """The tags with these names, in order and without duplicates.
+        Existing tags are loaded with one query and the missing ones
+        inserted together. If another save creates some of the same
+        tags first, ix_tag_name refuses ours and we load theirs.
+        """
+        names = list(collections.OrderedDict.fromkeys(names))
+        if not names:
+            return []
+        found = {tag.name: tag
+                 for tag in cls.query.filter(cls.name.in_(names))}
+        for attempt in range(3):
+            missing = [name for name in names if name not in found]
+            if not missing:
+                break
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(cls.__table__.insert(),
+                                       [{'name': name} for name in missing])
+            except sqlalchemy.exc.IntegrityError:
+                app.logger.debug('tags created concurrently: %s', missing)
+            found.update((tag.name, tag) for tag
+                         in cls.query.filter(cls.name.in_(missing)))
+        return [found[name] for name in names]
+
     def __init__(self, name):
         self.name = name
 
@@ -493,11 +791,43 @@ class Tag(db.Model):
         return self.name
 
 
+class TagStat(db.Model):
+    """Counts and frecency for one tag, for the tag cloud and the
+    editor's suggestions. Kept up to date by tags.update_tag_stats.
+    """
+    __table_args__ = (
+        db.Index('ix_tag_stat_count', 'count'),
+        db.Index('ix_tag_stat_public_count', 'public_count'),
+        db.Index('ix_tag_stat_score', 'score'),
+    )
+
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id'), primary_key=True)
+    tag = db.relationship('Tag')
+    # posts that haven't been deleted, and of those, the published posts
+    # that anyone can see
+    count = db.Column(db.Integer)
+    public_count = db.Column(db.Integer)
+    # sum over the posts of 2 ** (age relative to decayed_at in half
+    # lives); every row shares the same decayed_at
+    score = db.Column(db.Float)
+    decayed_at = db.Column(db.DateTime)
+
+    def __init__(self, tag_id):
+        self.tag_id = tag_id
+        self.count = 0
+        self.public_count = 0
+        self.score = 0.0
+
+
 class Nick(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     contact_id = db.Column(db.Integer, db.ForeignKey('contact.id'), index=True)
     name = db.Column(db.String(128), unique=True)
 
+    __table_args__ = (
+        db.Index('ix_nick_lower_name', db.func.lower(name)),
+    )
+
     def __init__(self, name):
         self.name = name
 
@@ -515,3 +845,17 @@ class Contact(db.Model):
         self.name = kwargs.get('name')
         self.url = kwargs.get('url')
         self.image = kwargs.get('image')
+
+
+class WebmentionEndpoint(db.Model):
+    """Endpoints discovered on a webmention target, kept so that the
+    target doesn't have to be fetched again until the entry expires.
+    key is the target url, or 'host:' + netloc for an endpoint that
+    the site advertises on its root page.
+    """
+    key = db.Column(db.String(512), primary_key=True)
+    webmention = db.Column(db.String(512))
+    pingback = db.Column(db.String(512))
+    etag = db.Column(db.String(256))
+    last_modified = db.Column(db.String(64))
+    expires = db.Column(db.DateTime, index=True)
@@ -2,8 +2,7 @@ from .. import app
 from .. import db
 from .. import util
 from .. import hooks
-from .. import queue
-from ..models import Post, Setting, get_settings
+from ..models import Post, Setting, get_settings, invalidate_settings
 
 
 from flask.ext.login import login_required
@@ -16,7 +15,7 @@ import urllib
 
 
 def register():
-    hooks.register('post-saved', send_to_facebook)
+    hooks.register('post-saved', do_send_to_facebook, deferred=True)
 
 
 @app.route('/authorize_facebook')
@@ -47,30 +46,21 @@ def authorize_facebook():
         access_token = payload[b'access_token'][0].decode('ascii')
         Setting.query.get('facebook_access_token').value = access_token
         db.session.commit()
+        invalidate_settings()
         return redirect(url_for('edit_settings'))
     else:
         return redirect('https://graph.facebook.com/oauth/authorize?'
                         + urllib.parse.urlencode(params))
 
 
-def send_to_facebook(post, args):
-    if 'facebook' in args.getlist('syndicate-to'):
-        if not is_facebook_authorized():
-            return False, 'Current user is not authorized to post to Facebook'
+def do_send_to_facebook(post, args):
+    if 'facebook' not in args.getlist('syndicate-to'):
+        return None
+    if not is_facebook_authorized():
+        app.logger.warn('not authorized to post %s to Facebook', post.id)
+        return None
 
-        try:
-            app.logger.debug('auto-posting to Facebook %s', post.id)
-            queue.enqueue(do_send_to_facebook, post.id)
-            return True, 'Success'
-
-        except Exception as e:
-            app.logger.exception('auto-posting to facebook')
-            return False, 'Exception while auto-posting to FB: {}'.format(e)
-
-
-def do_send_to_facebook(post_id):
-    app.logger.debug('auto-posting to facebook for %s', post_id)
-    post = Post.load_by_id(post_id)
+    app.logger.debug('auto-posting to facebook for %s', post.id)
 
     preview = guess_content(post)
     post_type = 'post'
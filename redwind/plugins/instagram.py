@@ -1,9 +1,9 @@
 from .. import app
 from .. import db
 from .. import util
-from ..models import Post, Setting, get_settings, Context
+from ..models import Setting, get_settings, Context, \
+    invalidate_settings
 from .. import hooks
-from .. import queue
 
 from flask.ext.login import login_required
 from flask import request, redirect, url_for, render_template, flash,\
@@ -20,7 +20,7 @@ PERMALINK_RE = util.INSTAGRAM_RE
 
 def register():
     hooks.register('create-context', create_context)
-    hooks.register('post-saved', send_to_instagram)
+    hooks.register('post-saved', do_send_to_instagram, deferred=True)
 
 
 @app.route('/authorize_instagram')
@@ -56,6 +56,7 @@ def authorize_instagram():
 
     Setting.query.get('instagram_access_token').value = access_token
     db.session.commit()
+    invalidate_settings()
     return redirect(url_for('edit_settings'))
 
 
@@ -105,21 +106,16 @@ def create_context(url):
     return context
 
 
-def send_to_instagram(post, args):
+def do_send_to_instagram(post, args):
     """Share a like to Instagram without user-input.
     """
-    if 'instagram' in args.getlist('syndicate-to'):
-        if not is_instagram_authorized():
-            return False, 'Current user is not authorized for instagram'
+    if 'instagram' not in args.getlist('syndicate-to'):
+        return None
+    if not is_instagram_authorized():
+        app.logger.warn('not authorized to post %s to instagram', post.id)
+        return None
 
-        app.logger.debug("queueing post to instagram {}".format(post.id))
-        queue.enqueue(do_send_to_instagram, post.id)
-        return True, 'Success'
-
-
-def do_send_to_instagram(post_id):
-    app.logger.debug('posting to instagram %d', post_id)
-    post = Post.load_by_id(post_id)
+    app.logger.debug('posting to instagram %d', post.id)
 
     in_reply_to, repost_of, like_of \
         = util.posse_post_discovery(post, PERMALINK_RE)
@@ -1,29 +1,19 @@
+import datetime
 import requests
 import json
 from .. import app
 from .. import db
 from .. import hooks
-from .. import models
-from .. import queue
 from .. import views
 from flask import request, jsonify
 
 
 def register():
-    hooks.register('post-saved', reverse_geocode)
-    hooks.register('venue-saved', reverse_geocode_venue)
+    hooks.register('post-saved', do_reverse_geocode_post, deferred=True)
+    hooks.register('venue-saved', do_reverse_geocode_venue, deferred=True)
 
 
-def reverse_geocode(post, args):
-    queue.enqueue(do_reverse_geocode_post, post.id)
-
-
-def reverse_geocode_venue(venue, args):
-    queue.enqueue(do_reverse_geocode_venue, venue.id)
-
-
-def do_reverse_geocode_post(postid):
-    post = models.Post.load_by_id(postid)
+def do_reverse_geocode_post(post, args):
     if post.location and 'latitude' in post.location \
        and 'longitude' in post.location:
         adr = do_reverse_geocode(post.location['latitude'],
@@ -32,11 +22,11 @@ def do_reverse_geocode_post(postid):
         # that it changed
         post.location = dict(post.location)
         post.location.update(adr)
+        post.updated = datetime.datetime.utcnow()
         db.session.commit()
 
 
-def do_reverse_geocode_venue(venueid):
-    venue = models.Venue.query.get(venueid)
+def do_reverse_geocode_venue(venue, args):
     if venue.location and 'latitude' in venue.location \
        and 'longitude' in venue.location:
         adr = do_reverse_geocode(venue.location['latitude'],
@@ -46,6 +36,7 @@ def do_reverse_geocode_venue(venueid):
         venue.location = dict(venue.location)
         venue.location.update(adr)
         venue.update_slug(views.geo_name(venue.location))
+        views.mark_venue_posts_updated(venue)
         db.session.commit()
 
 
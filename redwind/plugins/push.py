@@ -1,18 +1,17 @@
 from .. import app
 from .. import hooks
-from .. import queue
 import requests
 from flask import url_for
 
 
 def register():
-    hooks.register('post-saved', send_notifications)
+    hooks.register('post-saved', send_notifications, deferred=True)
 
 
 def send_notifications(post, args):
     if not post.hidden and not post.draft:
-        queue.enqueue(publish, url_for('index', _external=True))
-        queue.enqueue(publish, url_for('index', feed='atom', _external=True))
+        publish(url_for('index', _external=True))
+        publish(url_for('index', feed='atom', _external=True))
 
 
 def publish(url):
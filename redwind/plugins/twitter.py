@@ -1,9 +1,9 @@
 from .. import app
 from .. import db
 from .. import hooks
-from .. import queue
 from .. import util
-from ..models import Post, Context, Setting, get_settings
+from ..models import Post, Context, Setting, get_settings, \
+    invalidate_settings
 
 from flask.ext.login import login_required
 from flask import request, redirect, url_for, make_response,\
@@ -41,7 +41,7 @@ PERMALINK_RE = util.TWITTER_RE
 
 def register():
     hooks.register('create-context', create_context)
-    hooks.register('post-saved', send_to_twitter)
+    hooks.register('post-saved', do_send_to_twitter, deferred=True)
 
 
 @app.route('/authorize_twitter')
@@ -81,6 +81,7 @@ def twitter_callback():
         Setting.query.get('twitter_oauth_token_secret').value = access_token_secret
 
         db.session.commit()
+        invalidate_settings()
         return redirect(url_for('edit_settings'))
     except requests.RequestException as e:
         return make_response(str(e))
@@ -95,7 +96,9 @@ def collect_images(post):
             yield post.photo_url(photo)
 
     else:
-        html = util.markdown_filter(
+        # the pre-rendered html has the same images, apart from
+        # h-card photos, which are skipped anyway
+        html = post.content_html or util.markdown_filter(
             post.content, img_path=post.get_image_path(),
             url_processor=None, person_processor=None)
         soup = BeautifulSoup(html)
@@ -106,27 +109,17 @@ def collect_images(post):
                     yield urljoin(get_settings().site_url, src)
 
 
-def send_to_twitter(post, args):
+def do_send_to_twitter(post, args):
     """Share a note to twitter without user-input. Makes a best-effort
     attempt to guess the appropriate parameters and content
     """
-    if 'twitter' in args.getlist('syndicate-to'):
-        if not is_twitter_authorized():
-            return False, 'Current user is not authorized to tweets'
-
-        try:
-            app.logger.debug("auto-posting to twitter {}".format(post.id))
-            queue.enqueue(do_send_to_twitter, post.id)
-            return True, 'Success'
-
-        except Exception as e:
-            app.logger.exception('auto-posting to twitter')
-            return False, 'Exception while auto-posting to twitter: {}'.format(e)
-
+    if 'twitter' not in args.getlist('syndicate-to'):
+        return None
+    if not is_twitter_authorized():
+        app.logger.warn('not authorized to tweet %s', post.id)
+        return None
 
-def do_send_to_twitter(post_id):
-    app.logger.debug('auto-posting to twitter for %s', post_id)
-    post = Post.load_by_id(post_id)
+    app.logger.debug('auto-posting to twitter for %s', post.id)
 
     in_reply_to, repost_of, like_of = util.posse_post_discovery(
         post, PERMALINK_RE)
@@ -148,7 +141,7 @@ def do_send_to_twitter(post_id):
 
     preview, img_url = guess_tweet_content(post, in_reply_to)
     response = do_tweet(
-        post_id, preview, img_url, in_reply_to, repost_of, like_of)
+        post.id, preview, img_url, in_reply_to, repost_of, like_of)
     return str(response)
 
 
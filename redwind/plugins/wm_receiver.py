@@ -2,13 +2,12 @@ from .. import app
 from .. import db
 from .. import queue
 from .. import util
+from .. import views
 from ..models import Post, Mention, get_settings
-from bs4 import BeautifulSoup
 from flask import request, make_response, render_template, url_for, abort
 from werkzeug.exceptions import NotFound
 import collections
 import datetime
-import mf2py
 import mf2util
 import requests
 import urllib.parse
@@ -94,10 +93,16 @@ def process_webmention(source, target, callback):
                                     m.url != source]
         elif result.post and result.mention:
             result.post.mentions.append(result.mention)
+        if result.post:
+            result.post.update_mention_counts()
+            result.post.mentions_updated = datetime.datetime.utcnow()
 
         db.session.commit()
         app.logger.debug("saved mentions to %s", result.post.path)
 
+        if result.post:
+            views.invalidate_post_listings(result.post)
+
         if result.post and result.mention and result.create:
             send_push_notification(result.post, result.mention)
         
@@ -169,7 +174,13 @@ def do_process_webmention(source, target):
             error='{} and {} refer to the same post'.format(source, target))
 
     # confirm that source actually refers to the post
-    source_response = util.fetch_html(source)
+    try:
+        source_response = util.fetch_html(source)
+    except util.FetchError as e:
+        app.logger.warn("Webmention source refused: %s", e)
+        return ProcessResult(
+            post=target_post, mention=None, create=False, delete=False,
+            error="Could not read source post: {}".format(e))
     app.logger.debug('received response from source %s', source_response)
 
     if source_response.status_code == 410:
@@ -184,15 +195,8 @@ def do_process_webmention(source, target):
             post=target_post, mention=None, create=False, delete=False,
             error="Bad response when reading source post: {}, {}".format(source, source_response))
 
-    source_length = source_response.headers.get('Content-Length')
-
-    if source_length and int(source_length) > 2097152:
-        app.logger.warn("Very large source. length=%s", source_length)
-        return ProcessResult(
-            post=target_post, mention=None, create=False, delete=False,
-            error="Source is very large. Length={}".format(source_length))
-
-    link_to_target = find_link_to_target(source, source_response, target_urls)
+    source_doc = util.HtmlDocument.from_response(source_response, source)
+    link_to_target = find_link_to_target(source, source_doc, target_urls)
     if not link_to_target:
         app.logger.warn(
             "Webmention source %s does not appear to link to target %s. "
@@ -200,26 +204,16 @@ def do_process_webmention(source, target):
         return ProcessResult(target_post, None, False,\
             "Could not find any links from source to target")
 
-    mention = create_mention(target_post, source, source_response)
+    mention = create_mention(target_post, source, source_doc)
     return ProcessResult(
         post=target_post, mention=mention, create=not mention.id,
         delete=False, error=None)
 
 
-def find_link_to_target(source_url, source_response, target_urls):
-    if source_response.status_code // 2 != 100:
-        app.logger.warn(
-            "Received unexpected response from webmention source: %s",
-            source_response.text)
-        return None
-
+def find_link_to_target(source_url, source_doc, target_urls):
     # Don't worry about Microformats for now; just see if there is a
     # link anywhere that points back to the target
-    soup = BeautifulSoup(source_response.text)
-    for link in soup.find_all(['a', 'link']):
-        link_target = link.get('href')
-        if link_target in target_urls:
-            return link
+    return source_doc.find_links(target_urls)
 
 
 def find_target_post(target_url):
@@ -292,7 +286,7 @@ def find_target_post(target_url):
     return post
 
 
-def create_mention(post, url, source_response):
+def create_mention(post, url, source_doc):
     target_urls = []
     if post:
         base_target_urls = [post.permalink]
@@ -303,9 +297,9 @@ def create_mention(post, url, source_response):
                                if base_url.startswith('https://')
                                else base_url.replace('http://', 'https://'))
 
-    blob = mf2py.Parser(doc=source_response.text, url=url).to_dict()
+    blob = source_doc.to_mf2()
     if not blob:
-        app.logger.debug('create_mention: no mf2 in source_response')
+        app.logger.debug('create_mention: no mf2 in source document')
         return
     entry = mf2util.interpret_comment(blob, url, target_urls)
     if not entry:
@@ -1,36 +1,30 @@
 from .. import app
-from .. import queue
+from .. import util
 from .. import hooks
-from ..models import Post
+from .. import cache
+from .. import db
+from ..models import WebmentionEndpoint
 from bs4 import BeautifulSoup
-import urllib
+import collections
+import concurrent.futures
+import datetime
+import email.utils
 import re
-import requests
+import threading
+import time
+import urllib
 
 
 def register():
-    hooks.register('post-saved', send_webmentions)
+    hooks.register('post-saved', do_send_webmentions, deferred=True)
 
 
-def send_webmentions(post, args):
+def do_send_webmentions(post, args):
     if args.get('action') in ('save_draft', 'publish_quietly'):
         app.logger.debug('skipping webmentions for {}'.format(post.id))
         return
 
-    try:
-        app.logger.debug("queueing webmentions for {}".format(post.id))
-        queue.enqueue(do_send_webmentions, post.id)
-        return True, 'Success'
-
-    except Exception as e:
-        app.logger.exception('sending webmentions')
-        return False, "Exception while sending webmention: {}"\
-            .format(e)
-
-
-def do_send_webmentions(post_id):
-    app.logger.debug("sending mentions for {}".format(post_id))
-    post = Post.load_by_id(post_id)
+    app.logger.debug("sending mentions for {}".format(post.id))
     return handle_new_or_edit(post)
 
 
@@ -58,85 +52,279 @@ def get_target_urls(post):
     return target_urls
 
 
-def get_response(url):
-    if url in get_response.cached_responses:
-        return get_response.cached_responses[url]
-    response = requests.get(url)
-    get_response.cached_responses[url] = response
-    return response
+def host_limit(url):
+    """Semaphore that bounds concurrent connections to url's host
+    """
+    host = urllib.parse.urlparse(url).netloc
+    with host_limit.lock:
+        sem = host_limit.semaphores.get(host)
+        if not sem:
+            sem = host_limit.semaphores[host] = threading.BoundedSemaphore(
+                app.config.get('WM_SENDER_PER_HOST', 2))
+    return sem
 
-get_response.cached_responses = {}
+host_limit.lock = threading.Lock()
+host_limit.semaphores = {}
 
 
 def handle_new_or_edit(post):
-    target_urls = get_target_urls(post)
+    target_urls = list(collections.OrderedDict.fromkeys(
+        get_target_urls(post)))
     app.logger.debug("Sending webmentions to these urls {}"
                      .format(" ; ".join(target_urls)))
-    results = []
-    for target_url in target_urls:
-        results.append(send_mention(post, target_url))
-    return results
-
-
-def send_mention(post, target_url):
+    if not target_urls:
+        return []
+
+    # resolve the permalink and cached endpoints here; the worker
+    # threads have no app context
+    source_url = get_source_url(post)
+    cached = load_endpoints(target_urls)
+    max_workers = min(len(target_urls),
+                      app.config.get('WM_SENDER_MAX_WORKERS', 8))
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        sent = list(pool.map(lambda target_url: send_mention(
+            source_url, target_url, cached.get(target_url)), target_urls))
+
+    save_endpoints({target_url: endpoints for target_url, (_, endpoints)
+                    in zip(target_urls, sent)})
+    return [result for result, _ in sent]
+
+
+def send_mention(source_url, target_url, cached=None):
+    """Send a webmention or pingback to target_url. Returns the result
+    and the discovered endpoints (see discover_endpoints), or None if
+    they should not be cached.
+    """
     app.logger.debug("Looking for webmention endpoint on %s",
                      target_url)
+    start = time.time()
+    timing = {}
+    if cached and cached['expires'] > datetime.datetime.utcnow():
+        app.logger.debug("Using cached endpoints for %s", target_url)
+        success, explanation, endpoints = True, None, cached
+    else:
+        success, explanation, target = fetch_target(target_url, cached)
+        endpoints = success and discover_endpoints(target, cached)
+    timing['fetch'] = time.time() - start
 
-    success, explanation = check_content_type_and_size(target_url)
     if success:
-        if supports_webmention(target_url):
+        if endpoints['webmention']:
             app.logger.debug("Site supports webmention")
-            success, explanation = send_webmention(post, target_url)
+            success, explanation = send_webmention(
+                source_url, target_url, endpoints['webmention'])
 
-        elif supports_pingback(target_url):
+        elif endpoints['pingback']:
             app.logger.debug("Site supports pingback")
-            success, explanation = send_pingback(post, target_url)
+            success, explanation = send_pingback(
+                source_url, target_url, endpoints['pingback'])
             app.logger.debug("Sending pingback successful: %s", success)
 
         else:
             app.logger.debug("Site does not support mentions")
             success = False
             explanation = 'Site does not support webmentions or pingbacks'
+        timing['send'] = time.time() - start - timing['fetch']
+
+    if not success and endpoints and (
+            endpoints['webmention'] or endpoints['pingback']):
+        # look again next time, in case the endpoint has moved
+        endpoints = None
 
+    timing['total'] = time.time() - start
     return {'target': target_url,
             'success': success,
-            'explanation': explanation}
-
-
-def check_content_type_and_size(target_url):
-    request = urllib.request.Request(
-        target_url, headers={'User-Agent': 'kylewm.com'})
-    metadata = urllib.request.urlopen(request).info()
-    if not metadata:
-        return False, "Could not retrieve metadata for url {}".format(
-            target_url)
-
-    content_type = metadata.get_content_maintype()
-    content_length = metadata.get('Content-Length')
+            'explanation': explanation,
+            'timing': timing}, endpoints or None
+
+
+class Target:
+    """The parts of a fetched target page needed for endpoint discovery
+    """
+    def __init__(self, url, status_code, headers, text):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+        self.soup = text is not None and BeautifulSoup(text)
+
+
+def fetch_target(target_url, cached=None):
+    """Fetch the target once with util.fetch_html, which gives up as
+    soon as it is clear that the page is not text or is too large.
+    If we have validators for a cached copy, the request is
+    conditional and a 304 comes back as a Target with no text.
+    Returns (success, explanation, Target).
+    """
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
 
-    if content_type and content_type != 'text':
-        return False, "Target content type '{}' is not 'text'".format(
-            content_type)
-
-    if content_length and int(content_length) > 2097152:
-        return False, "Target content length {} is too large".format(
-            content_length)
-
-    return True, None
-
-
-def supports_webmention(target_url):
-    return find_webmention_endpoint(target_url) is not None
-
-
-def find_webmention_endpoint(target_url):
-    app.logger.debug("looking for webmention endpoint in %s", target_url)
-    response = get_response(target_url)
-    app.logger.debug("looking for webmention endpoint in headers and body")
-    endpoint = (find_webmention_endpoint_in_headers(response.headers)
-                or find_webmention_endpoint_in_html(response.text))
-    app.logger.debug("webmention endpoint %s %s", response.url, endpoint)
-    return endpoint and urllib.parse.urljoin(response.url, endpoint)
+    try:
+        with host_limit(target_url):
+            response = util.fetch_html(
+                target_url, headers=headers, content_types=('text/',))
+    except Exception as e:
+        app.logger.warn('failed to fetch target %s: %s', target_url, e)
+        return False, "Could not retrieve url {}: {}".format(
+            target_url, e), None
+
+    if headers and response.status_code == 304:
+        return True, None, Target(response.url or target_url, 304,
+                                  response.headers, None)
+    return True, None, Target(response.url or target_url,
+                              response.status_code, response.headers,
+                              response.text)
+
+
+def discover_endpoints(target, cached=None):
+    """Find the webmention and pingback endpoints for a fetched target,
+    along with what we need to cache them: validators, an expiry
+    derived from Cache-Control/Expires, and whether the endpoint was
+    found on the site's root page (and so is assumed to apply to the
+    whole host). Endpoints found anywhere else only apply to their own
+    target, since some hosts give each path an endpoint of its own.
+    """
+    lifetime = cache_lifetime(target.headers)
+    if target.status_code == 304:
+        endpoints = dict(cached)
+    else:
+        in_headers = find_webmention_endpoint_in_headers(target.headers)
+        endpoint = in_headers or find_webmention_endpoint_in_html(
+            target.soup)
+        endpoints = {
+            'webmention': endpoint and urllib.parse.urljoin(
+                target.url, endpoint),
+            'pingback': find_pingback_endpoint(target),
+            'host_wide': bool(endpoint) and is_site_root(target.url),
+            'etag': target.headers.get('etag'),
+            'last_modified': target.headers.get('last-modified'),
+        }
+        app.logger.debug("webmention endpoint %s %s", target.url, endpoint)
+    endpoints['expires'] = datetime.datetime.utcnow() + \
+        datetime.timedelta(seconds=lifetime or 0)
+    endpoints['no_store'] = lifetime is None
+    return endpoints
+
+
+def cache_lifetime(headers):
+    """Seconds that a response may be reused for, or None if it must
+    not be stored at all.
+    """
+    default_ttl = app.config.get('WM_ENDPOINT_CACHE_TTL', 86400)
+    max_ttl = app.config.get('WM_ENDPOINT_CACHE_MAX_TTL', 7 * 86400)
+    directives = {}
+    for directive in (headers.get('cache-control') or '').split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name.lower()] = value.strip('"')
+
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0
+    for name in ('s-maxage', 'max-age'):
+        if directives.get(name, '').isdigit():
+            return min(int(directives[name]), max_ttl)
+    if headers.get('expires'):
+        try:
+            expires = email.utils.parsedate_to_datetime(headers['expires'])
+            date = (email.utils.parsedate_to_datetime(headers['date'])
+                    if headers.get('date')
+                    else datetime.datetime.now(datetime.timezone.utc))
+            return min(max(int((expires - date).total_seconds()), 0),
+                       max_ttl)
+        except (TypeError, ValueError):
+            return 0
+    return default_ttl
+
+
+def host_key(url):
+    return 'host:' + urllib.parse.urlparse(url).netloc
+
+
+def is_site_root(url):
+    parsed = urllib.parse.urlparse(url)
+    return parsed.path in ('', '/') and not parsed.query
+
+
+def get_endpoint_cache():
+    """In-process LRU in front of the WebmentionEndpoint table
+    """
+    if not get_endpoint_cache.cached:
+        get_endpoint_cache.cached = cache.LruCacheImpl(
+            app.config.get('WM_ENDPOINT_CACHE_MAX_ENTRIES', 1000))
+    return get_endpoint_cache.cached
+
+get_endpoint_cache.cached = None
+
+
+def load_endpoints(target_urls):
+    """Look up cached endpoints for each target url, falling back to
+    a still-fresh entry for the target's host. Entries that are
+    missing from memory are read from the database in one query.
+    """
+    lru = get_endpoint_cache()
+    keys = set(target_urls) | set(host_key(url) for url in target_urls)
+    entries = {key: lru.get(key) for key in keys}
+    missing = [key for key, entry in entries.items() if entry is None]
+    if missing:
+        for row in WebmentionEndpoint.query.filter(
+                WebmentionEndpoint.key.in_(missing)):
+            entries[row.key] = entry = {
+                'webmention': row.webmention,
+                'pingback': row.pingback,
+                'etag': row.etag,
+                'last_modified': row.last_modified,
+                'expires': row.expires,
+                'host_wide': row.key.startswith('host:'),
+            }
+            lru.set(row.key, entry)
+
+    now = datetime.datetime.utcnow()
+    result = {}
+    for url in target_urls:
+        entry = entries.get(url)
+        host_entry = entries.get(host_key(url))
+        if (not entry or entry['expires'] <= now) \
+                and host_entry and host_entry['expires'] > now:
+            entry = host_entry
+        if entry:
+            result[url] = entry
+    return result
+
+
+def save_endpoints(discovered):
+    """Store newly discovered endpoints (target url -> endpoints, or
+    None to forget the target and its host) in memory and in the
+    database.
+    """
+    lru = get_endpoint_cache()
+    for url, endpoints in discovered.items():
+        keys = [url]
+        if endpoints is None or endpoints.get('host_wide'):
+            keys.append(host_key(url))
+        for key in keys:
+            if endpoints is None or endpoints.get('no_store'):
+                lru.delete(key)
+                WebmentionEndpoint.query.filter_by(key=key).delete()
+                continue
+            entry = {k: endpoints.get(k) for k in (
+                'webmention', 'pingback', 'etag', 'last_modified',
+                'expires', 'host_wide')}
+            lru.set(key, entry)
+            row = WebmentionEndpoint.query.get(key) \
+                or WebmentionEndpoint(key=key)
+            for k in ('webmention', 'pingback', 'etag', 'last_modified',
+                      'expires'):
+                setattr(row, k, entry[k])
+            db.session.add(row)
+
+    # nothing is revalidated after a month; don't keep it forever
+    WebmentionEndpoint.query.filter(
+        WebmentionEndpoint.expires < datetime.datetime.utcnow()
+        - datetime.timedelta(days=30)).delete()
+    db.session.commit()
 
 
 def find_webmention_endpoint_in_headers(headers):
@@ -149,30 +337,26 @@ def find_webmention_endpoint_in_headers(headers):
             return m.group(1)
 
 
-def find_webmention_endpoint_in_html(body):
-    soup = BeautifulSoup(body)
+def find_webmention_endpoint_in_html(soup):
     link = (soup.find('link', attrs={'rel': 'webmention'})
             or soup.find('link', attrs={'rel': 'http://webmention.org/'})
             or soup.find('a', attrs={'rel': 'webmention'}))
     return link and link.get('href')
 
 
-def send_webmention(post, target_url):
+def send_webmention(source_url, target_url, endpoint):
     app.logger.debug(
-        "Sending webmention from %s to %s",
-        get_source_url(post), target_url)
+        "Sending webmention from %s to %s", source_url, target_url)
 
     try:
-        endpoint = find_webmention_endpoint(target_url)
-        if not endpoint:
-            return False, "No webmention endpoint for {}".format(
-                target_url)
-
-        payload = {'source': get_source_url(post),
+        payload = {'source': source_url,
                    'target': target_url}
         headers = {'content-type': 'application/x-www-form-urlencoded',
                    'accept': 'application/json'}
-        response = requests.post(endpoint, data=payload, headers=headers)
+        with host_limit(endpoint):
+            response = util.get_http_session().post(
+                endpoint, data=payload, headers=headers,
+                timeout=app.config.get('WM_SENDER_TIMEOUT', 30))
 
         #from https://github.com/vrypan/webmention-tools/blob/master/
         #             webmentiontools/send.py
@@ -193,25 +377,16 @@ def send_webmention(post, target_url):
         return False, "Exception while sending webmention {}".format(e)
 
 
-def supports_pingback(target_url):
-    return find_pingback_endpoint(target_url) is not None
-
-
-def find_pingback_endpoint(target_url):
-    response = get_response(target_url)
-    endpoint = response.headers.get('x-pingback')
+def find_pingback_endpoint(target):
+    endpoint = target.headers.get('x-pingback')
     if not endpoint:
-        soup = BeautifulSoup(response.text)
-        link = soup.find('link', attrs={'rel': 'pingback'})
+        link = target.soup.find('link', attrs={'rel': 'pingback'})
         endpoint = link and link.get('href')
     return endpoint
 
 
-def send_pingback(post, target_url):
+def send_pingback(source_url, target_url, endpoint):
     try:
-        endpoint = find_pingback_endpoint(target_url)
-        source_url = get_source_url(post)
-
         payload = (
             """<?xml version="1.0" encoding="iso-8859-1"?><methodCall>"""
             """<methodName>pingback.ping</methodName><params><param>"""
@@ -219,7 +394,10 @@ def send_pingback(post, target_url):
             """<string>{}</string></value></param></params></methodCall>"""
             .format(source_url, target_url))
         headers = {'content-type': 'application/xml'}
-        response = requests.post(endpoint, data=payload, headers=headers)
+        with host_limit(endpoint):
+            response = util.get_http_session().post(
+                endpoint, data=payload, headers=headers,
+                timeout=app.config.get('WM_SENDER_TIMEOUT', 30))
         app.logger.debug(
             "Pingback to %s response status code %s. Message %s",
             target_url, response.status_code, response.text)
@@ -2,8 +2,7 @@ from .. import app
 from .. import db
 from .. import util
 from .. import hooks
-from .. import queue
-from ..models import Post, Setting, get_settings
+from ..models import Setting, get_settings, invalidate_settings
 
 from flask.ext.login import login_required
 from flask import request, redirect, url_for, render_template, flash,\
@@ -26,7 +25,7 @@ API_ME_URL = 'https://public-api.wordpress.com/rest/v1.1/me'
 
 
 def register():
-    hooks.register('post-saved', send_to_wordpress)
+    hooks.register('post-saved', do_send_to_wordpress, deferred=True)
 
 
 @app.route('/install_wordpress')
@@ -42,6 +41,7 @@ def install():
         if not Setting.query.get(s.key):
             db.session.add(s)
     db.session.commit()
+    invalidate_settings()
 
     return 'Success'
 
@@ -71,6 +71,7 @@ def authorize_wordpress():
         access_token = payload.get('access_token')
         Setting.query.get('wordpress_access_token').value = access_token
         db.session.commit()
+        invalidate_settings()
         return redirect(url_for('edit_settings'))
     else:
         return redirect(API_AUTHORIZE_URL + '?' + urllib.parse.urlencode({
@@ -81,13 +82,9 @@ def authorize_wordpress():
         }))
 
 
-def send_to_wordpress(post, args):
-    if 'wordpress' in args.getlist('syndicate-to'):
-        queue.enqueue(do_send_to_wordpress, post.id)
-
-
-def do_send_to_wordpress(post_id):
-    post = Post.load_by_id(post_id)
+def do_send_to_wordpress(post, args):
+    if 'wordpress' not in args.getlist('syndicate-to'):
+        return
 
     if post.like_of:
         for url in post.like_of:
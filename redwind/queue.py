@@ -1,73 +1,303 @@
 from . import app
 from . import db
+import concurrent.futures
+import datetime
+import os
+import pickle
+import select
+import socket
+import threading
 import time
+import traceback
 import uuid
-import pickle
 
 
 class Job(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     created = db.Column(db.DateTime, default=db.func.now())
     updated = db.Column(db.DateTime, onupdate=db.func.now())
-    key = db.Column(db.String(128))
+    key = db.Column(db.String(128), index=True)
     params = db.Column(db.PickleType)
     result = db.Column(db.PickleType)
     complete = db.Column(db.Boolean)
+    # earliest time the job may (re)run, pushed back after each failure
+    run_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, default=0)
+    locked_by = db.Column(db.String(128))
+    locked_at = db.Column(db.DateTime)
+    error = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_job_pending', 'complete', 'run_at'),
+    )
 
 
 class SqlQueueImpl:
+    """Stores jobs in the job table. Any number of qworker processes,
+    each running QUEUE_WORKERS threads, can share the table: a worker
+    claims a job by atomically stamping locked_by, so no job is run
+    twice at the same time. While a job runs, its worker refreshes
+    locked_at; claims that haven't been refreshed for QUEUE_JOB_TIMEOUT
+    are presumed dead and become claimable again. A worker whose job was
+    taken over drops its outcome.
+    """
+    NOTIFY_CHANNEL = 'redwind_jobs'
+
+    # on Postgres, SKIP LOCKED lets concurrent workers grab different
+    # rows without blocking on each other
+    CLAIM_SKIP_LOCKED = db.text("""
+        UPDATE job SET locked_by = :worker, locked_at = :now,
+                       attempts = coalesce(attempts, 0) + 1
+        WHERE id = (
+            SELECT id FROM job
+            WHERE complete = false AND run_at <= :now
+              AND (locked_by IS NULL OR locked_at < :stale)
+            ORDER BY run_at, id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED)
+        RETURNING id""")
+
+    # elsewhere, try a few candidates and keep the first one whose
+    # compare-and-set UPDATE wins
+    CLAIM_CANDIDATES = 5
+
+    def __init__(self):
+        self.wakeup = threading.Event()
+
+    def is_postgres(self):
+        return db.engine.dialect.name == 'postgresql'
+
     def enqueue(self, func, *args, **kwargs):
         job = Job()
         job.key = str(uuid.uuid4())
         job.params = (func, args, kwargs)
         job.complete = False
+        job.attempts = 0
+        job.run_at = datetime.datetime.utcnow()
         db.session.add(job)
+        if self.is_postgres():
+            # delivered to listening workers when the transaction commits
+            db.session.execute('NOTIFY ' + self.NOTIFY_CHANNEL)
         db.session.commit()
+        self.wakeup.set()
         return job.key
 
     def query(self, key):
-        job = Job.query.filter_by(key).first()
+        job = Job.query.filter_by(key=key).first()
         if job:
             if not job.complete:
                 return 'queued'
             return job.result
 
-    def run(self):
+    def claim(self, worker):
+        """Lock the next runnable job for this worker and return its id,
+        or None if there is nothing to do.
+        """
+        now = datetime.datetime.utcnow()
+        stale = now - datetime.timedelta(
+            seconds=app.config.get('QUEUE_JOB_TIMEOUT', 600))
+
+        if self.is_postgres():
+            job_id = db.session.execute(self.CLAIM_SKIP_LOCKED, {
+                'worker': worker, 'now': now, 'stale': stale,
+            }).scalar()
+            db.session.commit()
+            return job_id
+
+        claimable = db.and_(
+            Job.complete == False, Job.run_at <= now,
+            db.or_(Job.locked_by == None, Job.locked_at < stale))
+        candidates = db.session.query(Job.id).filter(claimable)\
+                                               .order_by(Job.run_at, Job.id)\
+                                               .limit(self.CLAIM_CANDIDATES)\
+                                               .all()
+        for job_id, in candidates:
+            claimed = Job.query.filter(Job.id == job_id, claimable).update({
+                'locked_by': worker,
+                'locked_at': now,
+                'attempts': db.func.coalesce(Job.attempts, 0) + 1,
+            }, synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return job_id
+        db.session.commit()
+
+    def work_one(self, worker=None):
+        """Claim and run a single job. Returns False if the queue was
+        empty.
+        """
+        worker = worker or self.worker_name()
+        job_id = self.claim(worker)
+        if job_id is None:
+            return False
+
+        job = Job.query.get(job_id)
+        func, args, kwargs = job.params
+        result = error = None
+        done = threading.Event()
+        heartbeat = threading.Thread(
+            target=self.heartbeat, args=(db.engine, job_id, worker, done),
+            name='heartbeat-{}'.format(job_id))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            app.logger.debug('executing job %d %s with args=%s kwargs=%s',
+                             job_id, func, args, kwargs)
+            result = func(*args, **kwargs)
+        except:
+            app.logger.exception('error while processing task')
+            error = traceback.format_exc()
+            db.session.rollback()
+        finally:
+            done.set()
+            heartbeat.join()
+
+        # the queued job may have mangled the session (and the job
+        # object with it), so refetch it before recording the outcome
+        job = Job.query.get(job_id)
+        if error and job.attempts < app.config.get('QUEUE_MAX_ATTEMPTS', 3):
+            delay = app.config.get('QUEUE_RETRY_DELAY', 10) \
+                * 2 ** (job.attempts - 1)
+            app.logger.warn('job %d failed (attempt %d), retrying in %ds',
+                            job_id, job.attempts, delay)
+            outcome = {
+                'run_at': datetime.datetime.utcnow()
+                + datetime.timedelta(seconds=delay),
+                'locked_by': None,
+                'locked_at': None,
+            }
+        else:
+            outcome = {'result': result, 'complete': True}
+        outcome['error'] = error
+        # compare-and-set, in case the claim was taken over after all
+        if not Job.query.filter_by(id=job_id, locked_by=worker).update(
+                outcome, synchronize_session=False):
+            app.logger.warn('job %d was taken over by %s, dropping the '
+                            'outcome of this run', job_id, job.locked_by)
+        db.session.commit()
+        return True
+
+    def heartbeat(self, engine, job_id, worker, done):
+        """Thread: refresh the claim on a running job until done is set,
+        in its own transactions
+        """
+        interval = app.config.get('QUEUE_JOB_TIMEOUT', 600) / 3
+        table = Job.__table__
+        while not done.wait(interval):
+            try:
+                with engine.begin() as conn:
+                    conn.execute(table.update().where(db.and_(
+                        table.c.id == job_id, table.c.locked_by == worker))
+                        .values(locked_at=datetime.datetime.utcnow()))
+            except Exception:
+                app.logger.exception('failed to refresh the claim on job %d',
+                                     job_id)
+
+    def worker_name(self):
+        return '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                                 threading.current_thread().name)
+
+    def work(self):
+        """Run jobs until the process is killed. Polls quickly while
+        there is work and backs off to QUEUE_POLL_MAX when idle; an
+        enqueue or NOTIFY wakes the worker immediately.
+        """
+        poll_min = app.config.get('QUEUE_POLL_MIN', 0.1)
+        poll_max = app.config.get('QUEUE_POLL_MAX', 1.0)
         with app.app_context():
+            worker = self.worker_name()
+            delay = poll_min
             while True:
-                for job in Job.query.filter_by(complete=False):
-                    result = None
-                    try:
-                        func, args, kwargs = job.params
-                        result = func(*args, **kwargs)
-                    except:
-                        app.logger.exception('error while processing task')
-                    finally:
-                        # I don't totally understand why, but in some
-                        # cases, the queued job mangles the session, so it
-                        # seems safest to refetch the job before modifying
-                        # it
-                        job = Job.query.get(job.id)
-                        job.result = result
-                        job.complete = True
-                        db.session.commit()
-                time.sleep(10)
+                try:
+                    worked = self.work_one(worker)
+                except:
+                    app.logger.exception('error while claiming task')
+                    db.session.rollback()
+                    worked = False
+                finally:
+                    db.session.remove()
+
+                if worked:
+                    delay = poll_min
+                elif self.wakeup.wait(delay):
+                    self.wakeup.clear()
+                    delay = poll_min
+                else:
+                    delay = min(delay * 2, poll_max)
+
+    def listen(self):
+        """Wake the workers whenever a job is enqueued by another
+        process (Postgres only).
+        """
+        with app.app_context():
+            conn = db.engine.raw_connection().connection
+            conn.set_isolation_level(0)  # autocommit
+            conn.cursor().execute('LISTEN ' + self.NOTIFY_CHANNEL)
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    del conn.notifies[:]
+                    self.wakeup.set()
+
+    def run(self):
+        nworkers = app.config.get('QUEUE_WORKERS', 4)
+        app.logger.info('starting %d queue workers', nworkers)
+        threads = [threading.Thread(target=self.work,
+                                    name='worker-{}'.format(i))
+                   for i in range(nworkers)]
+        with app.app_context():
+            if self.is_postgres():
+                threads.append(threading.Thread(
+                    target=self.listen, name='listener'))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
 
 
 class RedisQueueImpl:
+    """Jobs are pickled onto a Redis list. A worker moves each message
+    onto its own in-flight list (BRPOPLPUSH) before running it, so if
+    the worker dies mid-job, the next worker to start puts the message
+    back on the queue. Up to QUEUE_WORKERS jobs run at once.
+    """
     RV_TTL = 86400
+    HEARTBEAT_TTL = 30
 
-    def __init__(self, redis_url, redis_qkey):
-        import redis
-        self.redis = redis.StrictRedis.from_url(redis_url)
+    def __init__(self, redis_url, redis_qkey, connection=None):
+        if connection is None:
+            import redis
+            connection = redis.StrictRedis.from_url(redis_url)
+        self.redis = connection
         self.qkey = redis_qkey
+        self.worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.last_heartbeat = 0
+
+    def inflight_key(self, worker_id):
+        return '%s:inflight:%s' % (self.qkey, worker_id)
+
+    def heartbeat_key(self, worker_id):
+        return '%s:alive:%s' % (self.qkey, worker_id)
+
+    @property
+    def workers_key(self):
+        return '%s:workers' % self.qkey
+
+    @property
+    def stats_key(self):
+        return '%s:stats' % self.qkey
 
     def enqueue(self, func, *args, **kwargs):
         key = '%s:result:%s' % (self.qkey, str(uuid.uuid4()))
-        self.redis.rpush(
-            self.qkey, pickle.dumps((func, key, args, kwargs)))
         self.redis.set(key, pickle.dumps('queued'))
         self.redis.expire(key, self.RV_TTL)
+        # LPUSH + BRPOPLPUSH keeps the queue first-in, first-out
+        self.redis.lpush(
+            self.qkey, pickle.dumps((func, key, args, kwargs, time.time())))
+        self.redis.hincrby(self.stats_key, 'enqueued', 1)
         return key
 
     def query(self, key):
@@ -75,20 +305,144 @@ class RedisQueueImpl:
         if result is not None:
             return pickle.loads(result)
 
-    def run(self):
+    def stats(self):
+        """Throughput and latency counters for this queue: how many jobs
+        have been enqueued, completed, failed, and timed out, and the
+        average time a job waited in the queue and took to run, in ms.
+        """
+        raw = {k.decode() if isinstance(k, bytes) else k: int(v)
+               for k, v in self.redis.hgetall(self.stats_key).items()}
+        finished = raw.get('completed', 0) + raw.get('failed', 0)
+        stats = {k: raw.get(k, 0) for k in
+                 ('enqueued', 'completed', 'failed', 'timed_out')}
+        stats['pending'] = self.redis.llen(self.qkey)
+        stats['avg_wait_ms'] = finished and raw.get('wait_ms', 0) / finished
+        stats['avg_run_ms'] = finished and raw.get('run_ms', 0) / finished
+        return stats
+
+    def heartbeat(self):
+        now = time.time()
+        if now - self.last_heartbeat > self.HEARTBEAT_TTL / 3:
+            self.redis.sadd(self.workers_key, self.worker_id)
+            self.redis.setex(self.heartbeat_key(self.worker_id),
+                             self.HEARTBEAT_TTL, now)
+            self.last_heartbeat = now
+
+    def recover(self):
+        """Requeue jobs that were in flight on workers that are no longer
+        alive (including a previous run of this one).
+        """
+        for worker_id in self.redis.smembers(self.workers_key):
+            if isinstance(worker_id, bytes):
+                worker_id = worker_id.decode()
+            if (worker_id != self.worker_id
+                    and self.redis.exists(self.heartbeat_key(worker_id))):
+                continue
+            inflight = self.inflight_key(worker_id)
+            count = 0
+            while self.redis.rpoplpush(inflight, self.qkey) is not None:
+                count += 1
+            if count:
+                app.logger.warn('requeued %d jobs from worker %s',
+                                count, worker_id)
+            if worker_id != self.worker_id:
+                self.redis.srem(self.workers_key, worker_id)
+
+    def dequeue(self, count, timeout=1):
+        """Move up to count messages onto this worker's in-flight list,
+        blocking up to timeout seconds for the first one.
+        """
+        inflight = self.inflight_key(self.worker_id)
+        msg = self.redis.brpoplpush(self.qkey, inflight, timeout)
+        if msg is None:
+            return []
+        pipe = self.redis.pipeline()
+        for _ in range(count - 1):
+            pipe.rpoplpush(self.qkey, inflight)
+        return [msg] + [m for m in pipe.execute() if m is not None]
+
+    def execute(self, msg):
+        started = time.time()
+        func, key, args, kwargs, *rest = pickle.loads(msg)
+        enqueued = rest[0] if rest else started
+        failed = False
         with app.app_context():
+            try:
+                app.logger.debug('executing %s with args=%s kwargs=%s',
+                                 func, args, kwargs)
+                rv = func(*args, **kwargs)
+            except Exception as e:
+                app.logger.exception('exception while running queued task')
+                rv = e
+                failed = True
+            finally:
+                db.session.remove()
+
+        finished = time.time()
+        if not self.redis.lrem(self.inflight_key(self.worker_id), 1, msg):
+            # already given up on by expire(); keep the timeout result
+            app.logger.warn('job %s finished after timing out', key)
+            return rv
+        pipe = self.redis.pipeline()
+        pipe.set(key, pickle.dumps(rv))
+        pipe.expire(key, self.RV_TTL)
+        pipe.hincrby(self.stats_key, 'failed' if failed else 'completed', 1)
+        pipe.hincrby(self.stats_key, 'wait_ms',
+                     int((started - enqueued) * 1000))
+        pipe.hincrby(self.stats_key, 'run_ms',
+                     int((finished - started) * 1000))
+        pipe.execute()
+        return rv
+
+    def expire(self, msg):
+        """Give up on a job that has exceeded QUEUE_JOB_TIMEOUT. Threads
+        can't be killed, so the job keeps its worker slot until it
+        returns, but it is reported as failed and won't be requeued.
+        """
+        func, key, args, kwargs, *_ = pickle.loads(msg)
+        app.logger.warn('job %s timed out: %s with args=%s kwargs=%s',
+                        key, func, args, kwargs)
+        pipe = self.redis.pipeline()
+        pipe.set(key, pickle.dumps(TimeoutError(key)))
+        pipe.expire(key, self.RV_TTL)
+        pipe.lrem(self.inflight_key(self.worker_id), 1, msg)
+        pipe.hincrby(self.stats_key, 'timed_out', 1)
+        pipe.execute()
+
+    def step(self, pool, running, nworkers, timeout=1):
+        """Fill free worker slots from the queue and expire jobs that
+        have run too long. running maps future -> (msg, start time,
+        expired).
+        """
+        self.heartbeat()
+        job_timeout = app.config.get('QUEUE_JOB_TIMEOUT', 600)
+        now = time.time()
+        for future, (msg, started, expired) in list(running.items()):
+            if future.done():
+                del running[future]
+            elif not expired and now - started > job_timeout:
+                self.expire(msg)
+                running[future] = (msg, started, True)
+
+        free = nworkers - len(running)
+        if free:
+            for msg in self.dequeue(free, timeout):
+                running[pool.submit(self.execute, msg)] = \
+                    (msg, time.time(), False)
+        else:
+            concurrent.futures.wait(
+                running, timeout, concurrent.futures.FIRST_COMPLETED)
+
+    def run(self):
+        nworkers = app.config.get('QUEUE_WORKERS', 4)
+        app.logger.info('starting redis queue worker %s with %d threads',
+                        self.worker_id, nworkers)
+        self.heartbeat()
+        self.recover()
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(nworkers) as pool:
             while True:
-                msg = self.redis.blpop(self.qkey)
-                func, key, args, kwargs = pickle.loads(msg[1])
-                try:
-                    app.logger.debug('executing %s with args=%s kwargs=%s',
-                                     func, args, kwargs)
-                    rv = func(*args, **kwargs)
-                except Exception as e:
-                    app.logger.exception('exception while running queued task')
-                    rv = e
-                self.redis.set(key, pickle.dumps(rv))
-                self.redis.expire(key, self.RV_TTL)
+                self.step(pool, running, nworkers)
 
 
 def get_impl():
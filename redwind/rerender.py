@@ -0,0 +1,171 @@
+"""
+Re-render Post.content_html for many posts at once, e.g. after
+changing markdown_filter, the Pygments style, or a contact's nicks.
+Posts are walked in batches by id, rendered (optionally in a pool of
+processes), and only rows whose html actually changed are written.
+"""
+from . import app
+from . import cache
+from . import db
+from . import queue
+from . import util
+from .models import Post
+import datetime
+import multiprocessing
+import os
+import time
+
+
+def render_args(post):
+    """Everything needed to render a post, so that worker processes
+    don't have to load it themselves
+    """
+    return (post.id, post.content, post.get_image_path(),
+            util.person_to_microcard if post.post_type == 'article'
+            else util.person_to_at_name)
+
+
+def render(args):
+    """Render one post's html from render_args. Runs in the pool."""
+    post_id, content, img_path, person_processor = args
+    with app.app_context():
+        return post_id, util.markdown_filter(
+            content, img_path=img_path, person_processor=person_processor)
+
+
+def init_worker():
+    # forked workers must not reuse the parent's database connections.
+    # recreate() leaves them open for the parent, where dispose() would
+    # close them
+    with app.app_context():
+        db.engine.pool = db.engine.pool.recreate()
+
+
+def read_checkpoint(checkpoint):
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            return int(f.read().strip() or 0)
+    return 0
+
+
+def write_checkpoint(checkpoint, last_id):
+    if checkpoint:
+        with open(checkpoint + '.tmp', 'w') as f:
+            f.write(str(last_id))
+        os.replace(checkpoint + '.tmp', checkpoint)
+
+
+def rerender_posts(post_ids=None, batch_size=None, processes=None,
+                   checkpoint=None):
+    """Re-render every post (or just post_ids) in batches of
+    batch_size. With processes > 1, posts are rendered in a process
+    pool. If checkpoint is the name of a file, the id of the last post
+    in each finished batch is written there, and a later call with the
+    same checkpoint picks up after it; the file is removed when the
+    whole run completes.
+
+    Returns a dict with the number of posts rendered and changed and
+    the elapsed time.
+    """
+    batch_size = batch_size or app.config.get('RERENDER_BATCH_SIZE', 100)
+    if processes is None:
+        processes = app.config.get('RERENDER_PROCESSES') \
+            or multiprocessing.cpu_count()
+
+    # rendering or a contact changed, possibly in another process, so
+    # don't reuse anything rendered or looked up before
+    util.invalidate_contacts()
+
+    last_id = read_checkpoint(checkpoint)
+    if last_id:
+        app.logger.info('resuming rerender after post %d', last_id)
+
+    update = Post.__table__.update()\
+        .where(Post.__table__.c.id == db.bindparam('post_id'))\
+        .values(content_html=db.bindparam('html'),
+                updated=db.bindparam('updated'))
+
+    pool = multiprocessing.Pool(processes, init_worker) \
+        if processes > 1 else None
+    stats = {'posts': 0, 'changed': 0}
+    start = time.time()
+    try:
+        while True:
+            query = Post.query.options(db.load_only(
+                'id', 'content', 'content_html', 'path', 'post_type'))
+            if post_ids is not None:
+                query = query.filter(Post.id.in_(post_ids))
+            posts = query.filter(Post.id > last_id)\
+                         .order_by(Post.id).limit(batch_size).all()
+            if not posts:
+                break
+
+            old_html = {post.id: post.content_html for post in posts}
+            args = [render_args(post) for post in posts]
+            results = pool.map(render, args) if pool \
+                else [render(arg) for arg in args]
+            now = datetime.datetime.utcnow()
+            changed = [{'post_id': post_id, 'html': html, 'updated': now}
+                       for post_id, html in results
+                       if html != old_html[post_id]]
+
+            # the posts were only read; release them before writing
+            # behind the session's back
+            last_id = posts[-1].id
+            db.session.rollback()
+            if changed:
+                db.session.execute(update, changed)
+                db.session.commit()
+
+            write_checkpoint(checkpoint, last_id)
+            stats['posts'] += len(posts)
+            stats['changed'] += len(changed)
+            elapsed = time.time() - start
+            app.logger.info(
+                'rerendered %d posts (%d changed) in %.1fs, %.1f posts/s',
+                stats['posts'], stats['changed'], elapsed,
+                stats['posts'] / elapsed if elapsed else 0)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    if stats['changed']:
+        cache.invalidate('all')
+    stats['seconds'] = time.time() - start
+    return stats
+
+
+def do_rerender_posts(post_ids=None, processes=None, checkpoint=None):
+    """Queued job wrapper for rerender_posts. A retried job resumes
+    from its checkpoint.
+    """
+    return rerender_posts(post_ids, processes=processes,
+                          checkpoint=checkpoint)
+
+
+def posts_containing(texts):
+    """Ids of posts whose markdown contains any of these strings,
+    ignoring case. Underscores in them match any character (they are
+    LIKE wildcards), which can only add to the posts found.
+    """
+    texts = [text for text in texts if text]
+    if not texts:
+        return []
+    return [post_id for post_id, in db.session.query(Post.id).filter(
+        db.or_(*[db.func.lower(Post.content).like('%' + text.lower() + '%')
+                 for text in texts]))]
+
+
+def rerender_contact_posts(nicks, names=()):
+    """Queue a rerender of the posts that mention a contact, after it
+    has been changed or deleted. nicks are its nicks from before and
+    after the change, names its full names (for legacy [[Name]]s).
+    """
+    post_ids = posts_containing(['@' + nick for nick in nicks if nick]
+                                + ['[[' + name for name in names if name])
+    if post_ids:
+        app.logger.debug('queueing rerender of %d posts', len(post_ids))
+        queue.enqueue(do_rerender_posts, sorted(post_ids), processes=1)
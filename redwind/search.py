@@ -0,0 +1,237 @@
+"""
+Full-text search over post titles and content. Postgres keeps a
+stored tsvector column on post with a GIN index; SQLite keeps an FTS5
+table, post_search, whose rowids are post ids. Either way the index is
+created along with the post table, and is kept up to date by calling
+index_post and unindex_post whenever a post is saved or deleted.
+
+SQLite builds without FTS5 get no index at all; search_posts falls
+back to LIKE queries there, which is slow but works.
+"""
+from . import app
+from . import db
+from .models import Post
+import html
+import re
+import sqlalchemy
+import time
+
+# markers for the start and end of a match in snippets, replaced with
+# <mark> tags once the rest of the snippet has been escaped
+START_MATCH = '\x02'
+END_MATCH = '\x03'
+SNIPPET_WORDS = 24
+
+PG_VECTOR = ("setweight(to_tsvector('english', coalesce(post.title, '')), 'A')"
+             " || setweight(to_tsvector('english', "
+             "coalesce(post.content, '')), 'B')")
+
+CREATE_INDEX = [
+    sqlalchemy.DDL(
+        'ALTER TABLE post ADD COLUMN search_vector tsvector'
+    ).execute_if(dialect='postgresql'),
+    sqlalchemy.DDL(
+        'CREATE INDEX ix_post_search_vector ON post USING gin(search_vector)'
+    ).execute_if(dialect='postgresql'),
+    sqlalchemy.DDL(
+        "CREATE VIRTUAL TABLE post_search USING fts5("
+        "title, content, tokenize='porter unicode61')"
+    ).execute_if(dialect='sqlite',
+                 callable_=lambda ddl, target, bind, **kw:
+                 fts5_available(bind)),
+]
+DROP_INDEX = sqlalchemy.DDL(
+    'DROP TABLE IF EXISTS post_search').execute_if(dialect='sqlite')
+
+for ddl in CREATE_INDEX:
+    sqlalchemy.event.listen(Post.__table__, 'after_create', ddl)
+sqlalchemy.event.listen(Post.__table__, 'before_drop', DROP_INDEX)
+
+post_search = sqlalchemy.table(
+    'post_search', sqlalchemy.column('rowid'), sqlalchemy.column('title'),
+    sqlalchemy.column('content'))
+
+
+def is_postgres():
+    return db.engine.name == 'postgresql'
+
+
+def fts5_available(bind):
+    """Whether the sqlite library was compiled with FTS5. Checked
+    once per process, since it doesn't depend on the database.
+    """
+    if not hasattr(fts5_available, 'cached'):
+        options = [option for option, in
+                   bind.execute('PRAGMA compile_options')]
+        fts5_available.cached = 'ENABLE_FTS5' in options
+        if not fts5_available.cached:
+            app.logger.warn('sqlite was built without FTS5, search will '
+                            'fall back to slow LIKE queries')
+    return fts5_available.cached
+
+
+def use_fts5():
+    return not is_postgres() and fts5_available(db.engine)
+
+
+def create_index():
+    """Add the search index to an existing database. (db.create_all
+    creates it along with the post table.)
+    """
+    for ddl in CREATE_INDEX:
+        ddl.execute(bind=db.engine, target=Post.__table__)
+
+
+def index_post(post):
+    """Add or refresh one post in the index. Deleted posts are
+    removed. Call after committing the post.
+    """
+    if post.deleted:
+        return unindex_post(post.id)
+    if is_postgres():
+        db.session.execute(
+            'UPDATE post SET search_vector = ' + PG_VECTOR
+            + ' WHERE id = :id', {'id': post.id})
+    elif use_fts5():
+        db.session.execute(post_search.delete().where(
+            post_search.c.rowid == post.id))
+        db.session.execute(post_search.insert().values(
+            rowid=post.id, title=post.title or '',
+            content=post.content or ''))
+    db.session.commit()
+
+
+def unindex_post(post_id):
+    if is_postgres():
+        db.session.execute('UPDATE post SET search_vector = NULL '
+                           'WHERE id = :id', {'id': post_id})
+    elif use_fts5():
+        db.session.execute(post_search.delete().where(
+            post_search.c.rowid == post_id))
+    db.session.commit()
+
+
+def reindex_all(batch_size=1000):
+    """Rebuild the whole index, batch_size posts per transaction.
+    Returns the number of posts indexed.
+    """
+    if not is_postgres() and not use_fts5():
+        return 0
+    start = time.time()
+    last_id = count = 0
+    if not is_postgres():
+        db.session.execute(post_search.delete())
+    while True:
+        ids = [post_id for post_id, in db.session.query(Post.id)
+               .filter(Post.id > last_id, Post.deleted == False)
+               .order_by(Post.id).limit(batch_size)]
+        if not ids:
+            break
+        if is_postgres():
+            db.session.execute(
+                'UPDATE post SET search_vector = ' + PG_VECTOR
+                + ' WHERE id >= :first AND id <= :last AND NOT deleted',
+                {'first': ids[0], 'last': ids[-1]})
+        else:
+            db.session.execute(post_search.insert().from_select(
+                ['rowid', 'title', 'content'],
+                sqlalchemy.select([
+                    Post.id, sqlalchemy.func.coalesce(Post.title, ''),
+                    sqlalchemy.func.coalesce(Post.content, '')])
+                .where(Post.id.in_(ids))))
+        db.session.commit()
+        last_id = ids[-1]
+        count += len(ids)
+        app.logger.info('indexed %d posts, %.1f posts/s', count,
+                        count / max(time.time() - start, 0.001))
+    db.session.commit()
+    return count
+
+
+def fts_query(q):
+    """Quote each word of a free-text query, so FTS5 matches posts
+    containing all of them (like plainto_tsquery) instead of parsing
+    the query syntax.
+    """
+    words = re.findall(r'\w+', q)
+    return ' '.join('"{}"'.format(word) for word in words)
+
+
+def format_snippet(snippet):
+    return html.escape(snippet or '')\
+               .replace(START_MATCH, '<mark>')\
+               .replace(END_MATCH, '</mark>')
+
+
+def like_snippet(content, words):
+    """Cut SNIPPET_WORDS words of content around the first match, with
+    the matches marked, the way snippet() would for FTS5.
+    """
+    tokens = (content or '').split()
+    pattern = re.compile('|'.join(re.escape(word) for word in words),
+                         re.IGNORECASE)
+    first = next((ii for ii, token in enumerate(tokens)
+                  if pattern.search(token)), 0)
+    start = max(0, first - SNIPPET_WORDS // 2)
+    snippet = ' '.join(tokens[start:start + SNIPPET_WORDS])
+    snippet = pattern.sub(
+        lambda m: START_MATCH + m.group(0) + END_MATCH, snippet)
+    if start > 0:
+        snippet = '…' + snippet
+    if start + SNIPPET_WORDS < len(tokens):
+        snippet += '…'
+    return snippet
+
+
+def search_posts(q, query=None, limit=20, offset=0):
+    """Find posts matching all the words in q, best match first.
+    query (default Post.query) can be used to narrow down the posts
+    that are considered. Returns a list of (post, snippet) where
+    snippet is a piece of the content with matches in <mark> tags.
+    """
+    if query is None:
+        query = Post.query
+    if is_postgres():
+        tsquery = sqlalchemy.func.plainto_tsquery('english', q)
+        vector = sqlalchemy.literal_column('post.search_vector')
+        rank = sqlalchemy.func.ts_rank_cd(vector, tsquery)
+        matches = query.with_entities(Post.id.label('id'),
+                                      rank.label('rank'))\
+            .filter(vector.op('@@')(tsquery))\
+            .order_by(rank.desc(), Post.id.desc())\
+            .limit(limit).offset(offset).subquery()
+        # only build headlines for the page of results
+        headline = sqlalchemy.func.ts_headline(
+            'english', sqlalchemy.func.coalesce(Post.content, ''), tsquery,
+            'StartSel={}, StopSel={}, MaxWords={}, MinWords={}'.format(
+                START_MATCH, END_MATCH, SNIPPET_WORDS, SNIPPET_WORDS // 2))
+        rows = db.session.query(Post, headline)\
+            .join(matches, matches.c.id == Post.id)\
+            .order_by(matches.c.rank.desc(), Post.id.desc())
+    elif not use_fts5():
+        words = re.findall(r'\w+', q)
+        if not words:
+            return []
+        for word in words:
+            like = '%{}%'.format(word.replace('_', r'\_'))
+            query = query.filter(sqlalchemy.or_(
+                Post.title.ilike(like, escape='\\'),
+                Post.content.ilike(like, escape='\\')))
+        posts = query.order_by(Post.id.desc()).limit(limit).offset(offset)
+        return [(post, format_snippet(like_snippet(post.content, words)))
+                for post in posts]
+    else:
+        words = fts_query(q)
+        if not words:
+            return []
+        fts = sqlalchemy.literal_column('post_search')
+        # titles count for ten times as much as the content
+        rank = sqlalchemy.func.bm25(fts, 10.0, 1.0)
+        snippet = sqlalchemy.func.snippet(fts, 1, START_MATCH, END_MATCH,
+                                          '…', SNIPPET_WORDS)
+        rows = query.join(post_search, post_search.c.rowid == Post.id)\
+            .filter(fts.op('MATCH')(words))\
+            .add_columns(snippet)\
+            .order_by(rank, Post.id.desc())\
+            .limit(limit).offset(offset)
+    return [(post, format_snippet(snippet)) for post, snippet in rows]
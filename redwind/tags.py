@@ -0,0 +1,126 @@
+"""
+Per-tag statistics (see models.TagStat), so that the tag cloud and the
+editor's tag suggestions don't have to aggregate every post. Scores
+are frecency: each post adds 2 ** (its age in half-lives), measured
+from a reference time that all rows share and that decay_tag_scores
+periodically moves forward.
+"""
+from . import app
+from . import db
+from . import queue
+from .models import Post, Tag, TagStat, posts_to_tags
+import datetime
+import time
+
+
+def half_life():
+    return datetime.timedelta(days=app.config.get('TAG_SCORE_HALF_LIFE', 30))
+
+
+def weight(published, reference):
+    """A post's contribution to a score measured at `reference`"""
+    if not published:
+        return 0.0
+    return 2 ** ((published - reference) / half_life())
+
+
+def reference_time():
+    return db.session.query(db.func.max(TagStat.decayed_at)).scalar() \
+        or datetime.datetime.utcnow()
+
+
+def update_tag_stats(tag_ids=None):
+    """Recompute the stats for these tags (or for every tag) from their
+    posts. Call after committing a change to which tags a post has, or
+    to whether a tagged post is deleted, a draft, or restricted to an
+    audience.
+    """
+    query = db.session.query(
+        posts_to_tags.c.tag_id, Post.published, Post.draft, Post.audience)\
+        .join(Post, Post.id == posts_to_tags.c.post_id)\
+        .filter(Post.deleted == False)
+    stats = TagStat.query
+    if tag_ids is None:
+        tag_ids = [tag_id for tag_id, in db.session.query(Tag.id)]
+    else:
+        tag_ids = [tag_id for tag_id in set(tag_ids) if tag_id]
+        if not tag_ids:
+            return
+        query = query.filter(posts_to_tags.c.tag_id.in_(tag_ids))
+        stats = stats.filter(TagStat.tag_id.in_(tag_ids))
+
+    reference = reference_time()
+    stats = {stat.tag_id: stat for stat in stats}
+    for tag_id in tag_ids:
+        stat = stats.get(tag_id)
+        if not stat:
+            stat = stats[tag_id] = TagStat(tag_id)
+            db.session.add(stat)
+        stat.count = stat.public_count = 0
+        stat.score = 0.0
+        stat.decayed_at = reference
+
+    for tag_id, published, draft, audience in query:
+        stat = stats[tag_id]
+        stat.count += 1
+        if not draft and not audience:
+            stat.public_count += 1
+        stat.score += weight(published, reference)
+    db.session.commit()
+
+
+def decay_tag_scores():
+    """Queued job: move every score's reference time up to now, so the
+    scores stay in a sensible range
+    """
+    now = datetime.datetime.utcnow()
+    for stat in TagStat.query:
+        if stat.decayed_at:
+            stat.score *= weight(stat.decayed_at, now)
+        stat.decayed_at = now
+    db.session.commit()
+
+
+def schedule_decay():
+    """Queue decay_tag_scores if it hasn't run for TAG_DECAY_INTERVAL
+    seconds (and this process hasn't just queued it)
+    """
+    interval = app.config.get('TAG_DECAY_INTERVAL', 86400)
+    now = time.time()
+    if now - schedule_decay.queued < interval:
+        return
+    decayed_at = db.session.query(db.func.max(TagStat.decayed_at)).scalar()
+    age = decayed_at and datetime.datetime.utcnow() - decayed_at
+    if age and age.total_seconds() > interval:
+        schedule_decay.queued = now
+        queue.enqueue(decay_tag_scores)
+
+schedule_decay.queued = 0
+
+
+def tag_counts(public=True, min_count=1):
+    """[(name, count)] of tags used by at least min_count posts,
+    counting only public posts if public is True, ordered by name
+    """
+    column = TagStat.public_count if public else TagStat.count
+    return db.session.query(Tag.name, column)\
+                     .join(TagStat, TagStat.tag_id == Tag.id)\
+                     .filter(column >= min_count)\
+                     .order_by(Tag.name).all()
+
+
+def top_tags(n=10):
+    """The names of the n tags with the highest frecency"""
+    schedule_decay()
+    return [name for name, in db.session.query(Tag.name)
+            .join(TagStat, TagStat.tag_id == Tag.id)
+            .filter(TagStat.count > 0)
+            .order_by(TagStat.score.desc()).limit(n)]
+
+
+def tag_names():
+    """The names of all tags in use"""
+    return [name for name, in db.session.query(Tag.name)
+            .join(TagStat, TagStat.tag_id == Tag.id)
+            .filter(TagStat.count > 0)
+            .order_by(Tag.name)]
@@ -2,19 +2,24 @@ from . import app
 from datetime import date
 from flask import url_for, current_app
 from flask.ext.themes2 import render_theme_template, get_theme
-from markdown import markdown
 from smartypants import smartyPants
 import bleach
 import bs4
 import codecs
+import collections
 import datetime
+import html
 import jwt
+import markdown
 import os
 import os.path
 import random
 import re
 import requests
+import requests.adapters
 import shutil
+import threading
+import time
 import unicodedata
 import urllib
 import hmac
@@ -160,68 +165,145 @@ def person_to_microcard(contact, nick, soup):
     return a_tag
 
 
+AUTOLINK_BLACKLIST = ('a', 'script', 'style', 'pre', 'code', 'embed',
+                      'object', 'audio', 'video')
+# elements whose contents are raw text rather than markup
+RAW_TEXT_TAGS = ('script', 'style')
+HTML_TOKEN_RE = re.compile(
+    r'<!--.*?-->|<![^>]*>|<\?[^>]*>'
+    r'|<(/?)([a-zA-Z][a-zA-Z0-9:\-]*)(?:[^>"\']|"[^"]*"|\'[^\']*\')*>',
+    re.DOTALL)
+
+
+def tokenize_html(doc):
+    """Split an HTML fragment into text runs and markup, without parsing
+    it into a tree. Yields (text, markup, tag, closing) tuples: text is
+    set for text runs, markup for everything else. tag is the lowercase
+    name of an element's start or end tag (None for comments etc.)
+    and closing is True for end tags.
+    """
+    pos = 0
+    length = len(doc)
+    while pos < length:
+        m = HTML_TOKEN_RE.search(doc, pos)
+        if not m:
+            yield doc[pos:], None, None, False
+            return
+        if m.start() > pos:
+            yield doc[pos:m.start()], None, None, False
+        tag = m.group(2) and m.group(2).lower()
+        closing = bool(m.group(1))
+        pos = m.end()
+        if tag in RAW_TEXT_TAGS and not closing:
+            # pass <script> and <style> bodies through untouched, even
+            # if they happen to contain something that looks like a tag
+            end = re.compile('</' + tag + r'\s*>', re.IGNORECASE).search(
+                doc, pos)
+            body_end = end.start() if end else length
+            yield None, m.group(0) + doc[pos:body_end], tag, False
+            if end:
+                yield None, end.group(0), tag, True
+            pos = end.end() if end else length
+            continue
+        yield None, m.group(0), tag, closing
+
+
+class Markup(str):
+    """A string that autolink emits verbatim instead of escaping"""
+
+
+def get_tag_factory():
+    """An empty BeautifulSoup document, used only to create new tags
+    for the autolink url and person processors.
+    """
+    if not hasattr(get_tag_factory, 'soup'):
+        get_tag_factory.soup = bs4.BeautifulSoup('')
+    return get_tag_factory.soup
+
+
 def autolink(plain, url_processor=url_to_link,
              person_processor=person_to_microcard):
     """Replace bare URLs in a document with an HTML <a> representation
+
+    The document is tokenized rather than parsed: markup is copied to
+    the output as is, and only text outside of AUTOLINK_BLACKLIST
+    elements is rewritten. Processors may return a bs4 Tag or a string
+    of markup.
     """
-    blacklist = ('a', 'script', 'pre', 'code', 'embed', 'object',
-                      'audio', 'video')
-    soup = bs4.BeautifulSoup(plain)
-
-    def bs4_sub(regex, repl):
-        """Process text elements in a BeautifulSoup document with a regex and
-        replacement string.
-
-        :param BeautifulSoup soup: the BeautifulSoup document to be
-         edited in place
-        :param string regex: a regular expression whose matches will
-         be replaced
-        :param function repl: a function that a Match object, and
-         returns text or a new HTML node
-        :param list blacklist: a list of tags whose children should
-         not be modified (<pre> for example)
+    soup = get_tag_factory()
+
+    def to_markup(node):
+        return node if isinstance(node, Markup) else Markup(str(node))
+
+    def split(text, regex, repl):
+        """Split a text run around the matches of regex, replacing each
+        match with repl(m) (a Markup string, or plain text)
         """
-        for txt in soup.find_all(text=True):
-            if any(p.name in blacklist for p in txt.parents):
-                continue
-            nodes = []
-            start = 0
-            for m in regex.finditer(txt):
-                nodes.append(txt[start:m.start()])
-                nodes.append(repl(m))
-                start = m.end()
-            if not nodes:
-                continue
-            nodes.append(txt[start:])
-            parent = txt.parent
-            ii = parent.contents.index(txt)
-            txt.extract()
-            for offset, node in enumerate(nodes):
-                parent.insert(ii + offset, node)
+        parts = []
+        start = 0
+        for m in regex.finditer(text):
+            parts.append(text[start:m.start()])
+            parts.append(repl(m))
+            start = m.end()
+        if not parts:
+            return [text]
+        parts.append(text[start:])
+        return parts
 
     def link_repl(m):
         url = (m.group(1) or 'http://') + m.group(2)
-        return url_processor(url, soup)
+        return to_markup(url_processor(url, soup))
 
     def process_nick(m):
-        from . import db
-        from .models import Nick
         name = m.group(1)
-        nick = Nick.query.filter(
-            db.func.lower(Nick.name) == db.func.lower(name)).first()
-        contact = nick and nick.contact
+        contact = contacts.get(name.lower())
         processed = person_processor(contact, name, soup)
         if processed:
-            return processed
+            return to_markup(processed)
         return m.group(0)
 
-    if url_processor:
-        bs4_sub(LINK_RE, link_repl)
+    # first pass: split text runs around links, and leave everything
+    # else alone. runs is a list of either Markup or lists of parts
+    runs = []
+    depth = 0
+    for text, markup, tag, closing in tokenize_html(plain or ''):
+        if text is None:
+            if tag in AUTOLINK_BLACKLIST:
+                if closing:
+                    depth = max(depth - 1, 0)
+                elif not markup.endswith('/>'):
+                    depth += 1
+            runs.append(Markup(markup))
+        elif depth:
+            runs.append(Markup(text))
+        else:
+            text = html.unescape(text) if '&' in text else text
+            runs.append(split(text, LINK_RE, link_repl)
+                        if url_processor else [text])
 
     if person_processor:
-        bs4_sub(AT_USERNAME_RE, process_nick)
-
-    return ''.join(str(t) for t in soup.body.contents) if soup.body else ''
+        # look up every @name in the document at once
+        contacts = resolve_nicks(
+            m.group(1) for run in runs if not isinstance(run, Markup)
+            for part in run if not isinstance(part, Markup)
+            for m in AT_USERNAME_RE.finditer(part))
+
+    result = []
+    for run in runs:
+        if isinstance(run, Markup):
+            result.append(run)
+            continue
+        for part in run:
+            if isinstance(part, Markup):
+                result.append(part)
+                continue
+            if person_processor:
+                part = split(part, AT_USERNAME_RE, process_nick)
+            else:
+                part = [part]
+            result.extend(p if isinstance(p, Markup)
+                          else html.escape(p, quote=False) for p in part)
+    return ''.join(result)
 
 
 TAG_TO_TYPE = {
@@ -349,38 +431,158 @@ def construct_imageproxy_url(src, side=None):
     return pilbox_url + '?' + qs
 
 
+MARKDOWN_EXTENSIONS = ('codehilite', 'fenced_code')
+
+
+def get_markdown(extensions=MARKDOWN_EXTENSIONS):
+    """A Markdown instance for this set of extensions, reused between
+    calls. Markdown objects aren't thread-safe, so each thread has its
+    own.
+    """
+    instances = get_markdown.local.__dict__.setdefault('instances', {})
+    md = instances.get(extensions)
+    if md is None:
+        md = instances[extensions] = markdown.Markdown(
+            extensions=list(extensions))
+    return md.reset()
+
+get_markdown.local = threading.local()
+
+
+def _processor_name(processor):
+    return processor and '{}.{}'.format(processor.__module__,
+                                        processor.__qualname__)
+
+
 def markdown_filter(data, img_path=None, url_processor=url_to_link,
                     person_processor=person_to_microcard):
+    """Render markdown to HTML, autolinking URLs and @names with the
+    given processors. Results are cached by content and options in the
+    'markdown' cache namespace, which is invalidated with contacts;
+    renders that resolve people are kept no longer than the contacts
+    they were made from (CONTACT_CACHE_TIMEOUT).
+    """
+    from . import cache
     if data is None:
         return ''
 
+    key = 'markdown:' + hashlib.sha1('\0'.join((
+        data, img_path or '', _processor_name(url_processor) or '',
+        _processor_name(person_processor) or '',
+        ','.join(MARKDOWN_EXTENSIONS))).encode()).hexdigest()
+    result = cache.get(key, ['markdown'])
+    if result is not None:
+        return result
+
     if img_path:
         # replace relative paths to images with absolute
         data = RELATIVE_PATH_RE.sub('[\g<1>](' + img_path + '/\g<2>)', data)
 
     data = convert_legacy_people_to_at_names(data)
-    result = markdown(data, extensions=['codehilite', 'fenced_code'])
+    result = get_markdown().convert(data)
     if url_processor or person_processor:
         result = autolink(result, url_processor, person_processor)
     result = smartyPants(result)
+    timeout = app.config.get('MARKDOWN_CACHE_TIMEOUT', 3600)
+    if person_processor:
+        timeout = min(timeout, app.config.get('CONTACT_CACHE_TIMEOUT', 300))
+    cache.set(key, result, ['markdown'], timeout)
     return result
 
 
 def convert_legacy_people_to_at_names(data):
-    from .models import Contact
+    contacts = resolve_contact_names(
+        m.group(1) for m in PEOPLE_RE.finditer(data))
 
     def process_name(m):
         fullname = m.group(1)
         displayname = m.group(2)
-        contact = Contact.query.filter_by(name=fullname).first()
+        contact = contacts.get(fullname)
         if contact and contact.nicks:
-            return '@' + contact.nicks[0].name
+            return '@' + contact.nicks[0]
         return '@' + displayname
 
     data = PEOPLE_RE.sub(process_name, data)
     return data
 
 
+class ContactSnapshot(collections.namedtuple(
+        'ContactSnapshot', 'id name url image social nicks')):
+    """Read-only copy of a Contact (and its nick names) that can be
+    shared between requests
+    """
+    @classmethod
+    def from_contact(cls, contact):
+        return cls(contact.id, contact.name, contact.url, contact.image,
+                   dict(contact.social or {}),
+                   tuple(nick.name for nick in contact.nicks))
+
+
+def _resolve_contacts(keys, prefix, query_fn):
+    """Look keys up in the 'contacts' cache namespace, then fetch the
+    rest with a single query_fn(missing) -> {key: Contact}. Unknown
+    keys are cached as False so they aren't queried again.
+    """
+    from . import cache
+    keys = list(set(keys))
+    if not keys:
+        return {}
+    cached = cache.get_many([prefix + key for key in keys], ['contacts'])
+    result = dict(zip(keys, cached))
+    missing = [key for key, value in result.items() if value is None]
+    if missing:
+        found = query_fn(missing)
+        for key in missing:
+            contact = found.get(key)
+            result[key] = contact and ContactSnapshot.from_contact(contact)
+        cache.set_many({prefix + key: result[key] or False
+                        for key in missing}, ['contacts'],
+                       app.config.get('CONTACT_CACHE_TIMEOUT', 300))
+    return {key: value for key, value in result.items() if value}
+
+
+def resolve_nicks(names):
+    """Map lowercased nick -> ContactSnapshot for each of these names
+    that belongs to a contact
+    """
+    from . import db
+    from .models import Nick, Contact
+
+    def query(missing):
+        return {nick.name.lower(): nick.contact for nick in Nick.query
+                .options(db.joinedload(Nick.contact)
+                         .joinedload(Contact.nicks))
+                .filter(db.func.lower(Nick.name).in_(missing))}
+
+    return _resolve_contacts((name.lower() for name in names),
+                             'nick:', query)
+
+
+def resolve_contact_names(names):
+    """Map full name -> ContactSnapshot for each contact with one of
+    these names
+    """
+    from . import db
+    from .models import Contact
+
+    def query(missing):
+        contacts = {}
+        for contact in Contact.query.options(db.joinedload(Contact.nicks))\
+                                    .filter(Contact.name.in_(missing))\
+                                    .order_by(Contact.id):
+            contacts.setdefault(contact.name, contact)
+        return contacts
+
+    return _resolve_contacts(names, 'contact:', query)
+
+
+def invalidate_contacts():
+    """Call after contacts or their nicks change
+    """
+    from . import cache
+    cache.invalidate('contacts', 'markdown')
+
+
 def format_as_text(html, link_fn=None):
     if html is None:
         return ''
@@ -421,21 +623,90 @@ def prettify_url(url):
     return path
 
 
-def fetch_html(url):
-    """Utility to fetch HTML from an external site. If the Content-Type
-    header does not explicitly list a charset, Requests will assume a
-    bad one, so we ahve to use 'get_encodings_from_content` to find
-    the meta charset or other indications in the actual response body.
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
 
-    Return a requests.Response
+
+class FetchError(requests.RequestException):
+    """fetch_html refused a response because of its content type or
+    size
+    """
+
+
+def get_http_session():
+    """The keep-alive session shared by every fetch of an external
+    page. Connections are pooled per host.
     """
-    response = requests.get(url, timeout=30)
-    if response.status_code // 2 == 100:
+    if not get_http_session.cached:
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=app.config.get('FETCH_POOL_HOSTS', 32),
+            pool_maxsize=app.config.get('FETCH_POOL_SIZE', 4))
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['User-Agent'] = app.config.get(
+            'FETCH_USER_AGENT', 'redwind')
+        get_http_session.cached = session
+    return get_http_session.cached
+
+get_http_session.cached = None
+
+
+def fetch_html(url, headers=None, content_types=HTML_CONTENT_TYPES):
+    """Utility to fetch HTML from an external site. The body is streamed
+    with a hard cap of FETCH_MAX_BYTES, whether or not the server sends
+    Content-Length, and successful responses must have one of
+    `content_types` (matched as prefixes). Raises FetchError if the
+    response is refused.
+
+    If the Content-Type header does not explicitly list a charset,
+    Requests will assume a bad one, so we sniff the meta charset from
+    the first few KB of the body.
+
+    Return a requests.Response with its content already read
+    """
+    max_bytes = app.config.get('FETCH_MAX_BYTES', 2097152)
+    deadline = time.time() + app.config.get('FETCH_MAX_TIME', 60)
+    response = get_http_session().get(
+        url, stream=True, headers=headers or {},
+        timeout=(app.config.get('FETCH_CONNECT_TIMEOUT', 5),
+                 app.config.get('FETCH_READ_TIMEOUT', 30)))
+    try:
+        ok = response.status_code // 100 == 2
+        content_type = response.headers.get('content-type', '')
+        media_type = content_type.split(';')[0].strip().lower()
+        if ok and media_type and content_types \
+                and not media_type.startswith(tuple(content_types)):
+            raise FetchError('Content type {} is not allowed for {}'
+                             .format(media_type, url), response=response)
+
+        length = response.headers.get('content-length')
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise FetchError('Content length {} is too large for {}'
+                             .format(length, url), response=response)
+
+        # joined once at the end; adding to bytes copies it every time
+        chunks = []
+        received = 0
+        for chunk in response.iter_content(16384):
+            chunks.append(chunk)
+            received += len(chunk)
+            if received > max_bytes:
+                raise FetchError('Content length {} is too large for {}'
+                                 .format(received, url), response=response)
+            if time.time() > deadline:
+                raise FetchError('Timed out reading {}'.format(url),
+                                 response=response)
+    finally:
+        response.close()
+
+    body = response._content = b''.join(chunks)
+    response._content_consumed = True
+    if ok:
         # requests ignores <meta charset> when a Content-Type header
         # is provided, even if the header does not define a charset
-        if 'charset' not in response.headers.get('content-type', ''):
+        if 'charset' not in content_type:
             encodings = requests.utils.get_encodings_from_content(
-                response.text)
+                body[:4096].decode('ascii', 'replace'))
             if encodings:
                 response.encoding = encodings[0]
     else:
@@ -444,6 +715,43 @@ def fetch_html(url):
     return response
 
 
+class SharedSoup(bs4.BeautifulSoup):
+    """mf2py deep-copies any tree it is given, which costs about as
+    much as parsing the document again. The only change it makes is
+    to drop <template> elements, so let it work on our tree directly.
+    """
+    def __deepcopy__(self, memo):
+        return self
+
+
+class HtmlDocument:
+    """A fetched page that is decoded and parsed exactly once. Link
+    checks, mf2 parsing, and text extraction all share the same tree.
+    """
+    def __init__(self, text, url=None):
+        self.text = text
+        self.url = url
+        self.soup = SharedSoup(text)
+        self._mf2 = None
+
+    @classmethod
+    def from_response(cls, response, url=None):
+        # response.text decodes the whole body on every access
+        return cls(response.text, url or response.url)
+
+    def find_links(self, urls):
+        """Return the first <a> or <link> whose href is one of urls
+        """
+        for link in self.soup.find_all(['a', 'link']):
+            if link.get('href') in urls:
+                return link
+
+    def to_mf2(self):
+        if self._mf2 is None:
+            self._mf2 = mf2py.Parser(doc=self.soup, url=self.url).to_dict()
+        return self._mf2
+
+
 def clean_foreign_html(html):
     return bleach.clean(html, strip=True)
 
@@ -475,7 +783,9 @@ def posse_post_discovery(post, regex):
         if regex.match(original):
             return original
         try:
-            d = mf2py.Parser(url=original).to_dict()
+            response = fetch_html(original)
+            response.raise_for_status()
+            d = HtmlDocument.from_response(response).to_mf2()
             urls = d['rels'].get('syndication', [])
             for item in d['items']:
                 if 'h-entry' in item['type']:
@@ -1,12 +1,19 @@
 from . import app
 from . import auth
+from . import cache
 from . import contexts
 from . import db
 from . import hooks
+from . import images
 from . import maps
+from . import queue
+from . import rerender
+from . import search as search_index
+from . import tags as tag_stats
 from . import util
 from .models import Post, Tag, Mention, Contact, Nick, Setting,\
-    Venue, get_settings
+    Venue, get_settings, invalidate_settings, posts_to_mentions,\
+    group_mentions
 
 from flask import request, redirect, url_for, render_template, flash, g,\
     abort, make_response, Markup, send_from_directory, session, current_app
@@ -20,6 +27,7 @@ import sqlalchemy
 import bs4
 import collections
 import datetime
+import functools
 import hashlib
 import json
 import mf2util
@@ -51,6 +59,23 @@ BEFORE_TS_FORMAT = '%Y%m%d%H%M%S'
 
 AUTHOR_PLACEHOLDER = 'img/users/placeholder.png'
 
+# response headers that are safe to replay from the listing cache
+CACHED_HEADERS = ('Content-Type', 'Link')
+# the only query string arguments a stream page depends on; anything
+# else is left out of its links and its cache key
+LISTING_ARGS = ('feed',)
+
+# Cache-Control for anonymous visitors by kind of page (CACHE_CONTROL
+# in the config overrides these). The admin's pages are private
+CACHE_CONTROL = {
+    'listing': 'public, max-age=60',
+    'feed': 'public, max-age=300',
+    'post': 'public, max-age=60',
+    'file': 'public, max-age=86400',
+    # the files of drafts and of posts with an audience
+    'private_file': 'private, max-age=86400',
+}
+
 
 @app.context_processor
 def inject_settings_variable():
@@ -59,59 +84,185 @@ def inject_settings_variable():
     }
 
 
-def collect_posts(post_types, before_ts, per_page, tag, search=None,
-                  include_hidden=False):
+def stream_query(post_types, before_ts, tag, include_hidden=False):
+    """The posts of a stream after the before_ts cursor, newest first.
+    Pages are keyed on (published, id) of the last post of the previous
+    page, so each page is a single index range scan no matter how deep
+    it is.
+    """
     query = Post.query
-    query = query.options(
-        sqlalchemy.orm.subqueryload(Post.tags),
-        sqlalchemy.orm.subqueryload(Post.mentions),
-        sqlalchemy.orm.subqueryload(Post.reply_contexts),
-        sqlalchemy.orm.subqueryload(Post.repost_contexts),
-        sqlalchemy.orm.subqueryload(Post.like_contexts),
-        sqlalchemy.orm.subqueryload(Post.bookmark_contexts))
     if tag:
         query = query.filter(Post.tags.any(Tag.name == tag))
+    query = query.filter_by(deleted=False, draft=False)
     if not include_hidden:
         query = query.filter_by(hidden=False)
-    query = query.filter_by(deleted=False, draft=False)
     if post_types:
         query = query.filter(Post.post_type.in_(post_types))
-    if search:
-        query = query.filter(
-            sqlalchemy.func.concat(Post.title, ' ', Post.content)
-            .op('@@')(sqlalchemy.func.plainto_tsquery(search)))
 
-    try:
-        if before_ts:
-            # convert ts in local timezone to utc and re-remove the timezone
-            before_dt = datetime.datetime.strptime(before_ts, BEFORE_TS_FORMAT)\
-                                         .replace(tzinfo=TIMEZONE)\
-                                         .astimezone(datetime.timezone.utc)\
-                                         .replace(tzinfo=None)
-            query = query.filter(Post.published < before_dt)
-    except ValueError:
-        app.logger.warn('Could not parse before timestamp: %s', before_ts)
+    audience = audience_filter()
+    if audience is not None:
+        query = query.filter(audience)
+
+    before_dt, before_id = parse_before_ts(before_ts)
+    if before_dt and before_id:
+        query = query.filter(sqlalchemy.or_(
+            Post.published < before_dt,
+            sqlalchemy.and_(Post.published == before_dt,
+                            Post.id < before_id)))
+    elif before_dt:
+        query = query.filter(Post.published < before_dt)
 
-    query = query.order_by(Post.published.desc())
-    query = query.limit(per_page)
-    posts = query.all()
+    return query.order_by(Post.published.desc(), Post.id.desc())
 
-    posts = [post for post in posts if check_audience(post)]
-    if posts:
-        last_ts = posts[-1].published\
-                           .replace(tzinfo=datetime.timezone.utc)\
-                           .astimezone(TIMEZONE)\
-                           .strftime(BEFORE_TS_FORMAT)
+
+def collect_posts(post_types, before_ts, per_page, tag,
+                  include_hidden=False):
+    """Fetch one page of the stream, newest first.
+    """
+    rows = stream_query(post_types, before_ts, tag, include_hidden)\
+        .limit(per_page).all()
+
+    # mentions aren't needed; listings show post.response_counts
+    load_collections(rows, ('tags', 'reply_contexts',
+                            'repost_contexts', 'like_contexts',
+                            'bookmark_contexts'))
+    if app.config.get('MENTION_PREVIEWS'):
+        load_mention_previews(rows, app.config['MENTION_PREVIEWS'])
+
+    # audience_filter only approximates the audience for logged-in
+    # guests, so check each post here to be sure
+    posts = [post for post in rows if check_audience(post)]
+    if len(rows) == per_page:
         view_args = request.view_args.copy()
-        view_args['before_ts'] = last_ts
-        for k, v in request.args.items():
-            view_args[k] = v
+        view_args['before_ts'] = format_before_ts(rows[-1])
+        for k in LISTING_ARGS:
+            if k in request.args:
+                view_args[k] = request.args[k]
         older = url_for(request.endpoint, **view_args)
     else:
         older = None
 
     return posts, older
 
+
+def format_before_ts(post):
+    """Build the pagination cursor for the page after `post`: its
+    publish time in the local timezone, followed by its id
+    """
+    local_ts = post.published\
+                   .replace(tzinfo=datetime.timezone.utc)\
+                   .astimezone(TIMEZONE)\
+                   .strftime(BEFORE_TS_FORMAT)
+    return '{}-{}'.format(local_ts, post.id)
+
+
+def parse_before_ts(before_ts):
+    """Parse a pagination cursor into (published, id). Cursors from
+    older links have no id; return (published, None) for those.
+    """
+    if not before_ts:
+        return None, None
+    ts, _, dbid = before_ts.partition('-')
+    try:
+        # convert ts in local timezone to utc and re-remove the timezone
+        before_dt = datetime.datetime.strptime(ts, BEFORE_TS_FORMAT)\
+                                     .replace(tzinfo=TIMEZONE)\
+                                     .astimezone(datetime.timezone.utc)\
+                                     .replace(tzinfo=None)
+    except ValueError:
+        app.logger.warn('Could not parse before timestamp: %s', before_ts)
+        return None, None
+
+    if dbid.isdigit():
+        # the timestamp in the url is truncated to the second; use the
+        # exact publish time of the post it points to
+        published = db.session.query(Post.published)\
+                              .filter(Post.id == int(dbid)).scalar()
+        if published:
+            return published, int(dbid)
+    return before_dt, None
+
+
+def audience_filter():
+    """Push the audience check into SQL. Returns None when the current
+    user can see every post.
+    """
+    if flask_login.current_user.is_authenticated():
+        return None
+    audience = sqlalchemy.type_coerce(Post.audience, db.Text)
+    public = sqlalchemy.or_(Post.audience == None, audience == '[]')
+    if flask_login.current_user.is_anonymous():
+        return public
+    return sqlalchemy.or_(public, audience.like('%{}%'.format(
+        json.dumps(flask_login.current_user.get_id()))))
+
+
+def load_collections(posts, attrs):
+    """Populate the many-to-many collections `attrs` for every post in
+    one query per target table, using `post_id IN (...)` against the
+    association tables instead of re-running the parent query.
+    """
+    if not posts:
+        return
+    by_id = {post.id: post for post in posts}
+    loaded = {(attr, post.id): [] for attr in attrs for post in posts}
+
+    props_by_target = collections.OrderedDict()
+    for attr in attrs:
+        prop = Post.__mapper__.get_property(attr)
+        props_by_target.setdefault(prop.mapper.class_, []).append(
+            (attr, prop))
+
+    for target, props in props_by_target.items():
+        assoc = sqlalchemy.union_all(*[
+            sqlalchemy.select([
+                sqlalchemy.literal(attr).label('attr'),
+                prop.secondary.c.post_id.label('post_id'),
+                next(col for col in prop.secondary.c
+                     if col.name != 'post_id').label('target_id'),
+            ]).where(prop.secondary.c.post_id.in_(list(by_id)))
+            for attr, prop in props]).alias()
+
+        query = db.session.query(assoc.c.attr, assoc.c.post_id, target)\
+                          .join(target, target.id == assoc.c.target_id)
+        if len(props) == 1 and props[0][1].order_by:
+            query = query.order_by(*props[0][1].order_by)
+
+        for attr, post_id, obj in query:
+            loaded[attr, post_id].append(obj)
+
+    for (attr, post_id), objs in loaded.items():
+        sqlalchemy.orm.attributes.set_committed_value(
+            by_id[post_id], attr, objs)
+
+
+def load_mention_previews(posts, limit):
+    """Set post.mention_previews to {reftype: [mention, ...]} with the
+    `limit` most recent mentions of each type (e.g. for facepiles), in
+    one query however many mentions the posts have.
+    """
+    if not posts:
+        return
+    by_id = {post.id: post for post in posts}
+    ranked = sqlalchemy.select([
+        posts_to_mentions.c.post_id,
+        posts_to_mentions.c.mention_id,
+        sqlalchemy.func.row_number().over(
+            partition_by=(posts_to_mentions.c.post_id, Mention.reftype),
+            order_by=(Mention.published.desc(), Mention.id.desc()))
+        .label('rank'),
+    ]).select_from(posts_to_mentions.join(
+        Mention, Mention.id == posts_to_mentions.c.mention_id))\
+        .where(posts_to_mentions.c.post_id.in_(list(by_id))).alias()
+
+    for post in posts:
+        post.mention_previews = collections.defaultdict(list)
+    for post_id, mention in db.session.query(ranked.c.post_id, Mention)\
+            .join(Mention, Mention.id == ranked.c.mention_id)\
+            .filter(ranked.c.rank <= limit)\
+            .order_by(Mention.published.desc(), Mention.id.desc()):
+        by_id[post_id].mention_previews[mention.reftype].append(mention)
+
 # Font sizes in em. Maybe should be configurable
 MIN_TAG_SIZE = 1.0
 MAX_TAG_SIZE = 4.0
@@ -145,14 +296,194 @@ def render_posts(title, posts, older, template='posts.jinja2'):
 
 
 def render_posts_atom(title, feed_id, posts):
+    feed_url = url_for(request.endpoint, feed='atom', _external=True,
+                       **request.view_args)
     return make_response(
         render_template('posts.atom', title=title, feed_id=feed_id,
-                        posts=posts),
+                        feed_url=feed_url, posts=posts),
         200, {'Content-Type': 'application/atom+xml; charset=utf-8'})
 
 
+def listing_viewer_class():
+    """Pages are cached separately for the admin and for anonymous
+    visitors. Returns None if the page for this viewer should not be
+    cached at all (e.g., it will show a flash message, or contains
+    action links for a logged in guest).
+    """
+    if '_flashes' in session or 'action-handlers' in session:
+        return None
+    if flask_login.current_user.is_authenticated():
+        return 'admin'
+    if flask_login.current_user.is_anonymous():
+        return 'anonymous'
+    return None
+
+
+def post_listing_namespaces(post):
+    """The cache namespaces for every listing this post can appear in
+    """
+    namespaces = ['index', 'everything', 'type:' + post.post_type]
+    namespaces += ['tag:' + tag.name for tag in post.tags]
+    return namespaces
+
+
+def invalidate_post_listings(post, *args):
+    cache.invalidate(*post_listing_namespaces(post))
+
+
+def invalidate_all_listings(*args):
+    cache.invalidate('all')
+
+
+def mark_venue_posts_updated(venue):
+    """Bump Post.updated on the posts that show this venue, so that
+    their validators change along with it. Call before committing.
+    """
+    Post.query.filter_by(venue_id=venue.id).update(
+        {Post.updated: datetime.datetime.utcnow()},
+        synchronize_session=False)
+
+
+def cached_listing(namespaces):
+    """Cache the full response of a stream route. The cache key includes
+    the route and its arguments (before_ts, tag, ...), the LISTING_ARGS
+    in the query string (e.g. feed=atom), the viewer class, and the
+    ETag set by conditional, if any; entries are evicted when
+    anything in one of the `namespaces(**view_args)` changes.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(**kwargs):
+            viewer = listing_viewer_class()
+            if not viewer:
+                return f(**kwargs)
+
+            key = 'listing:{}:{}:{}:{}:{}'.format(
+                request.endpoint, json.dumps(kwargs, sort_keys=True),
+                json.dumps([request.args.get(k) for k in LISTING_ARGS]),
+                viewer, g.get('rw_listing_etag'))
+            ns = ['all'] + namespaces(**kwargs)
+
+            cached = cache.get(key, namespaces=ns)
+            if cached:
+                app.logger.debug('listing cache hit %s', key)
+                body, status, headers = cached
+                return make_response(body, status, headers)
+
+            resp = make_response(f(**kwargs))
+            if resp.status_code == 200:
+                headers = [(k, v) for k, v in resp.headers
+                           if k in CACHED_HEADERS]
+                cache.set(key, (resp.get_data(), resp.status_code, headers),
+                          namespaces=ns)
+            return resp
+        return wrapper
+    return decorator
+
+
+def make_etag(viewer, parts, args=()):
+    """Hash the parts of a validator together with everything else the
+    page depends on: the route, the query string arguments it reads,
+    who is looking, and the site settings
+    """
+    blob = json.dumps([
+        request.endpoint, request.view_args,
+        [request.args.get(k) for k in args], viewer,
+        get_settings()._version, parts,
+    ], sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode()).hexdigest()
+
+
+def is_not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0) \
+            <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def add_validators(resp, etag, last_modified, kind, viewer, private=False):
+    """private pages (the admin's, drafts) must not be kept by shared
+    caches
+    """
+    resp.set_etag(etag, weak=True)
+    if last_modified:
+        resp.last_modified = last_modified
+    if viewer == 'admin' or private:
+        resp.headers['Cache-Control'] = 'private, no-cache'
+    else:
+        policies = dict(CACHE_CONTROL, **app.config.get('CACHE_CONTROL', {}))
+        resp.headers['Cache-Control'] = policies[kind]
+    resp.vary.add('Cookie')
+    return resp
+
+
+def conditional(kind, validator):
+    """Answer conditional GETs for a read route. validator(**view_args)
+    cheaply describes the page the view would make, as (parts, last
+    modified) where parts is anything json-able that changes whenever
+    the page would; a client that already has that page gets a 304
+    before the view runs. Otherwise the view's response is sent with an
+    ETag, Last-Modified and the Cache-Control for this kind of page
+    ('feed' instead of 'listing' for atom feeds). The ETag is part of
+    the cached_listing key, so a cached body always matches it.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(**kwargs):
+            viewer = listing_viewer_class()
+            validated = viewer and validator(**kwargs)
+            if not validated:
+                return f(**kwargs)
+
+            page_kind = 'feed' if request.args.get('feed') == 'atom' \
+                else kind
+            parts, last_modified = validated
+            etag = make_etag(viewer, parts, LISTING_ARGS)
+            g.rw_listing_etag = etag
+            if is_not_modified(etag, last_modified):
+                app.logger.debug('not modified %s', request.path)
+                resp = make_response('', 304)
+            else:
+                resp = make_response(f(**kwargs))
+                if resp.status_code != 200:
+                    return resp
+            return add_validators(resp, etag, last_modified, page_kind,
+                                  viewer)
+        return wrapper
+    return decorator
+
+
+def stream_validator(post_types=None, tag=None, include_hidden=True):
+    """A validator for a stream page: the id and the published, updated
+    and mentions_updated times of each post on it, read without loading
+    the posts
+    """
+    def validator(before_ts=None, **kwargs):
+        rows = stream_query(post_types and post_types(**kwargs), before_ts,
+                            tag and tag(**kwargs), include_hidden)\
+            .with_entities(Post.id, Post.published, Post.updated,
+                           Post.mentions_updated)\
+            .limit(int(get_settings().posts_per_page)).all()
+        return ([list(row) for row in rows],
+                max((date for row in rows for date in row[1:] if date),
+                    default=None))
+    return validator
+
+
+def plural_to_post_type(plural_type, **kwargs):
+    return next(tup[0] for tup in POST_TYPES if tup[1] == plural_type)
+
+
+hooks.register('post-saved', invalidate_post_listings)
+hooks.register('venue-saved', invalidate_all_listings)
+
+
 @app.route('/')
 @app.route('/before-<before_ts>')
+@conditional('listing', stream_validator(include_hidden=False))
+@cached_listing(lambda **kwargs: ['index'])
 def index(before_ts=None):
     posts, older = collect_posts(
         None, before_ts, int(get_settings().posts_per_page),
@@ -172,6 +503,8 @@ def index(before_ts=None):
 
 @app.route('/everything')
 @app.route('/everything/before-<before_ts>')
+@conditional('listing', stream_validator())
+@cached_listing(lambda **kwargs: ['everything'])
 def everything(before_ts=None):
     posts, older = collect_posts(
         None, before_ts, int(get_settings().posts_per_page), None,
@@ -184,6 +517,10 @@ def everything(before_ts=None):
 
 @app.route('/' + PLURAL_TYPE_RULE)
 @app.route('/' + PLURAL_TYPE_RULE + '/before-<before_ts>')
+@conditional('listing', stream_validator(
+    post_types=lambda **kwargs: (plural_to_post_type(**kwargs),)))
+@cached_listing(lambda plural_type, **kwargs: [
+    'type:' + plural_to_post_type(plural_type)])
 def posts_by_type(plural_type, before_ts=None):
     post_type, _, title = next(tup for tup in POST_TYPES
                                if tup[1] == plural_type)
@@ -198,16 +535,9 @@ def posts_by_type(plural_type, before_ts=None):
 
 @app.route('/tags')
 def tag_cloud():
-    query = db.session.query(
-        Tag.name, sqlalchemy.func.count(Post.id)
-    ).join(Tag.posts)
-    query = query.filter(sqlalchemy.sql.expression.not_(Post.deleted))
-    if not flask_login.current_user.is_authenticated():
-        query = query.filter(sqlalchemy.sql.expression.not_(Post.draft))
-    query = query.group_by(Tag.id).order_by(Tag.name)
-    query = query.having(sqlalchemy.func.count(Post.id) >= MIN_TAG_COUNT)
+    public = not flask_login.current_user.is_authenticated()
     tagdict = {}
-    for name, count in query.all():
+    for name, count in tag_stats.tag_counts(public, MIN_TAG_COUNT):
         tagdict[name] = tagdict.get(name, 0) + count
     tags = [
         {"name": name, "count": tagdict[name]}
@@ -218,6 +548,8 @@ def tag_cloud():
 
 @app.route('/tags/<tag>')
 @app.route('/tags/<tag>/before-<before_ts>')
+@conditional('listing', stream_validator(tag=lambda tag, **kwargs: tag))
+@cached_listing(lambda tag, **kwargs: ['tag:' + tag])
 def posts_by_tag(tag, before_ts=None):
     posts, older = collect_posts(
         None, before_ts, int(get_settings().posts_per_page), tag,
@@ -230,18 +562,36 @@ def posts_by_tag(tag, before_ts=None):
 
 
 @app.route('/search')
-@app.route('/search/before-<before_ts>')
-def search(before_ts=None):
+def search():
     q = request.args.get('q')
     if not q:
         abort(404)
 
-    posts, older = collect_posts(
-        None, before_ts, int(get_settings().posts_per_page), None,
-        include_hidden=True, search=q)
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = int(get_settings().posts_per_page)
+    query = Post.query.filter_by(deleted=False, draft=False)
+    audience = audience_filter()
+    if audience is not None:
+        query = query.filter(audience)
+    results = search_index.search_posts(q, query, limit=per_page,
+                                        offset=(page - 1) * per_page)
+
+    posts = []
+    for post, snippet in results:
+        if check_audience(post):
+            post.search_snippet = snippet
+            posts.append(post)
+    older = url_for('search', q=q, page=page + 1) \
+        if len(results) == per_page else None
     return render_posts('Search: ' + q, posts, older)
 
 
+@app.route('/search/before-<before_ts>')
+def search_before(before_ts):
+    # results used to be paged by date
+    return redirect(url_for('search', q=request.args.get('q')))
+
+
 @app.route('/mentions')
 def mentions():
     mentions = Mention.query.order_by(Mention.published.desc()).limit(100)
@@ -306,23 +656,63 @@ def post_associated_file(year, month, slug, filename):
         app.logger.debug('source path does not exist %s', sourcepath)
         abort(404)
 
+    size = request.args.get('size')
+    if size:
+        sourcepath = images.get_derivative(
+            sourcepath, size, request.args.get('format'))
+
+    # shared caches mustn't keep the files of private posts
+    private = post.draft or bool(post.audience)
+    cache_control = dict(
+        CACHE_CONTROL, **app.config.get('CACHE_CONTROL', {}))[
+            'private_file' if private else 'file']
+
     if app.debug:
         _, ext = os.path.splitext(sourcepath)
-        return send_from_directory(
+        # answers If-None-Match and If-Modified-Since itself
+        resp = send_from_directory(
             os.path.join(util.image_root_path(),
                          os.path.dirname(sourcepath)),
             os.path.basename(sourcepath), mimetype=None)
+        resp.headers['Cache-Control'] = cache_control
+        return resp
 
     resp = make_response('')
     # nginx is configured to serve internal resources directly
     sourcepath_internal = os.path.join(
-        '/internal_data', post.path, 'files', filename)
+        '/internal_data', os.path.relpath(
+            sourcepath, os.path.join(util.image_root_path(), '_data')))
     resp.headers['X-Accel-Redirect'] = sourcepath_internal
+    if private:
+        resp.headers['Cache-Control'] = cache_control
     del resp.headers['Content-Type']
     app.logger.debug('response with X-Accel-Redirect %s', resp.headers)
     return resp
 
 
+@app.route('/map/<key>.png')
+def static_map(key):
+    """Serve a map from maps.get_map_image, or a placeholder that
+    browsers shouldn't keep while it's still being fetched. A missing
+    map is queued again, in case its fetch failed or it was evicted.
+    """
+    if not re.match('^[0-9a-f]{32}$', key):
+        abort(404)
+    path = maps.cached_map(key)
+    if not path:
+        query = maps.saved_query(key)
+        if query:
+            maps.queue_maps({key: query})
+        resp = app.send_static_file(maps.PLACEHOLDER)
+        resp.cache_control.no_cache = True
+        resp.cache_control.max_age = 0
+        return resp
+    # maps are named for their contents, so they never change
+    return send_from_directory(os.path.dirname(path),
+                               os.path.basename(path),
+                               cache_timeout=365 * 86400)
+
+
 @app.route('/' + POST_TYPE_RULE + '/' + DATE_RULE, defaults={'slug': None})
 @app.route('/' + POST_TYPE_RULE + '/' + DATE_RULE + '/<slug>')
 def post_by_date(post_type, year, month, day, index, slug):
@@ -365,7 +755,39 @@ def render_post(post):
     if post.redirect:
         return redirect(post.redirect)
 
-    return util.render_themed('post.jinja2', post=post, title=post.title_or_fallback)
+    viewer = listing_viewer_class()
+    if viewer:
+        etag = make_etag(viewer, [post.id, post.published, post.updated,
+                                  post.mentions_updated],
+                         ('mentions_after',))
+        private = post.draft or bool(post.audience)
+        if is_not_modified(etag, post.last_modified):
+            resp = make_response('', 304)
+        else:
+            resp = make_response(render_post_page(post))
+        return add_validators(resp, etag, post.last_modified, 'post',
+                              viewer, private)
+    return render_post_page(post)
+
+
+def render_post_page(post):
+    # mentions other than rsvps are paged through, oldest first
+    after = request.args.get('mentions_after', type=int)
+    mentions, cursor = post.mentions_page(
+        after=after, limit=app.config.get('MENTIONS_PER_PAGE', 50),
+        exclude=('rsvp',))
+    # all of the rsvps are shown on the first page, without the copies
+    # backfed from silos, like Post.rsvps
+    rsvps = [] if after else group_mentions(
+        post.mentions_page(reftypes=('rsvp',))[0]).get('rsvp', [])
+    more_mentions = cursor and url_for(
+        request.endpoint, mentions_after=cursor, _anchor='mentions',
+        **request.view_args)
+
+    return util.render_themed('post.jinja2', post=post,
+                              title=post.title_or_fallback,
+                              mentions=mentions, rsvps=rsvps,
+                              more_mentions=more_mentions)
 
 
 def discover_endpoints(me):
@@ -557,10 +979,25 @@ def edit_settings():
     for key, value in request.form.items():
         Setting.query.get(key).value = value
     db.session.commit()
+    invalidate_settings()
+    invalidate_all_listings()
 
     return redirect(url_for('edit_settings'))
 
 
+@app.route('/hooks')
+@flask_login.login_required
+def hook_stats():
+    hooks.flush_stats(force=True)
+    stats = hooks.HookStat.query.order_by(hooks.HookStat.hook,
+                                          hooks.HookStat.action).all()
+    deferred = {(hook, hooks.action_name(action))
+                for hook, actions in hooks.deferred_actions.items()
+                for action in actions}
+    return render_template('admin/hooks.jinja2', stats=stats,
+                           deferred=deferred)
+
+
 @app.route('/delete')
 @flask_login.login_required
 def delete_by_id():
@@ -569,7 +1006,11 @@ def delete_by_id():
     if not post:
         abort(404)
     post.deleted = True
+    post.updated = datetime.datetime.utcnow()
     db.session.commit()
+    search_index.unindex_post(post.id)
+    tag_stats.update_tag_stats(tag.id for tag in post.tags)
+    invalidate_post_listings(post)
 
     redirect_url = request.args.get('redirect') or url_for('index')
     app.logger.debug('redirecting to {}'.format(redirect_url))
@@ -577,7 +1018,7 @@ def delete_by_id():
 
 
 def get_tags():
-    return [t.name for t in Tag.query.all()]
+    return tag_stats.tag_names()
 
 
 def get_top_tags(n=10):
@@ -585,32 +1026,7 @@ def get_top_tags(n=10):
     Determine top-n tags based on a combination of frequency and receny.
     ref: https://developer.mozilla.org/en-US/docs/Mozilla/Tech/Places/Frecency_algorithm
     """
-    rank = collections.defaultdict(int)
-    now = datetime.datetime.utcnow()
-
-    entries = Post.query.join(Post.tags).values(Post.published, Tag.name)
-    for published, tag in entries:
-        weight = 0
-        if published:
-            if published.tzinfo:
-                published = published.astimezone(datetime.timezone.utc)
-                published = published.replace(tzinfo=None)
-            delta = now - published
-            if delta < datetime.timedelta(days=4):
-                weight = 1.0
-            elif delta < datetime.timedelta(days=14):
-                weight = 0.7
-            elif delta < datetime.timedelta(days=31):
-                weight = 0.5
-            elif delta < datetime.timedelta(days=90):
-                weight = 0.3
-            elif delta < datetime.timedelta(days=730):
-                weight = 0.1
-        rank[tag] += weight
-
-    ordered = sorted(list(rank.items()), key=operator.itemgetter(1),
-                     reverse=True)
-    return [key for key, _ in ordered[:n]]
+    return tag_stats.top_tags(n)
 
 
 @app.route('/new/<type>')
@@ -814,6 +1230,11 @@ def prettify_url(*args, **kwargs):
     return util.prettify_url(*args, **kwargs)
 
 
+@app.template_filter('group_mentions')
+def group_mentions_filter(mentions):
+    return group_mentions(mentions)
+
+
 @app.template_filter('domain_from_url')
 def domain_from_url(url):
     if not url:
@@ -880,6 +1301,9 @@ def save_new():
 
 def save_post(post):
     was_draft = post.draft
+    # listings the post appeared in before this edit (e.g. tags that
+    # are being removed) have to be refreshed as well
+    stale_listings = post_listing_namespaces(post) if post.id else []
 
     pub_str = request.form.get('published')
     if pub_str:
@@ -891,6 +1315,7 @@ def save_post(post):
 
     if not post.published or was_draft:
         post.published = datetime.datetime.utcnow()
+    post.updated = datetime.datetime.utcnow()
 
     # populate the Post object and save it to the database,
     # redirect to the view
@@ -956,8 +1381,8 @@ def save_post(post):
 
     tags = request.form.getlist('tags')
     tags = list(filter(None, map(util.normalize_tag, tags)))
-    post.tags = [Tag.query.filter_by(name=tag).first() or Tag(tag)
-                 for tag in tags]
+    old_tag_ids = [tag.id for tag in post.tags]
+    post.tags = Tag.load_or_create(tags)
 
     slug = request.form.get('slug')
     if slug:
@@ -974,13 +1399,7 @@ def save_post(post):
     elif not post.path or was_draft:
         base_path = '{}/{:02d}/{}'.format(
             post.published.year, post.published.month, post.slug)
-        # generate a unique path
-        unique_path = base_path
-        idx = 1
-        while Post.load_by_path(unique_path):
-            unique_path = '{}-{}'.format(base_path, idx)
-            idx += 1
-        post.path = unique_path
+        post.claim_path(base_path)
 
     # TODO accept multiple photos and captions
     inphoto = request.files.get('photo')
@@ -999,6 +1418,8 @@ def save_post(post):
         }]
 
     file_to_url = {}
+    # sizes of these (and the photo) are made once the post is saved
+    uploaded = []
     infiles = request.files.getlist('files')
     app.logger.debug('infiles: %s', infiles)
     for infile in infiles:
@@ -1010,6 +1431,7 @@ def save_post(post):
                 os.makedirs(os.path.dirname(fullpath))
             infile.save(fullpath)
             file_to_url[infile] = photo_url
+            uploaded.append(os.path.basename(relpath))
 
     app.logger.debug('uploaded files map %s', file_to_url)
 
@@ -1022,10 +1444,16 @@ def save_post(post):
     if not post.id:
         db.session.add(post)
     db.session.commit()
+    search_index.index_post(post)
+    tag_stats.update_tag_stats(old_tag_ids + [tag.id for tag in post.tags])
+    if (inphoto and inphoto.filename) or uploaded:
+        queue.enqueue(images.do_make_photo_variants, post.id, uploaded)
 
     app.logger.debug('saved post %d %s', post.id, post.permalink)
     redirect_url = post.permalink
 
+    cache.invalidate(*stale_listings)
+
     hooks.fire('post-saved', post, request.form)
 
     return redirect(redirect_url)
@@ -1092,8 +1520,12 @@ def contact_by_name(name):
 def delete_contact():
     id = request.args.get('id')
     contact = Contact.query.get(id)
+    nicks = [nick.name for nick in contact.nicks]
+    name = contact.name
     db.session.delete(contact)
     db.session.commit()
+    util.invalidate_contacts()
+    rerender.rerender_contact_posts(nicks, [name])
     return redirect(url_for('contacts'))
 
 
@@ -1127,6 +1559,8 @@ def edit_contact():
 
 
 def save_contact(contact):
+    old_nicks = [nick.name for nick in contact.nicks]
+    old_name = contact.name
     contact.name = request.form.get('name')
     contact.image = request.form.get('image')
     contact.url = request.form.get('url')
@@ -1148,6 +1582,10 @@ def save_contact(contact):
     if not contact.id:
         db.session.add(contact)
     db.session.commit()
+    util.invalidate_contacts()
+    rerender.rerender_contact_posts(
+        old_nicks + [nick.name for nick in contact.nicks],
+        [old_name, contact.name])
 
     if contact.nicks:
         return redirect(url_for('contact_by_name', name=contact.nicks[0].name))
@@ -1223,7 +1661,9 @@ def save_venue(venue):
     }
     venue.update_slug(request.form.get('geocode'))
 
-    if not venue.id:
+    if venue.id:
+        mark_venue_posts_updated(venue)
+    else:
         db.session.add(venue)
     db.session.commit()
 
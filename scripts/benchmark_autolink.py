@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Compare the tokenizing util.autolink with the previous implementation,
+which parsed the rendered markdown with BeautifulSoup, rewrote its text
+nodes and reserialized the tree.
+
+usage: python scripts/benchmark_autolink.py [FILE...] [--repeat N]
+
+Each FILE is markdown, rendered the same way markdown_filter does
+before it autolinks; without any, a built-in sample post is used.
+Outputs that differ other than in how bs4 normalizes markup are
+reported.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('files', nargs='*')
+parser.add_argument('--repeat', type=int, default=200)
+options = parser.parse_args()
+
+from redwind import app, util
+from markdown import markdown
+import bs4
+
+SAMPLE = """\
+Reply to @kylewm and @someone_else about http://example.com/a/post --
+see also [the spec](http://indiewebcamp.com/webmention) &amp; the
+discussion at https://github.com/kylewm/redwind/issues/42?q=1&amp;x=2.
+
+* one bare link: indiewebcamp.com/irc/today#t1418
+* a link inside `code http://example.com/` stays alone
+* an email-ish thing like user@example.com and a handle (@tantek).
+
+    def example():
+        return 'http://example.com/not/linked'
+
+<p class="h-card">Some <em>inline</em> html, <br /> with a
+<a href="http://example.org">pre-existing link</a>.</p>
+"""
+
+
+def legacy_autolink(plain, url_processor=util.url_to_link,
+                    person_processor=util.person_to_microcard):
+    """util.autolink before it was replaced by the tokenizer"""
+    blacklist = ('a', 'script', 'pre', 'code', 'embed', 'object',
+                 'audio', 'video')
+    soup = bs4.BeautifulSoup(plain)
+
+    def text_nodes():
+        return [txt for txt in soup.find_all(text=True)
+                if not any(p.name in blacklist for p in txt.parents)]
+
+    def bs4_sub(regex, repl):
+        for txt in text_nodes():
+            nodes = []
+            start = 0
+            for m in regex.finditer(txt):
+                nodes.append(txt[start:m.start()])
+                nodes.append(repl(m))
+                start = m.end()
+            if not nodes:
+                continue
+            nodes.append(txt[start:])
+            parent = txt.parent
+            ii = parent.contents.index(txt)
+            txt.extract()
+            for offset, node in enumerate(nodes):
+                parent.insert(ii + offset, node)
+
+    def link_repl(m):
+        url = (m.group(1) or 'http://') + m.group(2)
+        return url_processor(url, soup)
+
+    def process_nick(m):
+        name = m.group(1)
+        contact = contacts.get(name.lower())
+        processed = person_processor(contact, name, soup)
+        if processed:
+            return processed
+        return m.group(0)
+
+    if url_processor:
+        bs4_sub(util.LINK_RE, link_repl)
+
+    if person_processor:
+        contacts = util.resolve_nicks(
+            m.group(1) for txt in text_nodes()
+            for m in util.AT_USERNAME_RE.finditer(txt))
+        bs4_sub(util.AT_USERNAME_RE, process_nick)
+
+    return ''.join(str(t) for t in soup.body.contents) if soup.body else ''
+
+
+def normalize(doc):
+    """Serialize both outputs through bs4 so that only differences in
+    the content, not in the spelling of the markup, are reported"""
+    return str(bs4.BeautifulSoup(doc))
+
+
+def measure(fn, doc):
+    best = None
+    for _ in range(options.repeat):
+        start = time.perf_counter()
+        fn(doc)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def load_docs(paths):
+    if not paths:
+        yield 'sample', SAMPLE
+    for path in paths:
+        with open(path) as f:
+            yield path, f.read()
+
+
+with app.test_request_context():
+    for name, source in load_docs(options.files):
+        doc = markdown(source, extensions=['codehilite', 'fenced_code'])
+        if normalize(legacy_autolink(doc)) != normalize(util.autolink(doc)):
+            print('{}: output differs'.format(name))
+        legacy = measure(legacy_autolink, doc)
+        tokenizer = measure(util.autolink, doc)
+        print('{:<40.40} {:>6} chars  legacy {:7.3f}ms  tokenizer {:7.3f}ms'
+              '  ({:.1f}x)'.format(name, len(doc), legacy, tokenizer,
+                                   legacy / tokenizer))
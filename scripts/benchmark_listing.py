@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Compare the keyset-paginated views.collect_posts with the previous
+subqueryload-based implementation on synthetic archives.
+
+usage: python scripts/benchmark_listing.py [sizes...] [--db URI]
+
+Each size (default 10000 100000 1000000) is loaded into a fresh
+database (default: a temporary sqlite file), then both implementations
+fetch the first page, a page from the middle, and a page near the end
+of the archive.
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('sizes', nargs='*', type=int,
+                    default=[10000, 100000, 1000000])
+parser.add_argument('--db', help='SQLAlchemy URI (will be wiped!)')
+parser.add_argument('--per-page', type=int, default=15)
+parser.add_argument('--repeat', type=int, default=5)
+options = parser.parse_args()
+
+if not options.db:
+    options.db = 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'benchmark.db')
+
+from config import Configuration
+Configuration.SQLALCHEMY_DATABASE_URI = options.db
+Configuration.CACHE_TYPE = 'null'
+
+from redwind import app, db, views
+from redwind.models import Post, Tag, Mention, Context, Setting, \
+    posts_to_tags, posts_to_mentions, posts_to_reply_contexts
+import sqlalchemy
+import sqlalchemy.orm
+
+BATCH = 10000
+NTAGS = 200
+
+
+def legacy_collect_posts(before_dt, per_page):
+    """collect_posts as it was before keyset pagination"""
+    query = Post.query.options(
+        sqlalchemy.orm.subqueryload(Post.tags),
+        sqlalchemy.orm.subqueryload(Post.mentions),
+        sqlalchemy.orm.subqueryload(Post.reply_contexts),
+        sqlalchemy.orm.subqueryload(Post.repost_contexts),
+        sqlalchemy.orm.subqueryload(Post.like_contexts),
+        sqlalchemy.orm.subqueryload(Post.bookmark_contexts))
+    query = query.filter_by(deleted=False, draft=False)
+    if before_dt:
+        query = query.filter(Post.published < before_dt)
+    query = query.order_by(Post.published.desc()).limit(per_page)
+    return [post for post in query.all() if views.check_audience(post)]
+
+
+def populate(size):
+    db.drop_all()
+    db.create_all()
+    db.engine.execute(Setting.__table__.insert(), [
+        {'key': 'posts_per_page', 'value': str(options.per_page)},
+        {'key': 'site_url', 'value': 'http://example.com'},
+        {'key': 'timezone', 'value': 'America/Los_Angeles'},
+    ])
+    db.engine.execute(Tag.__table__.insert(), [
+        {'id': i + 1, 'name': 'tag{}'.format(i)} for i in range(NTAGS)])
+
+    start = datetime.datetime(2010, 1, 1)
+    for offset in range(0, size, BATCH):
+        ids = range(offset + 1, min(offset + BATCH, size) + 1)
+        db.engine.execute(Post.__table__.insert(), [{
+            'id': i,
+            'path': 'posts/{}'.format(i),
+            'post_type': 'note',
+            'draft': False,
+            'deleted': False,
+            'hidden': i % 10 == 0,
+            'audience': '[]' if i % 50 else '["friend.example.com"]',
+            'published': start + datetime.timedelta(minutes=i),
+            'content': 'post number {}'.format(i),
+            'content_html': '<p>post number {}</p>'.format(i),
+        } for i in ids])
+        db.engine.execute(posts_to_tags.insert(), [{
+            'post_id': i, 'tag_id': random.randint(1, NTAGS),
+        } for i in ids for _ in range(2)])
+        db.engine.execute(Mention.__table__.insert(), [{
+            'id': i, 'url': 'http://mention/{}'.format(i),
+            'reftype': 'like', 'published': start,
+        } for i in ids if i % 3 == 0])
+        db.engine.execute(posts_to_mentions.insert(), [{
+            'post_id': i, 'mention_id': i,
+        } for i in ids if i % 3 == 0])
+        db.engine.execute(Context.__table__.insert(), [{
+            'id': i, 'url': 'http://context/{}'.format(i),
+        } for i in ids if i % 7 == 0])
+        db.engine.execute(posts_to_reply_contexts.insert(), [{
+            'post_id': i, 'context_id': i,
+        } for i in ids if i % 7 == 0])
+
+
+def timed(fn):
+    best = None
+    for _ in range(options.repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def benchmark(size):
+    populate(size)
+    newest = db.session.query(sqlalchemy.func.max(Post.published)).scalar()
+    for label, depth in (('first', 0), ('middle', size // 2),
+                         ('end', size - options.per_page * 2)):
+        before_dt = newest - datetime.timedelta(minutes=depth) \
+            if depth else None
+        before_post = before_dt and Post.query.filter_by(
+            published=before_dt).first()
+        before_ts = before_post and views.format_before_ts(before_post)
+
+        with app.test_request_context('/everything'):
+            legacy = timed(
+                lambda: legacy_collect_posts(before_dt, options.per_page))
+            keyset = timed(lambda: views.collect_posts(
+                None, before_ts, options.per_page, None,
+                include_hidden=True))
+        print('{:>9} posts, {:<6} page: legacy {:8.2f}ms  '
+              'keyset {:8.2f}ms'.format(size, label, legacy, keyset))
+
+
+with app.app_context():
+    for size in options.sizes:
+        benchmark(size)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Compare search latency of the search index (redwind.search) with the
+previous unindexed query on synthetic archives.
+
+usage: python scripts/benchmark_search.py [sizes...] [--db URI]
+
+Each size (default 10000 100000) is loaded into a fresh database
+(default: a temporary sqlite file) and indexed, then a few queries of
+varying selectivity are timed. On Postgres the previous implementation
+is `concat(title, ' ', content) @@ plainto_tsquery(q)`; on SQLite,
+where that never worked, a LIKE scan stands in for it.
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('sizes', nargs='*', type=int, default=[10000, 100000])
+parser.add_argument('--db', help='SQLAlchemy URI (will be wiped!)')
+parser.add_argument('--repeat', type=int, default=5)
+options = parser.parse_args()
+
+if not options.db:
+    options.db = 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'benchmark.db')
+
+from config import Configuration
+Configuration.SQLALCHEMY_DATABASE_URI = options.db
+Configuration.CACHE_TYPE = 'null'
+
+from redwind import app, db, search
+from redwind.models import Post
+import sqlalchemy
+
+BATCH = 10000
+# a zipf-ish vocabulary, so that some words are common and some rare
+VOCABULARY = ['word{}'.format(i) for i in range(5000)]
+WEIGHTS = [1 / (i + 1) for i in range(len(VOCABULARY))]
+QUERIES = ['word0', 'word10', 'word500', 'word4000', 'word1 word20']
+
+
+def legacy_search(q):
+    query = Post.query.filter_by(deleted=False, draft=False)
+    if search.is_postgres():
+        query = query.filter(
+            sqlalchemy.func.concat(Post.title, ' ', Post.content)
+            .op('@@')(sqlalchemy.func.plainto_tsquery(q)))
+    else:
+        for word in q.split():
+            query = query.filter(Post.content.like('%' + word + '%'))
+    return query.order_by(Post.published.desc()).limit(20).all()
+
+
+def indexed_search(q):
+    query = Post.query.filter_by(deleted=False, draft=False)
+    return search.search_posts(q, query, limit=20)
+
+
+def populate(size):
+    db.drop_all()
+    db.create_all()
+    start = datetime.datetime(2010, 1, 1)
+    for offset in range(0, size, BATCH):
+        ids = range(offset + 1, min(offset + BATCH, size) + 1)
+        db.engine.execute(Post.__table__.insert(), [{
+            'id': i,
+            'path': 'posts/{}'.format(i),
+            'post_type': 'article' if i % 5 == 0 else 'note',
+            'draft': False,
+            'deleted': False,
+            'hidden': False,
+            'published': start + datetime.timedelta(minutes=i),
+            'title': ' '.join(random.choices(VOCABULARY, WEIGHTS, k=4))
+            if i % 5 == 0 else None,
+            'content': ' '.join(random.choices(VOCABULARY, WEIGHTS, k=60)),
+        } for i in ids])
+
+    started = time.perf_counter()
+    search.reindex_all(BATCH)
+    print('{:>9} posts indexed in {:.1f}s'.format(
+        size, time.perf_counter() - started))
+
+
+def timed(fn, q):
+    best = None
+    for _ in range(options.repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        fn(q)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+with app.app_context():
+    for size in options.sizes:
+        populate(size)
+        for q in QUERIES:
+            print('{:>9} posts, {:<14} legacy {:8.2f}ms  indexed {:8.2f}ms'
+                  .format(size, repr(q), timed(legacy_search, q),
+                          timed(indexed_search, q)))
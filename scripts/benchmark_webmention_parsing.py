@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Compare parse time and peak memory of the single-pass webmention
+pipeline (util.HtmlDocument) with the previous one, which parsed each
+source once for the link check and again for mf2py.
+
+usage: python scripts/benchmark_webmention_parsing.py CORPUS... [--target URL]
+
+Each CORPUS argument is an .html file, a directory of them, or a URL
+to fetch (e.g. a handful of real-world h-entry permalinks). The
+target is the link that the source has to contain, like a webmention
+to that URL would; it only affects whether mf2util runs.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('corpus', nargs='+')
+parser.add_argument('--target', default='http://example.com/')
+parser.add_argument('--repeat', type=int, default=3)
+options = parser.parse_args()
+
+from redwind import app, util
+import bs4
+import mf2py
+import mf2util
+import requests
+
+
+def load_corpus(paths):
+    for path in paths:
+        if path.startswith('http://') or path.startswith('https://'):
+            response = requests.get(path, timeout=30)
+            yield path, response.content
+        elif os.path.isdir(path):
+            yield from load_corpus(sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if name.endswith('.html') or name.endswith('.htm')))
+        else:
+            with open(path, 'rb') as f:
+                yield path, f.read()
+
+
+def legacy_pipeline(url, text):
+    """do_process_webmention as it was before HtmlDocument"""
+    soup = bs4.BeautifulSoup(text)
+    link = next((a for a in soup.find_all(['a', 'link'])
+                 if a.get('href') == options.target), None)
+    blob = mf2py.Parser(doc=text, url=url).to_dict()
+    entry = link and mf2util.interpret_comment(blob, url, [options.target])
+    return entry and util.format_as_text(
+        util.clean_foreign_html(entry.get('content', '')))
+
+
+def single_pass_pipeline(url, text):
+    doc = util.HtmlDocument(text, url)
+    link = doc.find_links([options.target])
+    blob = doc.to_mf2()
+    entry = link and mf2util.interpret_comment(blob, url, [options.target])
+    return entry and util.format_as_text(
+        util.clean_foreign_html(entry.get('content', '')))
+
+
+def measure(fn, url, text):
+    best = None
+    for _ in range(options.repeat):
+        start = time.perf_counter()
+        fn(url, text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    fn(url, text)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best * 1000, peak / 1024
+
+
+totals = {'legacy': [0, 0], 'single': [0, 0]}
+count = 0
+with app.app_context():
+    for url, content in load_corpus(options.corpus):
+        # both pipelines start from the already-decoded text, like
+        # do_process_webmention does
+        text = content.decode('utf-8', 'replace')
+        legacy = measure(legacy_pipeline, url, text)
+        single = measure(single_pass_pipeline, url, text)
+        for key, result in (('legacy', legacy), ('single', single)):
+            totals[key][0] += result[0]
+            totals[key][1] += result[1]
+        count += 1
+        print('{:<50.50} {:>7}KB  legacy {:8.2f}ms {:8.0f}KB  '
+              'single {:8.2f}ms {:8.0f}KB'.format(
+                  url, len(content) // 1024, *(legacy + single)))
+
+if count:
+    print('average per mention: legacy {:.2f}ms {:.0f}KB peak, '
+          'single pass {:.2f}ms {:.0f}KB peak'.format(
+              totals['legacy'][0] / count, totals['legacy'][1] / count,
+              totals['single'][0] / count, totals['single'][1] / count))
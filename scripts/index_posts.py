@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+"""
+Rebuild the full-text search index from scratch, e.g. after importing
+posts directly into the database.
+
+usage: python scripts/index_posts.py [--batch-size N]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch-size', type=int, default=1000)
+options = parser.parse_args()
+
+from redwind import app, search
+
+with app.app_context():
+    start = time.time()
+    count = search.reindex_all(options.batch_size)
+    elapsed = time.time() - start
+    print('indexed {} posts in {:.1f}s ({:.1f} posts/s)'.format(
+        count, elapsed, count / elapsed if elapsed else 0))
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""
+Re-render content_html for every post, e.g. after changing the markdown
+pipeline or the Pygments style.
+
+usage: python scripts/rerender_posts.py [--processes N] [--batch-size N]
+                                        [--checkpoint FILE] [--queue]
+
+An interrupted run picks up where it left off when started again with
+the same checkpoint file. With --queue, the rerender is handed to
+qworker instead of running here.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--processes', type=int)
+parser.add_argument('--batch-size', type=int)
+parser.add_argument('--checkpoint', default='rerender.checkpoint')
+parser.add_argument('--queue', action='store_true')
+options = parser.parse_args()
+
+from redwind import app, queue, rerender
+
+checkpoint = os.path.abspath(options.checkpoint)
+with app.app_context():
+    if options.queue:
+        key = queue.enqueue(rerender.do_rerender_posts,
+                            processes=options.processes,
+                            checkpoint=checkpoint)
+        print('queued rerender job', key)
+    else:
+        stats = rerender.rerender_posts(
+            batch_size=options.batch_size, processes=options.processes,
+            checkpoint=checkpoint)
+        print('rerendered {posts} posts, {changed} changed, in {seconds:.1f}s'
+              ' ({rate:.1f} posts/s)'.format(
+                  rate=stats['posts'] / stats['seconds']
+                  if stats['seconds'] else 0, **stats))
@@ -40,7 +40,7 @@ def app(request):
     import shutil
 
     def set_setting(key, value):
-        from redwind.models import Setting
+        from redwind.models import Setting, invalidate_settings
         s = Setting.query.get(key)
         if not s:
             s = Setting()
@@ -48,11 +48,15 @@ def app(request):
             rw_db.session.add(s)
         s.value = value
         rw_db.session.commit()
+        invalidate_settings()
+
+    from redwind import cache
 
     assert str(rw_db.engine.url) == 'sqlite:///:memory:'
     app_context = rw_app.app_context()
     app_context.push()
     rw_db.create_all()
+    cache.clear()
     temp_image_path = tempfile.mkdtemp()
     rw_app.config['IMAGE_ROOT_PATH'] = temp_image_path
 
@@ -0,0 +1,125 @@
+import datetime
+from redwind import contexts, db
+from redwind.models import Post, Context
+
+
+def make_post(path, **urls):
+    post = Post('reply')
+    post.path = path
+    for attr, value in urls.items():
+        setattr(post, attr, value)
+    db.session.add(post)
+    return post
+
+
+def fake_create_context(url):
+    return Context(url=url, permalink=url, title='Title of ' + url,
+                   fetched=datetime.datetime.utcnow())
+
+
+def test_fetch_contexts_concurrently(app, mocker):
+    create = mocker.patch('redwind.contexts.create_context',
+                          side_effect=fake_create_context)
+    post = make_post('2014/12/a', in_reply_to=['http://a.com/1'],
+                     like_of=['http://b.com/2', 'http://c.com/3'],
+                     repost_of=[], bookmark_of=['http://a.com/1'])
+    contexts.fetch_contexts(post)
+
+    assert create.call_count == 3
+    assert [c.title for c in post.reply_contexts] == ['Title of http://a.com/1']
+    assert [c.url for c in post.like_contexts] == ['http://b.com/2',
+                                                   'http://c.com/3']
+    # the same url shares one row
+    assert post.bookmark_contexts[0] is post.reply_contexts[0]
+    assert all(c.fetched for c in post.like_contexts)
+
+
+def test_fresh_contexts_are_reused(app, mocker):
+    create = mocker.patch('redwind.contexts.create_context',
+                          side_effect=fake_create_context)
+    first = make_post('2014/12/a', in_reply_to=['http://a.com/1'],
+                      like_of=[], repost_of=[], bookmark_of=[])
+    contexts.fetch_contexts(first)
+    second = make_post('2014/12/b', in_reply_to=['http://a.com/1'],
+                       like_of=[], repost_of=[], bookmark_of=[])
+    contexts.fetch_contexts(second)
+
+    assert create.call_count == 1
+    assert second.reply_contexts == first.reply_contexts
+
+    # once it is too old it gets refetched in place
+    context = first.reply_contexts[0]
+    context.fetched -= datetime.timedelta(days=2)
+    db.session.commit()
+    contexts.fetch_contexts(second)
+    assert create.call_count == 2
+    assert second.reply_contexts == [context]
+    assert Context.query.count() == 1
+
+    # replacing the url on one post doesn't delete the other's context
+    second.in_reply_to = ['http://z.com/9']
+    contexts.fetch_contexts(second)
+    assert Context.query.get(context.id)
+    first.in_reply_to = []
+    contexts.fetch_contexts(first)
+    assert not Context.query.get(context.id)
+
+
+def test_deferred_contexts(app, mocker):
+    create = mocker.patch('redwind.contexts.create_context',
+                          side_effect=fake_create_context)
+    enqueue = mocker.patch('redwind.queue.enqueue')
+    post = make_post('2014/12/a', in_reply_to=['http://a.com/1'],
+                     like_of=[], repost_of=[], bookmark_of=[])
+    contexts.fetch_contexts(post, defer=True)
+
+    assert not create.called
+    placeholder = post.reply_contexts[0]
+    assert placeholder.permalink == 'http://a.com/1'
+    assert not placeholder.fetched
+    enqueue.assert_called_once_with(contexts.do_refresh_contexts,
+                                    ['http://a.com/1'])
+
+    contexts.do_refresh_contexts(['http://a.com/1'])
+    assert post.reply_contexts[0].title == 'Title of http://a.com/1'
+    assert post.reply_contexts[0].fetched
+    assert post.updated
+
+
+def test_failed_fetch_is_retried(app, mocker):
+    mocker.patch('redwind.hooks.fire_first', return_value=None)
+    fetch = mocker.patch('redwind.util.fetch_html',
+                         side_effect=IOError('connection refused'))
+    post = make_post('2014/12/a', in_reply_to=['http://a.com/1'],
+                     like_of=[], repost_of=[], bookmark_of=[])
+    contexts.fetch_contexts(post)
+    context = post.reply_contexts[0]
+    assert context.permalink == 'http://a.com/1'
+    assert not context.fetched
+
+    # a failure doesn't overwrite a context that was fetched before
+    context.title = 'Fetched title'
+    context.fetched = datetime.datetime.utcnow() - datetime.timedelta(days=2)
+    db.session.commit()
+    contexts.fetch_contexts(post)
+    assert fetch.call_count == 2
+    assert post.reply_contexts[0].title == 'Fetched title'
+    assert post.reply_contexts[0].fetched < datetime.datetime.utcnow() \
+        - datetime.timedelta(days=1)
+
+
+def test_fetched_context_beats_placeholder(app, mocker):
+    create = mocker.patch('redwind.contexts.create_context',
+                          side_effect=fake_create_context)
+    fetched = fake_create_context('http://a.com/1')
+    placeholder = Context(url='http://a.com/1', permalink='http://a.com/1')
+    db.session.add_all([fetched, placeholder])
+    db.session.commit()
+    assert contexts.lookup_contexts(['http://a.com/1']) \
+        == {'http://a.com/1': fetched}
+
+    post = make_post('2014/12/a', in_reply_to=['http://a.com/1'],
+                     like_of=[], repost_of=[], bookmark_of=[])
+    contexts.fetch_contexts(post)
+    assert not create.called
+    assert post.reply_contexts == [fetched]
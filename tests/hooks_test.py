@@ -0,0 +1,93 @@
+from redwind import hooks
+from redwind.models import Post
+import time
+
+
+def test_deferred_hooks_share_one_job(app, db, mocker):
+    enqueue = mocker.patch('redwind.queue.enqueue')
+    calls = []
+
+    def first(post, args):
+        calls.append(('first', post.id, args['x']))
+
+    def second(post, args):
+        raise RuntimeError('broken plugin')
+
+    def third(post, args):
+        calls.append(('third', post.id))
+
+    mocker.patch.dict(hooks.deferred_actions,
+                      {'test-saved': [first, second, third]})
+    post = Post('note')
+    post.path = '2014/12/hooks-test'
+    db.session.add(post)
+    db.session.commit()
+
+    assert hooks.fire('test-saved', post, {'x': 1}) == []
+    assert not calls
+    func, hook, args, kwargs = enqueue.call_args[0]
+    assert enqueue.call_count == 1
+    assert args[0] == hooks.ModelRef(Post, post.id)
+
+    # a failing action doesn't stop the rest
+    func(hook, args, kwargs)
+    assert calls == [('first', post.id, 1), ('third', post.id)]
+    stats = {stat.action.rsplit('.', 1)[1]: stat
+             for stat in hooks.HookStat.query.filter_by(hook='test-saved')}
+    assert stats['first'].calls == 1 and not stats['first'].failures
+    assert stats['second'].failures == 1
+    assert 'broken plugin' in stats['second'].last_error
+
+
+def test_fire_first(app, mocker):
+    calls = []
+
+    def slow(url):
+        calls.append('slow')
+        time.sleep(0.5)
+        return 'too late'
+
+    def nothing(url):
+        calls.append('nothing')
+
+    def found(url):
+        calls.append('found')
+        return 'context for ' + url
+
+    def unreached(url):
+        calls.append('unreached')
+
+    mocker.patch.dict(hooks.actions,
+                      {'test-context': [slow, nothing, found, unreached]})
+    assert hooks.fire_first('test-context', 'http://a.b/', timeout=0.1) \
+        == 'context for http://a.b/'
+    assert calls == ['slow', 'nothing', 'found']
+
+    hooks.flush_stats(force=True)
+    stat = hooks.HookStat.query.filter_by(
+        hook='test-context', action='hooks_test.slow').first()
+    assert stat.failures == 1
+    assert 'timed out' in stat.last_error
+
+
+def test_fire_first_after_timeouts(app, mocker):
+    def stuck(url):
+        time.sleep(0.5)
+
+    def found(url):
+        return 'found'
+
+    # actions that are still running after their timeout don't keep
+    # the ones after them from getting a thread
+    mocker.patch.dict(hooks.actions,
+                      {'test-context': [stuck] * 6 + [found]})
+    assert hooks.fire_first('test-context', 'http://a.b/', timeout=0.05) \
+        == 'found'
+
+
+def test_hook_stats_page(client, auth, mocker):
+    mocker.patch.dict(hooks.actions, {'test-page': [lambda: None]})
+    hooks.fire('test-page')
+    rv = client.get('/hooks')
+    assert 200 == rv.status_code
+    assert 'hooks_test.&lt;lambda&gt;' in rv.get_data(as_text=True)
@@ -0,0 +1,137 @@
+import io
+import os
+import pytest
+from redwind import images
+
+Image = pytest.importorskip('PIL.Image')
+
+
+@pytest.yield_fixture(autouse=True)
+def resize_inline(app, mocker):
+    mocker.patch.dict(app.config, {'IMAGE_RESIZE_PROCESSES': 1})
+    images.get_pool.cached = None
+    yield
+    images.get_pool.cached = None
+
+
+@pytest.fixture
+def photo_post(client, auth, mocker):
+    mocker.patch('requests.get')
+    mocker.patch('redwind.queue.enqueue')
+    rv = client.post('/save_new', data={
+        'photo': (open('tests/image.jpg', 'rb'), 'image.jpg', 'image/jpeg'),
+        'post_type': 'photo',
+        'content': 'Resize me',
+        'action': 'publish_quietly',
+    })
+    assert rv.status_code == 302
+    return rv.location
+
+
+def test_resize_on_request(app, client, photo_post, mocker):
+    resize = mocker.spy(images, 'resize')
+
+    rv = client.get(photo_post + '/files/image.jpg',
+                    query_string={'size': 'small'})
+    assert rv.status_code == 200
+    im = Image.open(io.BytesIO(rv.data))
+    assert max(im.size) == 300
+
+    # served from the derivatives directory the second time
+    rv = client.get(photo_post + '/files/image.jpg',
+                    query_string={'size': 'small'})
+    assert max(Image.open(io.BytesIO(rv.data)).size) == 300
+    assert resize.call_count == 1
+
+    # larger than the original: a copy, never scaled up
+    rv = client.get(photo_post + '/files/image.jpg',
+                    query_string={'size': 'large'})
+    assert Image.open(io.BytesIO(rv.data)).size == (600, 399)
+
+    # unknown sizes get the original
+    rv = client.get(photo_post + '/files/image.jpg',
+                    query_string={'size': 'huge'})
+    assert Image.open(io.BytesIO(rv.data)).size == (600, 399)
+
+
+def test_stale_derivatives_are_remade(app, tmpdir):
+    source = str(tmpdir.mkdir('files').join('red.png'))
+    Image.new('RGB', (1000, 500), 'red').save(source)
+    with app.app_context():
+        dest = images.get_derivative(source, 'small')
+        assert dest == str(tmpdir.join('derivatives', 'small', 'red.png'))
+        assert Image.open(dest).size == (300, 150)
+        assert images.is_cached_current(source, dest)
+
+        Image.new('RGB', (500, 1000), 'blue').save(source)
+        then = os.stat(dest).st_mtime + 10
+        os.utime(source, (then, then))
+        assert not images.is_cached_current(source, dest)
+        assert Image.open(images.get_derivative(source, 'small')).size \
+            == (150, 300)
+
+
+def test_photo_variants_made_on_upload(app, client, auth, mocker):
+    from redwind.models import Post
+    mocker.patch.dict(app.config, {'PHOTO_WEBP': True})
+    mocker.patch('requests.get')
+    enqueue = mocker.patch('redwind.queue.enqueue')
+
+    # a portrait photo, stored sideways with an EXIF orientation
+    photo = io.BytesIO()
+    Image.new('RGB', (1200, 900), 'green').save(photo, 'JPEG', exif=(
+        b'Exif\x00\x00II*\x00\x08\x00\x00\x00\x01\x00'
+        b'\x12\x01\x03\x00\x01\x00\x00\x00\x06\x00\x00\x00'
+        b'\x00\x00\x00\x00'))
+    photo.seek(0)
+    rv = client.post('/save_new', data={
+        'photo': (photo, 'sideways.jpg', 'image/jpeg'),
+        'post_type': 'photo',
+        'content': 'Sideways',
+        'action': 'publish_quietly',
+    })
+    assert rv.status_code == 302
+    enqueue.assert_any_call(images.do_make_photo_variants, 1, [])
+
+    saved = Post.load_by_id(1).updated
+    images.do_make_photo_variants(1)
+    post = Post.load_by_id(1)
+    # so that clients holding the permalink get the new srcset
+    assert post.updated > saved
+    photo = post.photos[0]
+    assert (photo['width'], photo['height']) == (900, 1200)
+    assert photo['variants'] == [
+        {'size': 'small', 'width': 225, 'height': 300, 'webp': True},
+        {'size': 'medium', 'width': 600, 'height': 800, 'webp': True},
+        {'size': 'large', 'width': 900, 'height': 1200, 'webp': True},
+    ]
+    rv = client.get(post.photo_url(photo),
+                    query_string={'size': 'medium'})
+    small = Image.open(io.BytesIO(rv.data))
+    assert small.size == (600, 800)
+    assert 'exif' not in small.info
+    rv = client.get(post.photo_url(photo),
+                    query_string={'size': 'small', 'format': 'webp'})
+    assert Image.open(io.BytesIO(rv.data)).format == 'WEBP'
+
+    # rendered from post.photos alone
+    exists = mocker.patch('os.path.exists', side_effect=os.path.exists)
+    text = client.get(post.permalink).get_data(as_text=True)
+    assert 'sideways.jpg?size=small 225w' in text
+    assert 'width="600" height="800"' in text
+    assert 'type="image/webp"' in text
+    assert not any('sideways' in str(call) for call in exists.call_args_list)
+
+
+def test_private_files_are_not_shared(app, client, photo_post):
+    from redwind import db
+    from redwind.models import Post
+    rv = client.get(photo_post + '/files/image.jpg')
+    assert rv.headers['Cache-Control'] == 'public, max-age=86400'
+
+    post = Post.query.first()
+    post.audience = ['https://friend.example.com/']
+    db.session.commit()
+    rv = client.get(photo_post + '/files/image.jpg')
+    assert rv.status_code == 200
+    assert rv.headers['Cache-Control'] == 'private, max-age=86400'
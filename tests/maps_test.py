@@ -0,0 +1,83 @@
+from redwind import maps
+import os
+import time
+
+
+def fake_fetcher(query, path):
+    with open(path, 'wb') as f:
+        f.write(b'PNG ' + query.encode())
+
+
+def test_maps_are_fetched_in_the_background(app, client, mocker, tmpdir):
+    mocker.patch.dict(app.config, {'MAP_CACHE_DIR': str(tmpdir),
+                                   'MAP_FETCHER': fake_fetcher})
+    enqueue = mocker.patch('redwind.queue.enqueue')
+    markers = [maps.Marker(37.7, -122.4), maps.Marker(40.7, -74.0)]
+
+    with app.test_request_context('/'):
+        url = maps.get_map_image(600, 400, 13, markers[:1])
+        other = maps.get_map_image(600, 400, 13, markers)
+        assert url.startswith('/map/') and url != other
+        app.process_response(app.response_class())
+    # both maps are fetched by the same job, and not queued again
+    assert enqueue.call_count == 1
+    func, pending = enqueue.call_args[0]
+    assert len(pending) == 2
+    with app.test_request_context('/'):
+        maps.get_map_image(600, 400, 13, markers[:1])
+        app.process_response(app.response_class())
+    assert enqueue.call_count == 1
+
+    rv = client.get(url)
+    assert 200 == rv.status_code
+    assert 'no-cache' in rv.headers['cache-control']
+
+    func(pending)
+    rv = client.get(url)
+    assert rv.get_data().startswith(b'PNG ')
+    assert 'no-cache' not in rv.headers['cache-control']
+
+    with app.test_request_context('/'):
+        assert maps.get_map_image(600, 400, 13, markers[:1]) == url
+        app.process_response(app.response_class())
+    assert enqueue.call_count == 1
+
+
+def test_evict_maps(app, mocker, tmpdir):
+    mocker.patch.dict(app.config, {'MAP_CACHE_DIR': str(tmpdir)})
+    now = time.time()
+    for i in range(10):
+        path = str(tmpdir.join('{:032x}.png'.format(i)))
+        with open(path, 'wb') as f:
+            f.write(b'x' * 100)
+        os.utime(path, (now - 1000 + i, now - 1000 + i))
+
+    assert maps.evict_maps(max_bytes=2000) == 0
+    # the least recently used go first, down to 90% of the limit
+    assert maps.evict_maps(max_bytes=500) == 6
+    assert sorted(os.listdir(str(tmpdir))) == [
+        '{:032x}.png'.format(i) for i in range(6, 10)]
+
+
+def test_missing_maps_are_queued_again(app, client, mocker, tmpdir):
+    def failing_fetcher(query, path):
+        raise IOError('map service is down')
+
+    mocker.patch.dict(app.config, {'MAP_CACHE_DIR': str(tmpdir),
+                                   'MAP_FETCHER': failing_fetcher})
+    enqueue = mocker.patch('redwind.queue.enqueue')
+    with app.test_request_context('/'):
+        url = maps.get_map_image(600, 400, 13, [maps.Marker(37.7, -122.4)])
+        app.process_response(app.response_class())
+    func, pending = enqueue.call_args[0]
+    func(pending)
+
+    # the page isn't rendered again, but the map is still requested
+    enqueue.reset_mock()
+    rv = client.get(url)
+    assert 'no-cache' in rv.headers['cache-control']
+    enqueue.assert_called_once_with(maps.generate_maps, pending)
+
+    app.config['MAP_FETCHER'] = fake_fetcher
+    func(pending)
+    assert client.get(url).get_data().startswith(b'PNG ')
@@ -0,0 +1,188 @@
+import datetime
+import pytest
+from redwind import db, queue
+
+
+calls = []
+
+
+def record_call(value):
+    calls.append(value)
+    return value * 2
+
+
+def always_fail():
+    raise RuntimeError('nope')
+
+
+@pytest.fixture
+def sql_queue(app, mocker):
+    del calls[:]
+    mocker.patch.dict(app.config, {'QUEUE_MAX_ATTEMPTS': 3,
+                                   'QUEUE_RETRY_DELAY': 10})
+    return queue.SqlQueueImpl()
+
+
+def test_sql_queue_runs_jobs(sql_queue):
+    key = sql_queue.enqueue(record_call, 21)
+    assert sql_queue.query(key) == 'queued'
+    assert sql_queue.work_one()
+    assert calls == [21]
+    assert sql_queue.query(key) == 42
+    # nothing left to do
+    assert not sql_queue.work_one()
+
+
+def test_sql_queue_claims_once(sql_queue):
+    sql_queue.enqueue(record_call, 1)
+    job_id = sql_queue.claim('worker-a')
+    assert job_id
+    assert sql_queue.claim('worker-b') is None
+    job = queue.Job.query.get(job_id)
+    assert job.locked_by == 'worker-a'
+    assert job.attempts == 1
+
+    # a claim that has outlived QUEUE_JOB_TIMEOUT can be taken over
+    job.locked_at -= datetime.timedelta(hours=1)
+    db.session.commit()
+    assert sql_queue.claim('worker-b') == job_id
+
+
+def test_sql_queue_heartbeat(sql_queue, mocker):
+    sql_queue.enqueue(record_call, 1)
+    job_id = sql_queue.claim('worker-a')
+    job = queue.Job.query.get(job_id)
+    job.locked_at -= datetime.timedelta(hours=1)
+    db.session.commit()
+
+    # one refresh, then the job is done
+    done = mocker.Mock()
+    done.wait.side_effect = [False, True]
+    sql_queue.heartbeat(db.engine, job_id, 'worker-a', done)
+    # so the claim is no longer up for grabs
+    assert sql_queue.claim('worker-b') is None
+
+
+def taken_over(job_key):
+    queue.Job.query.filter_by(key=job_key).update(
+        {'locked_by': 'worker-b'}, synchronize_session=False)
+    db.session.commit()
+    return 'stale result'
+
+
+def test_sql_queue_drops_outcome_after_takeover(sql_queue):
+    key = sql_queue.enqueue(taken_over, None)
+    job = queue.Job.query.filter_by(key=key).first()
+    job.params = (taken_over, (key,), {})
+    db.session.commit()
+    assert sql_queue.work_one('worker-a')
+    # the job is worker-b's now; only its run may complete it
+    job = queue.Job.query.filter_by(key=key).first()
+    assert not job.complete and job.result is None
+    assert job.locked_by == 'worker-b'
+
+
+def test_sql_queue_retries_with_backoff(sql_queue):
+    key = sql_queue.enqueue(always_fail)
+    job = queue.Job.query.filter_by(key=key).first()
+
+    delays = []
+    for attempt in range(3):
+        # make the job due again
+        job.run_at = datetime.datetime.utcnow()
+        db.session.commit()
+        before = datetime.datetime.utcnow()
+        assert sql_queue.work_one()
+        job = queue.Job.query.filter_by(key=key).first()
+        assert 'RuntimeError' in job.error
+        delays.append(round((job.run_at - before).total_seconds()))
+        # not due until the backoff has passed
+        assert not sql_queue.work_one()
+
+    assert delays[:2] == [10, 20]
+    assert job.complete
+    assert job.attempts == 3
+    assert sql_queue.query(key) is None
+
+
+@pytest.fixture
+def redis_queue(app):
+    fakeredis = pytest.importorskip('fakeredis')
+    del calls[:]
+    # older fakeredis versions share one store between connections
+    connection = fakeredis.FakeStrictRedis()
+    connection.flushall()
+    return queue.RedisQueueImpl(None, 'testq', connection=connection)
+
+
+def run_redis_jobs(redis_queue, nworkers=2):
+    import concurrent.futures
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(nworkers) as pool:
+        while redis_queue.redis.llen('testq') or running:
+            redis_queue.step(pool, running, nworkers, timeout=0.1)
+
+
+def test_redis_queue_runs_jobs(redis_queue):
+    keys = [redis_queue.enqueue(record_call, i) for i in range(5)]
+    failed = redis_queue.enqueue(always_fail)
+    assert redis_queue.query(keys[0]) == 'queued'
+    run_redis_jobs(redis_queue)
+
+    assert sorted(calls) == [0, 1, 2, 3, 4]
+    assert [redis_queue.query(key) for key in keys] == [0, 2, 4, 6, 8]
+    assert isinstance(redis_queue.query(failed), RuntimeError)
+    assert not redis_queue.redis.llen(
+        redis_queue.inflight_key(redis_queue.worker_id))
+
+    stats = redis_queue.stats()
+    assert stats['enqueued'] == 6
+    assert stats['completed'] == 5
+    assert stats['failed'] == 1
+    assert stats['pending'] == 0
+
+
+def test_redis_queue_recovers_inflight(redis_queue):
+    key = redis_queue.enqueue(record_call, 7)
+    # simulate a worker that died after taking the job
+    dead = queue.RedisQueueImpl(None, 'testq', connection=redis_queue.redis)
+    dead.worker_id = 'deadhost:1'
+    dead.heartbeat()
+    assert len(dead.dequeue(1)) == 1
+    redis_queue.redis.delete(dead.heartbeat_key(dead.worker_id))
+
+    redis_queue.recover()
+    assert not redis_queue.redis.llen(dead.inflight_key(dead.worker_id))
+    run_redis_jobs(redis_queue)
+    assert redis_queue.query(key) == 14
+
+
+def test_redis_queue_legacy_messages(redis_queue):
+    import pickle
+    key = 'testq:result:legacy'
+    redis_queue.redis.lpush('testq', pickle.dumps(
+        (record_call, key, (3,), {})))
+    run_redis_jobs(redis_queue)
+    assert redis_queue.query(key) == 6
+
+
+def slow_call():
+    import time
+    time.sleep(0.3)
+    return 'finally'
+
+
+def test_redis_queue_job_timeout(app, redis_queue, mocker):
+    mocker.patch.dict(app.config, {'QUEUE_JOB_TIMEOUT': 0.1})
+    key = redis_queue.enqueue(slow_call)
+    import concurrent.futures
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        redis_queue.step(pool, running, 1, timeout=0.1)
+        redis_queue.step(pool, running, 1, timeout=0.2)
+        redis_queue.step(pool, running, 1, timeout=0.1)
+        assert isinstance(redis_queue.query(key), TimeoutError)
+    # the late result doesn't replace the timeout
+    assert isinstance(redis_queue.query(key), TimeoutError)
+    assert redis_queue.stats()['timed_out'] == 1
+    assert redis_queue.stats()['completed'] == 0
@@ -0,0 +1,77 @@
+from redwind import db, rerender, util
+from redwind.models import Post, Contact, Nick
+
+
+def make_post(path, content, content_html=None):
+    post = Post('note')
+    post.path = path
+    post.content = content
+    post.content_html = content_html
+    db.session.add(post)
+    return post
+
+
+def test_rerender_writes_only_changed_posts(app, tmpdir, mocker):
+    posts = [make_post('2014/12/{}'.format(ii), 'post *{}*'.format(ii))
+             for ii in range(5)]
+    db.session.commit()
+    # the first two are already up to date
+    for post in posts[:2]:
+        post.content_html = util.markdown_filter(
+            post.content, img_path=post.get_image_path(),
+            person_processor=util.person_to_at_name)
+    db.session.commit()
+    ids = [post.id for post in posts]
+
+    # pretend an earlier run got through the first batch
+    checkpoint = str(tmpdir.join('checkpoint'))
+    rerender.write_checkpoint(checkpoint, ids[1])
+    render = mocker.spy(rerender, 'render')
+    stats = rerender.rerender_posts(batch_size=2, processes=1,
+                                    checkpoint=checkpoint)
+    assert render.call_count == 3
+    assert stats['posts'] == 3 and stats['changed'] == 3
+    assert not tmpdir.join('checkpoint').exists()
+
+    db.session.expire_all()
+    assert Post.query.get(ids[4]).content_html == '<p>post <em>4</em></p>'
+    assert Post.query.get(ids[4]).updated
+    assert not Post.query.get(ids[0]).updated
+
+    # a second run has nothing left to write
+    stats = rerender.rerender_posts(batch_size=2, processes=1)
+    assert stats['posts'] == 5 and stats['changed'] == 0
+
+
+def test_contact_change_rerenders_mentions(app, client, auth, mocker):
+    enqueue = mocker.patch('redwind.queue.enqueue')
+    mentions = make_post('2014/12/a', 'hi @Han!')
+    legacy = make_post('2014/12/b', 'hi [[Han Solo]]')
+    make_post('2014/12/c', 'hi @leia')
+    contact = Contact(name='Han Solo')
+    contact.nicks = [Nick(name='han')]
+    db.session.add(contact)
+    db.session.commit()
+
+    client.post('/edit/contact', data={
+        'id': contact.id, 'name': 'Han Solo', 'url': 'https://falcon.example',
+        'nicks': 'captain'})
+    enqueue.assert_called_once_with(rerender.do_rerender_posts,
+                                    [mentions.id, legacy.id], processes=1)
+
+
+def test_rerender_ignores_cached_contacts(app, mocker):
+    post = make_post('2014/12/a', 'hi @han')
+    contact = Contact(name='Han Solo', url='https://han.example')
+    contact.nicks = [Nick(name='han')]
+    db.session.add(contact)
+    db.session.commit()
+    rerender.rerender_posts([post.id], processes=1)
+    assert 'https://han.example' in Post.query.get(post.id).content_html
+
+    # changed by another process, which couldn't clear this one's cache
+    Contact.query.get(contact.id).url = 'https://falcon.example'
+    db.session.commit()
+    stats = rerender.rerender_posts([post.id], processes=1)
+    assert stats['changed'] == 1
+    assert 'https://falcon.example' in Post.query.get(post.id).content_html
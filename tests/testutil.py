@@ -17,6 +17,7 @@ class FakeResponse:
         self.content = text and bytes(text, 'utf8')
         self.url = url
         self.headers = {'content-type': 'text/html'}
+        self.encoding = 'utf-8'
 
     def __repr__(self):
         return 'FakeResponse(status={}, text={}, url={})'.format(
@@ -25,6 +26,14 @@ class FakeResponse:
     def raise_for_status(self):
         pass
 
+    def iter_content(self, chunk_size=1):
+        content = self.content or b''
+        for i in range(0, len(content), chunk_size):
+            yield content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
 
 class FakeUrlOpen:
     def __init__(self, url=None, info=None):
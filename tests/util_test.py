@@ -72,7 +72,7 @@ def test_autolink_trailing_slash():
     assert result == '<a href="http://hel.lo/world/">hel.lo/world/</a>'
 
 
-def test_no_autolink_in_code_block():
+def test_no_autolink_in_code_block(app):
     result = util.markdown_filter("""
 Don't autolink @-names or URLs inside a fenced code block.
 
@@ -117,6 +117,24 @@ def test_autolink_urls():
             inp, person_processor=None, url_processor=simple_url_marker)
 
 
+def test_autolink_leaves_markup_alone():
+    """Markup passes through untouched, and text is matched unescaped
+    """
+    test_cases = [
+        ('<p class="x">a &amp; b &lt;x&gt; e.com/?a=1&amp;b=2</p>',
+         '<p class="x">a &amp; b &lt;x&gt; <a href="http://e.com/?a=1&amp;b=2">'
+         'e.com/?a=1&amp;b=2</a></p>'),
+        ('<script>if (a<b) f("http://x.com")</script> y.com',
+         '<script>if (a<b) f("http://x.com")</script> '
+         '<a href="http://y.com">y.com</a>'),
+        ('<!-- z.com --><br /><a title="q.com">q.com</a>',
+         '<!-- z.com --><br /><a title="q.com">q.com</a>'),
+    ]
+
+    for inp, out in test_cases:
+        assert out == util.autolink(inp, person_processor=None)
+
+
 def test_autolink_people(db):
     """Exercise the @-name matching regex, without contacts
     """
@@ -141,3 +159,113 @@ def test_autolink_people(db):
         assert out == util.autolink(
             inp, person_processor=simple_name_marker,
             url_processor=None)
+
+
+def test_html_document_parses_once(mocker):
+    import mf2py
+    parser = mocker.spy(mf2py, 'Parser')
+    doc = util.HtmlDocument("""<!DOCTYPE html>
+    <html><head><title>Source</title></head>
+    <body class="h-entry">
+      <template><a href="http://target.com/">hidden</a></template>
+      <a class="u-in-reply-to" href="http://target.com/1">reply</a>
+      <p class="e-content">Some text</p>
+    </body></html>""", 'http://source.com/1')
+
+    assert doc.find_links(['http://target.com/1'])['class'] == ['u-in-reply-to']
+    blob = doc.to_mf2()
+    assert blob['items'][0]['type'] == ['h-entry']
+    assert doc.to_mf2() is blob
+    # mf2py worked on our tree rather than a copy or a fresh parse
+    assert parser.call_count == 1
+    assert parser.call_args[1]['doc'] is doc.soup
+    assert doc.soup.title.string == 'Source'
+
+
+def test_fetch_html_caps_and_sniffs(app, mocker):
+    from testutil import FakeResponse
+    session = mocker.patch('redwind.util.get_http_session')()
+    mocker.patch.dict(app.config, {'FETCH_MAX_BYTES': 1024})
+
+    # no Content-Length (e.g. chunked); the cap still applies
+    session.get.return_value = FakeResponse('x' * 2048)
+    with pytest.raises(util.FetchError):
+        util.fetch_html('http://example.com/huge')
+
+    image = FakeResponse('GIF89a')
+    image.headers['content-type'] = 'image/gif'
+    session.get.return_value = image
+    with pytest.raises(util.FetchError):
+        util.fetch_html('http://example.com/cat.gif')
+
+    page = FakeResponse('<meta charset="iso-8859-2"><p>hi</p>')
+    page.encoding = None
+    session.get.return_value = page
+    assert util.fetch_html('http://example.com/').encoding == 'iso-8859-2'
+
+    # error pages are returned, not refused
+    session.get.return_value = FakeResponse(status_code=410)
+    assert util.fetch_html('http://example.com/gone').status_code == 410
+
+
+def test_at_names_resolved_in_one_query(contacts, client, auth):
+    import sqlalchemy
+    from redwind import db
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        # cache generations are checked now and then as well
+        if 'cache_generation' not in statement:
+            statements.append(statement)
+    sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        text = '@luke @leia @han @chewie and @nobody'
+        first = util.autolink(text)
+        assert len(statements) == 1
+        # served from the contact cache the second time
+        assert util.autolink(text) == first
+        assert len(statements) == 1
+
+        assert util.convert_legacy_people_to_at_names(
+            '[[Han Solo]], [[Chewbacca]] and [[Han Solo]]') \
+            == '@han, @chewie and @han'
+        assert len(statements) == 2
+    finally:
+        sqlalchemy.event.remove(db.engine, 'before_cursor_execute', count)
+
+    # editing a contact evicts the cached copies
+    han = Contact.query.filter_by(name='Han Solo').first()
+    client.post('/edit/contact', data={
+        'id': han.id, 'name': 'Han Solo', 'url': 'https://falcon.example',
+        'nicks': 'han,captain'})
+    assert 'https://falcon.example' in util.autolink('@captain')
+
+
+def test_markdown_render_cache(contacts, client, auth, mocker):
+    convert = mocker.spy(util.get_markdown(), 'convert')
+    text = 'Hello @han, see example.com'
+    first = util.markdown_filter(text)
+    assert 'https://millennium.falcon' in first
+    assert util.markdown_filter(text) == first
+    assert convert.call_count == 1
+
+    # different render options are cached separately
+    plain = util.markdown_filter(text, url_processor=None,
+                                 person_processor=None)
+    assert '<a' not in plain
+    assert convert.call_count == 2
+
+    # editing a contact re-renders the posts that mention them
+    han = Contact.query.filter_by(name='Han Solo').first()
+    client.post('/edit/contact', data={
+        'id': han.id, 'name': 'Han Solo', 'url': 'https://falcon.example',
+        'nicks': 'han'})
+    assert 'https://falcon.example' in util.markdown_filter(text)
+    assert convert.call_count == 3
+
+    # renders with @-names expire along with the contacts
+    from redwind import cache
+    cache_set = mocker.spy(cache, 'set')
+    util.markdown_filter('Bye @han')
+    util.markdown_filter('Bye', person_processor=None)
+    assert [call[0][3] for call in cache_set.call_args_list] == [300, 3600]
@@ -144,6 +144,89 @@ def test_tag_cloud(client, silly_posts):
     assert re.search('<a[^>]*title="3"[^>]*>interesting', content)
 
 
+def test_tag_stats(client, silly_posts):
+    from redwind import tags
+    assert tags.top_tags(2) == ['interesting', 'good']
+
+    # drafts count toward the editor's tags but aren't public
+    rv = client.post('/save_new', data={
+        'post_type': 'note',
+        'content': 'Not ready yet',
+        'tags': ['good', 'unfinished'],
+        'action': 'save_draft',
+    })
+    assert 302 == rv.status_code
+    assert dict(tags.tag_counts(public=False))['good'] == 3
+    assert dict(tags.tag_counts(public=True))['good'] == 2
+    assert 'unfinished' not in dict(tags.tag_counts(public=True))
+    assert 'unfinished' in tags.tag_names()
+
+    # deleting a post takes its tags out of the counts
+    rv = client.get('/delete?id=2')
+    assert 302 == rv.status_code
+    counts = dict(tags.tag_counts(public=True))
+    assert counts['interesting'] == 2
+    assert 'thoughtful' not in counts
+    assert 'thoughtful' not in tags.tag_names()
+
+    # decaying rebases the scores without reordering them
+    before = tags.top_tags(10)
+    tags.decay_tag_scores()
+    assert tags.top_tags(10) == before
+
+
+def test_save_post_paths_and_tags(client, silly_posts):
+    from redwind import db
+    from redwind.models import Post, Tag
+    for _ in range(2):
+        rv = client.post('/save_new', data={
+            'post_type': 'article',
+            'title': 'First interesting article',
+            'content': 'Said it twice',
+            'tags': ['good', 'new', 'good'],
+            'action': 'publish_quietly',
+        })
+        assert 302 == rv.status_code
+    assert rv.location.endswith('first-interesting-article-2')
+    post = Post.query.order_by(Post.id.desc()).first()
+    assert [tag.name for tag in post.tags] == ['good', 'new']
+    assert Tag.query.filter_by(name='new').count() == 1
+
+    # gaps are reused, and unrelated paths that share the prefix ignored
+    base = post.path[:-len('-2')]
+    post.path = base + '-3'
+    extra = Post('note')
+    extra.path = base + '-tips'
+    db.session.add(extra)
+    db.session.commit()
+    assert Post.allocate_path(base) == base + '-2'
+    assert Post.allocate_path(base + '-x') == base + '-x'
+
+    tags = Tag.load_or_create(['zzz', 'good', 'aaa', 'zzz'])
+    assert [tag.name for tag in tags] == ['zzz', 'good', 'aaa']
+    assert all(tag.id for tag in tags)
+
+
+def test_claim_path_retries(app, mocker):
+    from redwind import db
+    from redwind.models import Post
+    first = Post('note')
+    first.path = '2014/12/taken'
+    db.session.add(first)
+    db.session.commit()
+
+    # another save took the path between the lookup and the write
+    allocate = mocker.patch.object(
+        Post, 'allocate_path', side_effect=['2014/12/taken',
+                                            '2014/12/taken-1'])
+    post = Post('note')
+    post.content = 'Second'
+    assert post.claim_path('2014/12/taken') == '2014/12/taken-1'
+    db.session.commit()
+    assert allocate.call_count == 2
+    assert Post.load_by_path('2014/12/taken-1').content == 'Second'
+
+
 def test_atom_redirects(client):
     rv = client.get('/all.atom')
     assert 302 == rv.status_code
@@ -235,3 +318,329 @@ def test_indieauth_login(app, client, mocker):
     mock_login.assert_called_once_with(User('example.com'), remember=True)
     client.get('/logout')
     mock_logout.assert_called_once_with()
+
+
+def test_listing_cache(client, silly_posts, mocker):
+    rv = client.get('/tags/interesting')
+    assert 'Second interesting article' in rv.get_data(as_text=True)
+
+    # a second request is served from the cache without hitting the db
+    collect_posts = mocker.patch('redwind.views.collect_posts')
+    rv = client.get('/tags/interesting')
+    assert 200 == rv.status_code
+    assert 'Second interesting article' in rv.get_data(as_text=True)
+    # query string arguments the page doesn't read share the entry
+    rv = client.get('/tags/interesting', query_string={'x': '1'})
+    assert 'Second interesting article' in rv.get_data(as_text=True)
+    assert not collect_posts.called
+    mocker.stopall()
+
+    # saving a post evicts the listings it appears in
+    mocker.patch('requests.get').return_value = FakeResponse()
+    mocker.patch('redwind.queue.enqueue')
+    rv = client.post('/save_new', data={
+        'post_type': 'article',
+        'title': 'Third interesting article',
+        'content': 'Even more interesting',
+        'tags': ['interesting'],
+        'action': 'publish_quietly',
+    })
+    assert 302 == rv.status_code
+    text = client.get('/tags/interesting').get_data(as_text=True)
+    assert 'Third interesting article' in text
+
+
+def test_listing_cache_shared_invalidation(app, client, silly_posts,
+                                           mocker):
+    from redwind import cache, db
+    mocker.patch.dict(app.config, {'CACHE_GENERATION_CHECK_INTERVAL': 0})
+    client.get('/tags/interesting')
+
+    # another process (e.g. qworker) invalidates the tag's listings
+    db.session.execute(
+        cache.CacheGeneration.__table__.update()
+        .where(cache.CacheGeneration.namespace == 'tag:interesting')
+        .values(generation=cache.CacheGeneration.generation + 1))
+    db.session.commit()
+    collect_posts = mocker.patch('redwind.views.collect_posts',
+                                 return_value=([], None))
+    client.get('/tags/interesting')
+    assert collect_posts.called
+
+
+def test_conditional_get(app, client, silly_posts, mocker):
+    rv = client.get('/tags/interesting')
+    assert rv.headers['Cache-Control'] == 'private, no-cache'
+    admin_etag = rv.headers['ETag']
+
+    client.get('/logout')
+    rv = client.get('/tags/interesting')
+    etag = rv.headers['ETag']
+    assert etag.startswith('W/') and etag != admin_etag
+    assert rv.headers['Cache-Control'] == 'public, max-age=60'
+    assert 'Cookie' in rv.headers['Vary']
+    last_modified = rv.headers['Last-Modified']
+
+    # answered from the validator, without collecting the posts
+    collect_posts = mocker.patch('redwind.views.collect_posts')
+    rv = client.get('/tags/interesting', headers={'If-None-Match': etag})
+    assert 304 == rv.status_code
+    assert rv.headers['ETag'] == etag
+    rv = client.get('/tags/interesting',
+                    headers={'If-Modified-Since': last_modified})
+    assert 304 == rv.status_code
+    assert not collect_posts.called
+    mocker.stopall()
+
+    # feeds and other pages have their own validators
+    rv = client.get('/tags/interesting', query_string={'feed': 'atom'})
+    assert rv.headers['ETag'] != etag
+    assert rv.headers['Cache-Control'] == 'public, max-age=300'
+    rv = client.get('/everything', headers={'If-None-Match': etag})
+    assert 200 == rv.status_code
+
+    from redwind.models import Post
+    permalink = '/' + Post.load_by_id(6).path
+    post_etag = client.get(permalink).headers['ETag']
+    assert 304 == client.get(permalink, headers={
+        'If-None-Match': post_etag}).status_code
+    assert client.get(permalink).headers['Cache-Control'] \
+        == 'public, max-age=60'
+
+    # a new post changes the page
+    client.get('/bypass_login')
+    mocker.patch('requests.get').return_value = FakeResponse()
+    mocker.patch('redwind.queue.enqueue')
+    rv = client.post('/save_new', data={
+        'post_type': 'article',
+        'title': 'Third interesting article',
+        'content': 'Even more interesting',
+        'tags': ['interesting'],
+        'action': 'publish_quietly',
+    })
+    assert 302 == rv.status_code
+    rv = client.post('/save_new', data={
+        'post_type': 'note',
+        'content': 'Not ready yet',
+        'action': 'save_draft',
+    })
+    draft_url = rv.location
+    client.get('/logout')
+    rv = client.get('/tags/interesting', headers={'If-None-Match': etag})
+    assert 200 == rv.status_code
+    assert 'Third interesting article' in rv.get_data(as_text=True)
+
+    # drafts are never kept by shared caches
+    rv = client.get(draft_url)
+    assert 200 == rv.status_code
+    assert rv.headers['Cache-Control'] == 'private, no-cache'
+
+
+def test_etag_matches_cached_body(client, silly_posts, mocker):
+    from redwind import db
+    from redwind.models import Post
+    client.get('/logout')
+    etag = client.get('/tags/interesting').headers['ETag']
+
+    # a change the listing cache wasn't told about still shows up
+    post = Post.load_by_id(6)
+    post.mention_counts = {'like': 1}
+    post.mentions_updated = datetime.datetime.utcnow()
+    db.session.commit()
+    rv = client.get('/tags/interesting', headers={'If-None-Match': etag})
+    assert 200 == rv.status_code
+    assert rv.headers['ETag'] != etag
+    assert '1 Like' in rv.get_data(as_text=True)
+
+    # ...and the new body is cached under the new ETag
+    collect_posts = mocker.patch('redwind.views.collect_posts')
+    again = client.get('/tags/interesting', query_string={'x': '1'})
+    assert again.headers['ETag'] == rv.headers['ETag']
+    assert again.get_data() == rv.get_data()
+    assert not collect_posts.called
+
+
+def test_post_updated(client, silly_posts):
+    from redwind.models import Post
+    post = Post.load_by_id(6)
+    published = post.published
+    permalink = '/' + post.path
+    etag = client.get(permalink).headers['ETag']
+    feed = client.get('/', query_string={'feed': 'atom'})
+    feed_etag = feed.headers['ETag']
+
+    rv = client.post('/save_edit', data={
+        'post_id': 6,
+        'post_type': 'article',
+        'title': 'Second interesting article',
+        'content': 'Edited to be even more interesting',
+        'action': 'publish_quietly',
+    })
+    assert 302 == rv.status_code
+    post = Post.load_by_id(6)
+    assert post.published == published
+    assert post.updated > published
+    assert post.last_modified == post.updated
+
+    rv = client.get(permalink, headers={'If-None-Match': etag})
+    assert 200 == rv.status_code
+    assert 'Edited to be even more interesting' in rv.get_data(as_text=True)
+    feed = client.get('/', query_string={'feed': 'atom'},
+                      headers={'If-None-Match': feed_etag})
+    assert 200 == feed.status_code
+    # the feed is as new as its newest entry
+    updated = re.findall('<updated>(.*?)</updated>',
+                         feed.get_data(as_text=True))
+    assert updated[0] == updated[1]
+
+
+def test_stream_pagination(app, silly_posts):
+    from redwind import views
+    seen = []
+    before_ts = None
+    while True:
+        with app.test_request_context('/everything'):
+            posts, older = views.collect_posts(
+                None, before_ts, 4, None, include_hidden=True)
+        seen += [post.id for post in posts]
+        assert all(post.tags for post in posts)
+        if not older:
+            break
+        before_ts = re.search('/before-([0-9-]+)', older).group(1)
+    assert seen == [6, 5, 4, 3, 2, 1]
+
+
+def test_settings_snapshot(app, client, auth, mocker):
+    from redwind import db
+    from redwind.models import Setting, SettingsVersion, get_settings, \
+        load_settings, invalidate_settings, get_settings_version
+    from flask import g
+    settings = get_settings()
+    assert settings.site_url == 'http://example.com'
+    with pytest.raises(AttributeError):
+        settings.site_url = 'http://evil.example.com'
+
+    # saving from the settings page publishes a new snapshot
+    rv = client.post('/settings', data={'timezone': 'America/New_York'})
+    assert 302 == rv.status_code
+    assert get_settings().timezone == 'America/New_York'
+    assert get_settings() is load_settings()
+
+    # a change made by another worker is only noticed once the check
+    # interval has passed
+    Setting.query.get('timezone').value = 'Europe/London'
+    SettingsVersion.query.get(1).version += 1
+    db.session.commit()
+    del g.rw_settings
+    assert load_settings().timezone == 'America/New_York'
+
+    mocker.patch('time.time').return_value = load_settings.checked + 60
+    assert load_settings().timezone == 'Europe/London'
+
+    # the version is bumped in SQL, so a bump made since this session
+    # loaded the row isn't lost
+    row = SettingsVersion.query.get(1)
+    version = row.version
+    db.session.execute(SettingsVersion.__table__.update().values(
+        version=SettingsVersion.__table__.c.version + 1))
+    invalidate_settings()
+    assert get_settings_version() == version + 2
+
+
+def test_mention_pages(app, client, silly_posts, mocker):
+    from redwind import db, views
+    from redwind.models import Post, Mention
+    post = Post.load_by_path('{:%Y/%m}/first-interesting-article'.format(
+        datetime.date.today()))
+    for ii in range(5):
+        mention = Mention()
+        mention.reftype = 'like' if ii % 2 else 'reply'
+        mention.permalink = 'http://foreign/{}'.format(ii)
+        mention.published = datetime.datetime(2014, 12, 1, 12, ii)
+        post.mentions.append(mention)
+    post.update_mention_counts()
+    db.session.commit()
+
+    mocker.patch.dict(app.config, {'MENTIONS_PER_PAGE': 2})
+    rv = client.get(post.permalink)
+    text = rv.get_data(as_text=True)
+    assert 'foreign/1' in text and 'foreign/2' not in text
+    more = re.search('class="more-mentions" href="([^"]+)"', text).group(1)
+    assert more.endswith('#mentions')
+    text = client.get(more[:-len('#mentions')]).get_data(as_text=True)
+    assert 'foreign/3' in text and 'foreign/1' not in text
+
+    with app.test_request_context():
+        views.load_mention_previews([post], 1)
+    assert {reftype: [m.permalink for m in mentions] for reftype, mentions
+            in post.mention_previews.items()} == {
+                'reply': ['http://foreign/4'], 'like': ['http://foreign/3']}
+
+    # an rsvp and its copy backfed from twitter
+    for ii, (author, permalink) in enumerate((
+            ('Original RSVP', 'http://foreign/rsvp'),
+            ('Backfed RSVP', 'https://twitter.com/foreign/status/1'))):
+        mention = Mention()
+        mention.reftype = 'rsvp'
+        mention.author_name = author
+        mention.permalink = permalink
+        mention.published = datetime.datetime(2014, 12, 2, ii)
+        post.mentions.append(mention)
+    post.mentions[-2].syndication = ['https://twitter.com/foreign/status/1']
+    post.update_mention_counts()
+    db.session.commit()
+    text = client.get(post.permalink).get_data(as_text=True)
+    assert 'Original RSVP' in text and 'Backfed RSVP' not in text
+
+    # the other theme pages through them too, without loading them all
+    mocker.patch.dict(app.config, {'DEFAULT_THEME': 'oldskool'})
+    from redwind.models import Setting, invalidate_settings
+    db.session.add_all([Setting(key='avatar_prefix', value='me'),
+                        Setting(key='avatar_suffix', value='png')])
+    db.session.commit()
+    invalidate_settings()
+    mocker.patch.object(Post, 'group_mentions',
+                        side_effect=AssertionError('loaded every mention'))
+    text = client.get(post.permalink).get_data(as_text=True)
+    assert '3 replies' in text and 'foreign/2' not in text
+    assert 'Original RSVP' in text and 'Backfed RSVP' not in text
+    assert 'class="more-mentions"' in text
+
+
+def test_search(client, silly_posts):
+    from redwind.models import Post
+    text = client.get('/search', query_string={'q': 'interesting'})\
+                 .get_data(as_text=True)
+    assert 'First interesting article' in text
+    assert 'Second interesting article' in text
+    assert 'Something really thoughtful and <mark>interesting</mark>' in text
+
+    text = client.get('/search', query_string={'q': 'jokes'})\
+                 .get_data(as_text=True)
+    assert '<mark>joke</mark>' in text
+
+    post = Post.query.filter_by(title='First interesting article').first()
+    client.get('/delete', query_string={'id': post.id})
+    text = client.get('/search', query_string={'q': 'thoughtful'})\
+                 .get_data(as_text=True)
+    assert 'First interesting article' not in text
+
+
+def test_search_without_fts5(client, silly_posts, mocker):
+    from redwind import db, search
+    mocker.patch.object(search, 'fts5_available', return_value=False)
+    # without FTS5 the index table never gets created
+    db.engine.execute('DROP TABLE post_search')
+    search.create_index()
+    assert search.reindex_all() == 0
+
+    text = client.get('/search', query_string={'q': 'interesting'})\
+                 .get_data(as_text=True)
+    assert 'First interesting article' in text
+    assert 'Second interesting article' in text
+    assert 'Something really thoughtful and <mark>interesting</mark>' in text
+
+    text = client.get('/search', query_string={'q': 'thoughtful article'})\
+                 .get_data(as_text=True)
+    assert 'First interesting article' in text
+    assert 'Second interesting article' not in text
@@ -32,7 +32,7 @@ def test_process_wm(client, target_url, mocker):
     source_url = 'http://foreign/permalink/url'
 
     urlopen = mocker.patch('urllib.request.urlopen')
-    getter = mocker.patch('requests.get')
+    getter = mocker.patch('redwind.util.get_http_session')().get
 
     urlopen.return_value = FakeUrlOpen(target_url)  # follows redirects
     getter.return_value = FakeResponse("""
@@ -57,7 +57,8 @@ def test_process_wm(client, target_url, mocker):
     assert result.create
     assert not result.delete
     assert not result.error
-    getter.assert_called_once_with('http://foreign/permalink/url', timeout=30)
+    getter.assert_called_once_with('http://foreign/permalink/url',
+                                   stream=True, headers={}, timeout=(5, 30))
 
 
 def test_process_wm_no_target_post(client, mocker):
@@ -81,7 +82,7 @@ def test_process_wm_deleted(client, target_url, mocker):
     source_url = 'http://foreign/permalink/url'
 
     urlopen = mocker.patch('urllib.request.urlopen')
-    getter = mocker.patch('requests.get')
+    getter = mocker.patch('redwind.util.get_http_session')().get
 
     urlopen.return_value = FakeUrlOpen(target_url)  # follows redirects
     getter.return_value = FakeResponse(status_code=410)
@@ -94,4 +95,37 @@ def test_process_wm_deleted(client, target_url, mocker):
     assert result.create is False
     assert result.delete is True
     assert result.error is None
-    getter.assert_called_once_with('http://foreign/permalink/url', timeout=30)
+    getter.assert_called_once_with('http://foreign/permalink/url',
+                                   stream=True, headers={}, timeout=(5, 30))
+
+
+def test_mention_counts(client, target_url, mocker):
+    from redwind.models import Post, Mention
+    urlopen = mocker.patch('urllib.request.urlopen')
+    getter = mocker.patch('redwind.util.get_http_session')().get
+    urlopen.return_value = FakeUrlOpen(target_url)
+    getter.return_value = FakeResponse("""
+    <html><body class="h-entry">
+      <a href="{}" class="u-like-of">Liked</a>
+      <a href="http://foreign/like" class="u-url">Permalink</a>
+      <a href="https://twitter.com/foreign/status/1" class="u-syndication">
+        on Twitter</a>
+    </body></html>""".format(target_url))
+
+    result = wm_receiver.process_webmention(
+        'http://foreign/like', target_url, None)
+    assert result['status'] == 'success'
+    post = Post.load_by_path(target_url.split('/', 3)[3])
+    assert post.mention_counts == {'like': 1}
+    assert post.mentions_updated
+    assert '1 Like' in client.get('/').get_data(as_text=True)
+
+    # the same like, backfed from twitter, isn't counted twice
+    backfed = Mention()
+    backfed.reftype = 'like'
+    backfed.permalink = 'https://twitter.com/foreign/status/1'
+    post.mentions.append(backfed)
+    post.update_mention_counts()
+    assert post.mention_counts == {'like': 1}
+    assert [m.permalink for m in post.likes] == ['http://foreign/like']
+    assert post.likes[0]._children == [backfed]
@@ -1,11 +1,17 @@
 import pytest
-from redwind.models import Post
+from redwind.models import Post, WebmentionEndpoint
 from redwind.plugins import wm_sender
 from redwind import db
-from testutil import FakeResponse, FakeUrlOpen, FakeUrlMetadata
+from redwind import hooks
+from testutil import FakeResponse
 import urllib
 
 
+@pytest.fixture(autouse=True)
+def endpoint_cache(app):
+    wm_sender.get_endpoint_cache.cached = None
+
+
 def test_queue_wm_sender(client, auth, mocker):
     enqueue = mocker.patch('redwind.queue.enqueue')
     client.post('/save_new', data={
@@ -13,13 +19,19 @@ def test_queue_wm_sender(client, auth, mocker):
         'content': 'Some content',
     })
     post = Post.query.first()
-    enqueue.assert_called_with(wm_sender.do_send_webmentions, post.id)
+    # the post-saved hooks are queued together as one job
+    func, hook, args, kwargs = enqueue.call_args[0]
+    assert (func, hook) == (hooks.run_deferred, 'post-saved')
+    # and the job sends the webmentions itself
+    enqueue.reset_mock()
+    handle = mocker.patch('redwind.plugins.wm_sender.handle_new_or_edit')
+    func(hook, args, kwargs)
+    assert handle.call_args[0][0].id == post.id
+    assert not enqueue.called
 
 
 def test_send_wms(client, mocker):
-    getter = mocker.patch('requests.get')
-    poster = mocker.patch('requests.post')
-    urlopen = mocker.patch('urllib.request.urlopen')
+    session = mocker.patch('redwind.util.get_http_session')()
 
     post = Post('note')
     post.content = 'This note links to [wikipedia](https://en.wikipedia.org/wiki/Webmention)'
@@ -28,21 +40,146 @@ def test_send_wms(client, mocker):
     db.session.add(post)
     db.session.commit()
 
-    urlopen.return_value = FakeUrlOpen(
-        info=FakeUrlMetadata(content_type='text/html', content_length=256))
-
-    getter.return_value = FakeResponse(text="""<!DOCTYPE html>
+    session.get.return_value = FakeResponse(text="""<!DOCTYPE html>
     <html>
       <link rel="webmention" href="https://en.wikipedia.org/endpoint">
-    </html>""")
+    </html>""", url='https://en.wikipedia.org/wiki/Webmention')
+    session.post.return_value = FakeResponse()
 
-    wm_sender.do_send_webmentions(post.id)
+    results = wm_sender.do_send_webmentions(post, {})
 
-    getter.assert_called_with('https://en.wikipedia.org/wiki/Webmention')
-    poster.assert_called_with('https://en.wikipedia.org/endpoint', data={
+    # a single fetch per target
+    session.get.assert_called_once_with(
+        'https://en.wikipedia.org/wiki/Webmention', stream=True,
+        headers={}, timeout=(5, 30))
+    session.post.assert_called_with('https://en.wikipedia.org/endpoint', data={
         'source': post.permalink,
         'target': 'https://en.wikipedia.org/wiki/Webmention',
     }, headers={
         'content-type': 'application/x-www-form-urlencoded',
         'accept': 'application/json',
-    })
+    }, timeout=30)
+    assert len(results) == 1
+    assert results[0]['success']
+    assert set(results[0]['timing']) == {'fetch', 'send', 'total'}
+
+
+def test_send_wms_pingback_and_rejects(client, mocker):
+    session = mocker.patch('redwind.util.get_http_session')()
+
+    post = Post('note')
+    post.content_html = (
+        '<a href="http://pingback.example.com/">pb</a> '
+        '<a href="http://example.com/cat.jpg">cat</a> '
+        '<a href="http://example.com/huge">huge</a> '
+        '<a href="http://pingback.example.com/">again</a>')
+    post.path = '2014/11/wm-sender-test-2'
+    db.session.add(post)
+    db.session.commit()
+
+    pingback = FakeResponse(text='<html></html>',
+                            url='http://pingback.example.com/')
+    pingback.headers['x-pingback'] = 'http://pingback.example.com/xmlrpc'
+    image = FakeResponse(url='http://example.com/cat.jpg')
+    image.headers['content-type'] = 'image/jpeg'
+    huge = FakeResponse(text='x' * 2097153,
+                        url='http://example.com/huge')
+    responses = {r.url: r for r in (pingback, image, huge)}
+    session.get.side_effect = lambda url, **kwargs: responses[url]
+    session.post.return_value = FakeResponse()
+
+    results = {r['target']: r for r in wm_sender.do_send_webmentions(post, {})}
+    # duplicate links are only sent once
+    assert session.get.call_count == 3
+    assert results['http://pingback.example.com/']['success']
+    assert session.post.call_args[0] == ('http://pingback.example.com/xmlrpc',)
+    assert not results['http://example.com/cat.jpg']['success']
+    assert 'image/jpeg is not allowed' in results['http://example.com/cat.jpg']['explanation']
+    assert not results['http://example.com/huge']['success']
+    assert 'too large' in results['http://example.com/huge']['explanation']
+
+
+def make_post(*urls):
+    post = Post('note')
+    post.content_html = ' '.join('<a href="{}">link</a>'.format(url)
+                                 for url in urls)
+    post.path = Post.allocate_path('2014/11/wm-sender-cache-test')
+    db.session.add(post)
+    db.session.commit()
+    return post
+
+
+def test_endpoint_cache(client, mocker):
+    session = mocker.patch('redwind.util.get_http_session')()
+    session.post.return_value = FakeResponse()
+    post = make_post('http://example.com/fresh', 'http://example.com/stale',
+                     'http://example.com/private')
+
+    def make_response(url, max_age):
+        response = FakeResponse(
+            text='<link rel="webmention" href="/endpoint">', url=url)
+        response.headers['cache-control'] = max_age
+        response.headers['etag'] = '"v1"'
+        return response
+
+    responses = {
+        'http://example.com/fresh': make_response(
+            'http://example.com/fresh', 'max-age=3600'),
+        'http://example.com/stale': make_response(
+            'http://example.com/stale', 'max-age=0'),
+        'http://example.com/private': make_response(
+            'http://example.com/private', 'no-store'),
+    }
+    session.get.side_effect = lambda url, **kwargs: responses[url]
+    assert all(r['success'] for r in wm_sender.do_send_webmentions(post, {}))
+    assert session.get.call_count == 3
+    assert WebmentionEndpoint.query.get('http://example.com/fresh')\
+                                   .webmention == 'http://example.com/endpoint'
+    assert not WebmentionEndpoint.query.get('http://example.com/private')
+
+    # forget the in-memory copy; the database should be enough
+    wm_sender.get_endpoint_cache.cached = None
+    session.get.reset_mock()
+    not_modified = FakeResponse(status_code=304)
+    session.get.side_effect = lambda url, **kwargs: (
+        not_modified if kwargs['headers'] else responses[url])
+    assert all(r['success'] for r in wm_sender.do_send_webmentions(post, {}))
+
+    fetched = {c[0][0]: c[1]['headers'] for c in session.get.call_args_list}
+    # fresh entry is not fetched, stale one is revalidated, and the
+    # no-store page is fetched from scratch
+    assert set(fetched) == {'http://example.com/stale',
+                            'http://example.com/private'}
+    assert fetched['http://example.com/stale'] == {'If-None-Match': '"v1"'}
+    assert fetched['http://example.com/private'] == {}
+    assert session.post.call_count == 6
+
+
+def test_endpoint_cache_host_wide(client, mocker):
+    session = mocker.patch('redwind.util.get_http_session')()
+    session.post.return_value = FakeResponse()
+
+    response = FakeResponse(text='<html></html>', url='http://example.com/a')
+    response.headers['link'] = '<http://example.com/wm>; rel="webmention"'
+    session.get.return_value = response
+    # a page's endpoint may be its own, e.g. on a multi-user host
+    wm_sender.do_send_webmentions(make_post('http://example.com/a'), {})
+    assert WebmentionEndpoint.query.get('http://example.com/a')
+    assert not WebmentionEndpoint.query.get('host:example.com')
+
+    # but the root page's endpoint is taken for the whole host
+    response.url = 'http://example.com/'
+    wm_sender.do_send_webmentions(make_post('http://example.com/'), {})
+    assert WebmentionEndpoint.query.get('host:example.com')
+
+    session.get.reset_mock()
+    results = wm_sender.do_send_webmentions(
+        make_post('http://example.com/b'), {})
+    assert results[0]['success']
+    assert not session.get.called
+    assert session.post.call_args[0] == ('http://example.com/wm',)
+
+    # a failed send forgets the endpoint so it is rediscovered
+    session.post.return_value = FakeResponse(status_code=410)
+    wm_sender.do_send_webmentions(make_post('http://example.com/b'), {})
+    assert not WebmentionEndpoint.query.get('host:example.com')